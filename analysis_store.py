@@ -0,0 +1,83 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import select, delete
+from models import db, AnalysisSection
+
+# 差分更新のプロンプトに入れる要約の最大文字数
+SUMMARY_MAX_CHARS = 1200
+DELTA_SUMMARY_MAX_CHARS = 300
+SUMMARY_DELTAS = 2
+
+
+def get_sections(stock_id):
+    return db.session.scalars(
+        select(AnalysisSection)
+        .where(AnalysisSection.stock_id == stock_id)
+        .order_by(AnalysisSection.created_at, AnalysisSection.id)
+    ).all()
+
+
+def ensure_base(stock, sections):
+    """セクションが無い銘柄は、既存の analysis_text を base として登録する"""
+    if sections or not stock.analysis_text:
+        return sections
+    base = AnalysisSection(stock_id=stock.id, kind='base', body=stock.analysis_text,
+                           created_at=stock.rating_date or datetime.utcnow())
+    db.session.add(base)
+    return [base]
+
+
+def add_delta(stock_id, body):
+    section = AnalysisSection(stock_id=stock_id, kind='delta', body=body.strip(), created_at=datetime.utcnow())
+    db.session.add(section)
+    return section
+
+
+def delete_sections(stock_id):
+    db.session.execute(delete(AnalysisSection).where(AnalysisSection.stock_id == stock_id))
+
+
+def compact_summary(sections):
+    """base の見出しと箇条書き、直近の差分だけを抜き出した短い要約を作る"""
+    parts = []
+    base = next((s for s in sections if s.kind == 'base'), None)
+    if base:
+        lines = [line.strip() for line in base.body.splitlines()]
+        key_lines = [line for line in lines if line.startswith(('#', '-', '*', '・'))]
+        parts.append('\n'.join(key_lines or lines)[:SUMMARY_MAX_CHARS])
+    for section in [s for s in sections if s.kind == 'delta'][-SUMMARY_DELTAS:]:
+        parts.append(f"【{section.created_at:%Y-%m-%d} 更新】\n{section.body[:DELTA_SUMMARY_MAX_CHARS]}")
+    return '\n\n'.join(parts)
+
+
+def last_updated(sections):
+    """最後に差分を追加した日時 (まだ一度も更新していなければ None)"""
+    deltas = [s for s in sections if s.kind == 'delta']
+    return deltas[-1].created_at if deltas else None
+
+
+def compose(base_text, sections):
+    """base と差分をつなげて、画面に表示する1つのレポートにする"""
+    parts = []
+    for section in sections:
+        if section.kind == 'base':
+            parts.append(section.body)
+        else:
+            parts.append(f"\n\n---\n\n**【{section.created_at:%Y-%m-%d} 更新】**\n{section.body}")
+    if not any(s.kind == 'base' for s in sections) and base_text:
+        parts.insert(0, base_text)
+    return ''.join(parts)
+
+
+def full_texts(stocks):
+    """複数銘柄のレポートを1回のクエリでまとめて組み立てる"""
+    sections_by_stock = defaultdict(list)
+    stock_ids = [stock.id for stock in stocks]
+    if stock_ids:
+        for section in db.session.scalars(
+            select(AnalysisSection)
+            .where(AnalysisSection.stock_id.in_(stock_ids))
+            .order_by(AnalysisSection.created_at, AnalysisSection.id)
+        ):
+            sections_by_stock[section.stock_id].append(section)
+    return {stock.id: compose(stock.analysis_text, sections_by_stock[stock.id]) for stock in stocks}
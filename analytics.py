@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+from datetime import date
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+import metrics
+from models import db, StockItem, CacheGeneration
+
+# numpy / pandas は読み込みに時間がかかるので、起動を遅くしないよう集計する関数の中で読み込む
+
+# 株価の更新や銘柄の追加・編集・削除で破棄する。破棄はDBの世代番号で他のワーカープロセスにも伝える
+TTL = float(os.environ.get('ANALYTICS_CACHE_TTL', 60 * 60))
+VALUATION_COLUMNS = ('per', 'pbr', 'dividend_yield')
+PERCENTILES = (10, 25, 50, 75, 90)
+_COLUMNS = ('id', 'ticker', 'sector', 'rating', 'entry_price', 'current_price', 'rating_date') + VALUATION_COLUMNS
+_ALL_USERS_KEY = 'analytics'
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _user_key(user_id):
+    return f"analytics:{user_id}"
+
+
+def _bump(key):
+    """key の世代番号を1つ増やす。行が無ければ作る (同時に作られた場合は増やし直す)"""
+    for _ in range(2):
+        result = db.session.execute(
+            update(CacheGeneration).where(CacheGeneration.key == key).values(generation=CacheGeneration.generation + 1)
+        )
+        if result.rowcount == 0:
+            try:
+                db.session.execute(insert(CacheGeneration).values(key=key, generation=1))
+            except IntegrityError:
+                db.session.rollback()
+                continue
+        db.session.commit()
+        return
+
+
+def _generations(user_id):
+    rows = dict(db.session.execute(
+        select(CacheGeneration.key, CacheGeneration.generation)
+        .where(CacheGeneration.key.in_([_ALL_USERS_KEY, _user_key(user_id)]))
+    ).all())
+    return rows.get(_ALL_USERS_KEY, 0), rows.get(_user_key(user_id), 0)
+
+
+def invalidate(user_id=None):
+    """user_id の集計結果を破棄する。省略すると全ユーザー分を破棄する"""
+    with _lock:
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
+    _bump(_ALL_USERS_KEY if user_id is None else _user_key(user_id))
+
+
+def get(user_id):
+    """キャッシュを通して user_id の集計結果を返す"""
+    now = time.monotonic()
+    generations = _generations(user_id)
+    with _lock:
+        entry = _cache.get(user_id)
+    if entry and entry[2] == generations and now - entry[0] < TTL:
+        metrics.record_cache('analytics', 'hit')
+        return entry[1]
+    metrics.record_cache('analytics', 'miss')
+    result = compute(load_frame(user_id))
+    with _lock:
+        _cache[user_id] = (now, result, generations)
+    return result
+
+
+def load_frame(user_id):
+    """集計に使う列だけを1回のクエリで DataFrame に読み込む (ORMオブジェクトは作らない)"""
+    import pandas as pd
+    rows = db.session.execute(
+        select(*(getattr(StockItem, column) for column in _COLUMNS)).where(StockItem.user_id == user_id)
+    ).all()
+    frame = pd.DataFrame.from_records(rows, columns=_COLUMNS)
+    for column in ('entry_price', 'current_price') + VALUATION_COLUMNS:
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    frame['rating_date'] = pd.to_datetime(frame['rating_date'])
+    frame['sector'] = frame['sector'].fillna('不明')
+    return frame
+
+
+def _rating_closes(frame):
+    """各行の評価日時点の終値を保存済みの日足から引く。日足が無い行は NaN"""
+    import numpy as np
+    import pandas as pd
+    import price_history
+    closes = np.full(len(frame), np.nan)
+    rated = frame['rating_date'].notna().to_numpy()
+    if not rated.any():
+        return closes
+    tickers = frame['ticker'].str.upper().to_numpy()
+    rating_days = frame['rating_date'].to_numpy().astype('datetime64[D]')
+    rated_rows = np.flatnonzero(rated)
+    rows_by_ticker = pd.Series(rated_rows).groupby(tickers[rated_rows]).indices
+    for ticker, bars in price_history.load(rows_by_ticker).items():
+        rows = rated_rows[rows_by_ticker[ticker]]
+        index = np.searchsorted(bars['date'], rating_days[rows], side='right') - 1
+        found = index >= 0
+        closes[rows[found]] = bars['close'][index[found]]
+    return closes
+
+
+def _clean(value):
+    import numpy as np
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) or np.isinf(value) else round(float(value), 4)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def _records(frame):
+    return [{key: _clean(value) for key, value in row.items()} for row in frame.reset_index().to_dict('records')]
+
+
+def compute(frame, today=None):
+    """銘柄の DataFrame からセクター別・評価別の集計、評価日からの騰落率、バリュエーションの分布を計算する"""
+    import numpy as np
+    import pandas as pd
+    today = pd.Timestamp(today or date.today())
+    entry = frame['entry_price'].to_numpy(dtype='float64')
+    current = frame['current_price'].to_numpy(dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        performance = np.where((entry > 0) & (current > 0), (current / entry - 1) * 100, 0.0)
+        base = _rating_closes(frame)
+        # 日足が無い場合は登録時の株価を評価日の株価の代わりに使う
+        base = np.where(np.isnan(base), entry, base)
+        since_rating = np.where(frame['rating_date'].notna() & (base > 0) & (current > 0),
+                                (current / base - 1) * 100, np.nan)
+        days_held = (today - frame['rating_date']).dt.days.to_numpy(dtype='float64')
+        # 1年未満の保有期間を年率に引き延ばすと極端な値 (オーバーフロー) になるので、年率換算は1年以上の銘柄だけにする。
+        # 年数を先に NaN にしておき、1年未満の銘柄では累乗を計算しない
+        years = np.where(days_held >= 365, days_held / 365, np.nan)
+        annualized = ((1 + since_rating / 100) ** (1 / years) - 1) * 100
+    # 無限大は平均を壊し、JSON にも出せないので NaN (None) にする
+    performance, since_rating, annualized = (np.where(np.isfinite(v), v, np.nan)
+                                             for v in (performance, since_rating, annualized))
+    frame = frame.assign(performance=performance, since_rating=since_rating, annualized=annualized,
+                         winner=performance > 0)
+
+    total = len(frame)
+    by_sector = frame.groupby('sector').agg(
+        count=('id', 'size'), avg_performance=('performance', 'mean'),
+        per=('per', 'median'), pbr=('pbr', 'median'), dividend_yield=('dividend_yield', 'mean'),
+    ).sort_values('count', ascending=False)
+    by_sector['weight'] = by_sector['count'] / total * 100 if total else 0.0
+    by_rating = frame.groupby('rating').agg(
+        count=('id', 'size'), avg_performance=('performance', 'mean'),
+        median_performance=('performance', 'median'), win_ratio=('winner', 'mean'),
+        avg_since_rating=('since_rating', 'mean'), avg_annualized=('annualized', 'mean'),
+    )
+    by_rating['win_ratio'] *= 100
+
+    valuation = {}
+    for column in VALUATION_COLUMNS:
+        values = frame[column].to_numpy(dtype='float64')
+        values = values[~np.isnan(values)]
+        valuation[column] = {
+            'count': int(values.size),
+            'mean': _clean(values.mean()) if values.size else None,
+            'percentiles': ({str(p): _clean(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+                            if values.size else {}),
+        }
+
+    rated = frame[frame['rating_date'].notna()].sort_values('since_rating', ascending=False, na_position='last')
+    return {
+        'total': total,
+        'avg_performance': _clean(frame['performance'].mean()) if total else None,
+        'by_sector': _records(by_sector.rename_axis('sector')),
+        'by_rating': _records(by_rating.rename_axis('rating')),
+        'valuation': valuation,
+        'since_rating': _records(rated[['id', 'ticker', 'rating', 'since_rating', 'annualized']]
+                                 .set_index('id').head(20)),
+    }
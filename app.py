@@ -1,64 +1,106 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import select, asc, desc
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-import yfinance as yf
+import click
+from flask import Flask, Response, stream_with_context, render_template, request, redirect, url_for, flash, jsonify
+from sqlalchemy import select, asc, desc, update, insert, bindparam, and_, or_, inspect
+from sqlalchemy.orm import defer
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from datetime import datetime
 from dotenv import load_dotenv
 import os
+import logging
 import json
 import re
+import csv
+import base64
 from operator import itemgetter
-# Vertex AI 関連のライブラリをインポート
-import vertexai
-from vertexai.generative_models import GenerativeModel
+import market_data
+from models import db, User, StockItem, TickerMetadata, AnalysisJob
+import jobs
+import map_cache
+import theme_graph
+import analysis_store
+import news_store
+import analytics
+import watchlist_io
+import refresh_scheduler
+import price_feed
+import metrics
+import rate_limit
+import tree_parser
+from tree_parser import TreeStreamParser, extract_json
+import time
+# yfinance・Vertex AI・numpy/pandas は起動を遅くしないよう、各モジュールで最初に使うときに読み込む
+import gemini_client
 
 load_dotenv()
-app = Flask(__name__)
-
-# --- Renderデプロイ用に修正した箇所 ---
-
-# SECRET_KEYを環境変数から取得するように変更
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default-secret-key-for-local-dev')
-
-# データベース接続設定を環境変数に応じて切り替える
-DATABASE_URL = os.environ.get('DATABASE_URL')
-if DATABASE_URL:
-    # Render環境のPostgreSQLに接続
-    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
-else:
-    # ローカル開発環境のSQLiteに接続
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# --- 修正箇所ここまで ---
-
 # 開発中はTrueにするとAPIを消費せずに固定データを返す
-DEV_MODE = False
-# --- Vertex AI の初期化 ---
-try:
-    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
-    location = os.environ.get("GOOGLE_CLOUD_LOCATION")
-    # ローカル認証とGCP環境での認証を両立させるため、projectとlocationが取得できた場合のみ初期化
-    if project_id and location:
-        # ▼▼▼ 今回の修正箇所 ▼▼▼
-        vertexai.init(project=project_id, location=location)
-        # ▲▲▲ 今回の修正箇所 ▲▲▲
-except Exception as e:
-    print(f"Vertex AIの初期化中にエラーが発生しました: {e}")
-    # アプリケーションの起動は続行する
-
-db = SQLAlchemy(app)
-
-# アプリケーションコンテキスト内でテーブルを自動作成する
-with app.app_context():
-    db.create_all()
-
+DEV_MODE = os.environ.get('DEV_MODE') == '1'
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
+def database_uri():
+    """データベース接続設定を環境変数に応じて切り替える"""
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        # 本番環境のPostgreSQLに接続
+        return database_url.replace('postgres://', 'postgresql://', 1)
+    # ローカル開発環境のSQLiteに接続
+    return 'sqlite:///users.db'
+# ワーカープロセスの中でDBを使うバックグラウンドスレッドの数 (分析ジョブ・株価の配信・ニュース・株価の定期更新)
+BACKGROUND_THREADS = 4
+def engine_options(uri):
+    """コネクションプールの設定
+
+    切れた接続を使わないよう貸し出し前に確認 (pre_ping) し、Postgres 側でアイドル接続が切られる前に作り直す (recycle)。
+    プールは gunicorn のスレッド数と BACKGROUND_THREADS の合計で、接続を同時に使う数より多くは作らない。
+    ワーカー数 × (DB_POOL_SIZE + DB_MAX_OVERFLOW) が Postgres の最大接続数を超えないようにする (gunicorn.conf.py)。
+    """
+    options = {'pool_pre_ping': True, 'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 280))}
+    if uri.startswith('postgresql'):
+        threads = int(os.environ.get('GUNICORN_THREADS', 8))
+        options.update(
+            pool_size=int(os.environ.get('DB_POOL_SIZE', threads + BACKGROUND_THREADS)),
+            max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 0)),
+            pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            # 1つのSQLがワーカーのスレッドを占有し続けないようにする (ミリ秒)
+            connect_args={'options': f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))}"},
+        )
+    return options
+# ルートごとの処理時間の上限(秒)。Gemini・yfinance の呼び出しは締め切りまでの残り時間でタイムアウトする
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 30))
+ROUTE_TIMEOUTS = {
+    'generate_analysis_route': 90,
+    'generate_analysis_stream': 120,
+    'add_stock_from_prism': 90,
+    'generate_map': 60,
+    'generate_map_from_news': 60,
+    'generate_map_stream': 120,
+    'generate_map_from_news_stream': 120,
+    'get_latest_news': 60,
+    'update_financial_data': 60,
+    'import_stocks': 600,
+}
+def create_app():
+    """設定と拡張機能を初期化したアプリを作る
+
+    テーブルの作成はアプリの中では行わず、デプロイ時に flask upgrade-db で行う (Procfile の release と Dockerfile の CMD)。
+    DATABASE_URL を設定していないローカル開発環境の SQLite だけは、手順を省けるよう起動時に作成する。
+    """
+    app = Flask(__name__)
+    # SECRET_KEYを環境変数から取得する
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default-secret-key-for-local-dev')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['REQUEST_TIMEOUT'] = REQUEST_TIMEOUT
+    app.config['ROUTE_TIMEOUTS'] = ROUTE_TIMEOUTS
+    # リクエストごとの所要時間の内訳を記録し、JSON形式でログに出す (LOG_LEVEL=DEBUG でAIの応答内容も出す)
+    metrics.init_app(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+    if not os.environ.get('DATABASE_URL'):
+        with app.app_context():
+            db.create_all()
+    return app
+app = create_app()
 
 SECTOR_TRANSLATION = {
     'Consumer Cyclical': '一般消費財', 'Technology': 'テクノロジー', 'Industrials': '資本財',
@@ -66,74 +108,104 @@ SECTOR_TRANSLATION = {
     'Consumer Defensive': '生活必需品', 'Basic Materials': '素材', 'Real Estate': '不動産',
     'Utilities': '公共事業', 'Energy': 'エネルギー', 'N/A': 'N/A'
 }
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    password_hash = db.Column(db.String(200), nullable=False)
-    stocks = db.relationship('StockItem', backref='owner', lazy=True)
-
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
-
-    def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-class StockItem(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    ticker = db.Column(db.String(20), nullable=False)
-    company_name = db.Column(db.String(100), nullable=True)
-    company_name_en = db.Column(db.String(100), nullable=True)
-    sector = db.Column(db.String(50), nullable=True)
-    memo = db.Column(db.Text, nullable=True)
-    rating = db.Column(db.String(10), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    entry_price = db.Column(db.Float, nullable=False)
-    current_price = db.Column(db.Float, nullable=True)
-    rating_date = db.Column(db.DateTime, nullable=True)
-    per = db.Column(db.Float, nullable=True)
-    pbr = db.Column(db.Float, nullable=True)
-    dividend_yield = db.Column(db.Float, nullable=True)
-    analysis_text = db.Column(db.Text, nullable=True)
-    has_update = db.Column(db.Boolean, default=False, nullable=False)
-    @property
-    def performance(self):
-        if self.current_price and self.entry_price and self.entry_price > 0:
-            return (self.current_price / self.entry_price - 1) * 100
-        return 0
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
-def extract_json(text):
-    text = re.sub(r'```json\s*(.*?)\s*```', r'\1', text, flags=re.DOTALL)
-    match = re.search(r'\{.*\}', text, re.DOTALL)
-    if match:
-        return match.group(0)
-    return text
-def get_japanese_name_by_gemini(ticker):
+def rate_limited_message(e):
+    return f"アクセスが集中しています。{e.retry_after}秒ほど待ってからもう一度お試しください。"
+@app.errorhandler(rate_limit.RateLimited)
+def rate_limited_response(e, **fields):
+    """外部APIの呼び出し回数の上限に達した場合は 429 と Retry-After を返す"""
+    response = jsonify({"error": rate_limited_message(e), "retry_after": e.retry_after, **fields})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+DEADLINE_EXCEEDED_MESSAGE = "AIの応答に時間がかかりすぎたため中断しました。もう一度お試しください。"
+@app.errorhandler(gemini_client.RequestDeadlineExceeded)
+def deadline_exceeded_response(e, **fields):
+    """ルートの締め切り (ROUTE_TIMEOUTS) を過ぎた場合は 504 を返す"""
+    app.logger.warning(f"Request deadline exceeded: {e!r}")
+    response = jsonify({"error": DEADLINE_EXCEEDED_MESSAGE, **fields})
+    response.status_code = 504
+    return response
+async def get_japanese_name_by_gemini_async(ticker):
     if DEV_MODE:
         return "（開発モード名称）"
     try:
-        model = GenerativeModel("gemini-1.5-flash")
         prompt = f"""
         証券コード「{ticker}」の正式な日本語社名を教えてください。
         以下のJSON形式のみで、他の文字列は一切含めずに回答してください。
         {{ "japanese_name": "日本語の正式社名" }}
         """
-        response = model.generate_content(prompt)
+        response = await gemini_client.generate_async(prompt)
         json_string = extract_json(response.text)
         if json_string:
             data = json.loads(json_string)
             if "japanese_name" in data:
                 return data["japanese_name"]
     except Exception as e:
-        print(f"Error getting Japanese name from Gemini for {ticker}: {e}")
+        app.logger.warning(f"Error getting Japanese name from Gemini for {ticker}: {e}")
     return ticker
-def generate_initial_analysis(ticker, company_name):
-    """Gemini を使って銘柄の初期分析を生成する"""
+def get_japanese_name_by_gemini(ticker):
+    return gemini_client.run(get_japanese_name_by_gemini_async(ticker))
+JAPANESE_NAMES_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {"type": "object", "properties": {"companies": {"type": "array", "items": {
+        "type": "object", "properties": {"ticker": {"type": "string"}, "japanese_name": {"type": "string"}},
+        "required": ["ticker", "japanese_name"]}}}, "required": ["companies"]},
+}
+async def get_japanese_names_by_gemini_async(tickers):
+    """複数の銘柄の日本語社名を1回の呼び出しでまとめて問い合わせる。ティッカー -> 社名 (分からなかった銘柄は含めない)"""
     if DEV_MODE:
-        return "これは開発モードの分析テキストです。"
+        return {ticker: "（開発モード名称）" for ticker in tickers}
     try:
-        model = GenerativeModel("gemini-1.5-flash")
         prompt = f"""
+        次の証券コードそれぞれの正式な日本語社名を教えてください: {", ".join(tickers)}
+        以下のJSON形式のみで、他の文字列は一切含めずに回答してください。
+        {{ "companies": [{{ "ticker": "証券コード", "japanese_name": "日本語の正式社名" }}] }}
+        """
+        response = await gemini_client.generate_async(prompt, generation_config=JAPANESE_NAMES_GENERATION_CONFIG)
+        data = json.loads(extract_json(response.text))
+        companies = data.get("companies", []) if isinstance(data, dict) else []
+        requested = set(tickers)
+        return {theme_graph.normalize_ticker(c.get("ticker")): c["japanese_name"] for c in companies
+                if isinstance(c, dict) and isinstance(c.get("japanese_name"), str)
+                and theme_graph.normalize_ticker(c.get("ticker")) in requested}
+    except Exception as e:
+        app.logger.warning(f"Error getting Japanese names from Gemini for {len(tickers)} tickers: {e}")
+    return {}
+def resolve_ticker_metadata(ticker, info, japanese_name=None):
+    """日本語社名・英語社名・セクター(日本語)を返す
+
+    TickerMetadata に登録済みならそれを使い、無い項目だけ info と Gemini で補って保存する。
+    japanese_name を渡した場合は Gemini への問い合わせの代わりにそれを使う。
+    """
+    metadata = db.session.get(TickerMetadata, ticker.upper())
+    if metadata is None:
+        metadata = TickerMetadata(ticker=ticker.upper())
+    changed = False
+    if not metadata.company_name_en and info.get('longName'):
+        metadata.company_name_en = info['longName']
+        changed = True
+    if not metadata.sector and info.get('sector'):
+        metadata.sector = SECTOR_TRANSLATION.get(info['sector'], info['sector'])
+        changed = True
+    if metadata.company_name:
+        japanese_name = metadata.company_name
+    else:
+        japanese_name = japanese_name or get_japanese_name_by_gemini(ticker)
+        # 取得に失敗してティッカーが返ってきた場合や開発モードの仮名称は保存しない
+        if japanese_name != ticker and not DEV_MODE:
+            metadata.company_name = japanese_name
+            changed = True
+    if changed:
+        metadata.updated_at = datetime.utcnow()
+        db.session.merge(metadata)
+    return (japanese_name,
+            metadata.company_name_en or ticker,
+            metadata.sector or 'N/A')
+def initial_analysis_prompt(ticker, company_name):
+    return f"""
         あなたはプロの証券アナリストです。日本の企業「{company_name}（証券コード: {ticker}）」について、以下の観点から詳細な分析レポートを作成してください。
 
         ### 1. 外部環境分析
@@ -153,44 +225,97 @@ def generate_initial_analysis(ticker, company_name):
 
         以上の内容を、平易な日本語で、マークダウン形式でまとめてください。
         """
-        response = model.generate_content(prompt)
+INITIAL_ANALYSIS_ERROR = "分析の生成中にエラーが発生しました。"
+async def generate_initial_analysis_async(ticker, company_name):
+    """Gemini を使って銘柄の初期分析を生成する
+
+    回数制限の RateLimited と、リクエストの締め切りを過ぎた RequestDeadlineExceeded はそのまま送出する。
+    """
+    if DEV_MODE:
+        return "これは開発モードの分析テキストです。"
+    try:
+        prompt = initial_analysis_prompt(ticker, company_name)
+        response = await gemini_client.generate_async(prompt)
         return response.text
+    except (rate_limit.RateLimited, gemini_client.RequestDeadlineExceeded):
+        raise
     except Exception as e:
-        print(f"Error generating initial analysis for {ticker}: {e}")
-        return "分析の生成中にエラーが発生しました。"
-def update_analysis_with_news(ticker, company_name, old_analysis):
-    """Gemini を使って最新ニュースを基に分析内容を更新する"""
+        app.logger.warning(f"Error generating initial analysis for {ticker}: {e}")
+        return INITIAL_ANALYSIS_ERROR
+def generate_initial_analysis(ticker, company_name):
+    return gemini_client.run(generate_initial_analysis_async(ticker, company_name))
+NO_CHANGE_MARKER = "NO_CHANGE"
+async def update_analysis_with_news_async(ticker, company_name, summary, last_update):
+    """Gemini を使って最新ニュースを基に分析の差分を作る
+
+    既存レポート全体ではなく要約と最終更新日だけを送り、変更点の箇条書きだけを受け取る。
+    大きな変更が無い場合やエラーの場合は None を返す。回数制限の RateLimited はそのまま送出する。
+    """
     if DEV_MODE:
-        return old_analysis + "\n\n---\n\n**【2025-09-04 更新】**\n- 開発モードでの更新テストです。"
+        return "- 開発モードでの更新テストです。"
+    last_update_str = last_update.strftime("%Y年%m月%d日") if last_update else "不明（直近数ヶ月を対象としてください）"
     try:
-        model = GenerativeModel("gemini-1.5-flash")
         prompt = f"""
         あなたはプロの証券アナリストです。日本の企業「{company_name}（証券コード: {ticker}）」に関する既存の分析レポートを、最新情報で更新するタスクです。
 
-        ### 既存の分析レポート
+        ### 既存の分析レポートの要約
         ```
-        {old_analysis}
+        {summary}
         ```
 
-        ### あなたのタスク
-        1.  直近数ヶ月のこの企業に関する重要なニュースや決算情報を wewnętrznie（内部で）検索・考慮してください。
-        2.  その最新情報を踏まえて、上記の「既存の分析レポート」の内容を評価してください。
-        3.  分析内容（外部環境、SWOT、将来性）に**重要な変更が必要な場合のみ**、内容を修正してください。
-        4.  修正した場合、レポートの末尾に**水平線(`---`)**を追加し、その下に「**【YYYY-MM-DD 更新】**」という見出しを付けて、**変更点やその根拠となったニュースの要約**を箇条書きで追記してください。
-        5.  最新情報を踏まえても既存の分析から**大きな変更が必要ない場合**は、既存の分析レポートを**完全にそのまま**返してください。追記は不要です。
+        ### 最終更新日
+        {last_update_str}
 
-        最終的なアウトプットは、更新後の完全な分析レポートのテキストのみとしてください。
+        ### あなたのタスク
+        1.  最終更新日以降のこの企業に関する重要なニュースや決算情報を内部で検索・考慮してください。
+        2.  その最新情報を踏まえて、上記の既存の分析内容（外部環境、SWOT、将来性）に**重要な変更が必要かどうか**を評価してください。
+        3.  変更が必要な場合は、**変更点やその根拠となったニュースの要約**だけを箇条書きで出力してください。見出しや既存レポートの繰り返しは不要です。
+        4.  **大きな変更が必要ない場合**は「{NO_CHANGE_MARKER}」とだけ出力してください。
         """
-        response = model.generate_content(prompt)
-        return response.text
+        response = await gemini_client.generate_async(prompt)
+        delta = response.text.strip()
+        if not delta or delta.startswith(NO_CHANGE_MARKER):
+            return None
+        return delta
+    except rate_limit.RateLimited:
+        raise
     except Exception as e:
-        print(f"Error updating analysis for {ticker}: {e}")
-        return old_analysis
+        app.logger.warning(f"Error updating analysis for {ticker}: {e}")
+        return None
+def update_analysis_with_news(ticker, company_name, summary, last_update):
+    return gemini_client.run(update_analysis_with_news_async(ticker, company_name, summary, last_update))
+def refresh_stock_analysis(stock):
+    """1銘柄の分析を差分で更新する。差分を追加した場合は True を返す
+
+    一括登録した銘柄など分析テキストが無い場合は、初期分析を生成して True を返す。
+    """
+    if not stock.analysis_text:
+        analysis_text = generate_initial_analysis(stock.ticker, stock.company_name or stock.ticker)
+        if analysis_text == INITIAL_ANALYSIS_ERROR:
+            raise RuntimeError(INITIAL_ANALYSIS_ERROR)
+        stock.analysis_text = analysis_text
+        return True
+    sections = analysis_store.ensure_base(stock, analysis_store.get_sections(stock.id))
+    if not sections:
+        return False
+    delta = update_analysis_with_news(stock.ticker, stock.company_name,
+                                      analysis_store.compact_summary(sections),
+                                      analysis_store.last_updated(sections))
+    if delta is None:
+        return False
+    analysis_store.add_delta(stock.id, delta)
+    return True
 @app.route('/')
 def home():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
     return render_template('home.html')
+def analysis_company_name(ticker):
+    """分析のプロンプトに使う社名 (英語)"""
+    metadata = db.session.get(TickerMetadata, ticker.upper())
+    if metadata and metadata.company_name_en:
+        return metadata.company_name_en
+    return market_data.get_info(ticker).get('longName', ticker)
 @app.route('/generate_analysis', methods=['POST'])
 @login_required
 def generate_analysis_route():
@@ -198,12 +323,87 @@ def generate_analysis_route():
     if not ticker:
         return jsonify({"error": "ティッカーがありません"}), 400
     try:
-        info = yf.Ticker(ticker).info
-        company_name = info.get('longName', ticker)
+        company_name = analysis_company_name(ticker)
         analysis_text = generate_initial_analysis(ticker, company_name)
         return jsonify({"analysis_text": analysis_text})
+    except rate_limit.RateLimited as e:
+        return rate_limited_response(e)
+    except gemini_client.RequestDeadlineExceeded as e:
+        return deadline_exceeded_response(e)
     except Exception as e:
         return jsonify({"error": f"分析生成エラー: {e}"}), 500
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+@app.route('/generate_analysis/stream', methods=['POST'])
+@login_required
+def generate_analysis_stream():
+    """初期分析を生成しながら Server-Sent Events で少しずつ返す"""
+    ticker = request.form.get('ticker')
+    if not ticker:
+        return jsonify({"error": "ティッカーがありません"}), 400
+    try:
+        company_name = analysis_company_name(ticker)
+    except rate_limit.RateLimited as e:
+        return rate_limited_response(e)
+    except Exception as e:
+        return jsonify({"error": f"分析生成エラー: {e}"}), 500
+
+    def events():
+        if DEV_MODE:
+            yield sse_event({"text": "これは開発モードの分析テキストです。"})
+            yield sse_event({}, event='done')
+            return
+        try:
+            for chunk in gemini_client.stream(initial_analysis_prompt(ticker, company_name)):
+                yield sse_event({"text": chunk})
+            yield sse_event({}, event='done')
+        except rate_limit.RateLimited as e:
+            yield sse_event({"error": rate_limited_message(e), "retry_after": e.retry_after}, event='error')
+        except Exception as e:
+            app.logger.warning(f"Error streaming initial analysis for {ticker}: {e}")
+            yield sse_event({"error": f"分析生成エラー: {e}"}, event='error')
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+SORTABLE_COLUMNS = ('company_name', 'company_name_en', 'ticker', 'rating', 'performance', 'per', 'pbr', 'dividend_yield')
+PAGE_SIZE = int(os.environ.get('DASHBOARD_PAGE_SIZE', 100))
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode()
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        is_null, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return bool(is_null), value, int(last_id)
+    except (ValueError, TypeError):
+        return None
+def keyset_page(query, sort_column, descending, cursor, page_size):
+    """sort_column (NULL は最後) と id の順に並べ、cursor の続きから page_size 件を返す
+
+    OFFSET を使わず直前のページの最後の行の値から続きを取るので、後ろのページでも速い。
+    戻り値は (銘柄のリスト, 次のページのカーソル または None)。
+    """
+    sort_value = sort_column.label('sort_value')
+    after_id = StockItem.id < cursor[2] if cursor and descending else StockItem.id > (cursor[2] if cursor else 0)
+    query = query.add_columns(sort_value).order_by(
+        sort_column.is_(None),
+        desc(sort_column) if descending else asc(sort_column),
+        desc(StockItem.id) if descending else asc(StockItem.id),
+    )
+    if cursor:
+        is_null, value, _ = cursor
+        if is_null:
+            query = query.filter(sort_column.is_(None), after_id)
+        else:
+            after_value = sort_column < value if descending else sort_column > value
+            query = query.filter(or_(sort_column.is_(None), after_value, and_(sort_column == value, after_id)))
+    rows = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last_stock, last_value = rows[-1]
+        next_cursor = encode_cursor([last_value is None, last_value, last_stock.id])
+    return [stock for stock, _ in rows], next_cursor
 @app.route('/dashboard', methods=['GET', 'POST'])
 @login_required
 def dashboard():
@@ -217,18 +417,19 @@ def dashboard():
             flash('ティッカーシンボルと評価は必須です。')
         else:
             try:
-                stock_data = yf.Ticker(ticker)
-                info = stock_data.info
+                stmt = select(StockItem.id).where(StockItem.user_id == current_user.id, StockItem.ticker == ticker.upper())
+                if db.session.scalar(stmt):
+                    flash('この銘柄は既に追加されています。')
+                    return redirect(url_for('dashboard'))
+
+                info = market_data.get_info(ticker)
                 current_price = info.get('currentPrice') or info.get('regularMarketPrice')
 
                 if current_price is None:
                     flash(f'ティッカーシンボル「{ticker}」の株価を取得できませんでした。')
                     return redirect(url_for('dashboard'))
 
-                company_name_en = info.get('longName', ticker)
-                company_name_jp = get_japanese_name_by_gemini(ticker)
-                sector_en = info.get('sector', 'N/A')
-                sector_jp = SECTOR_TRANSLATION.get(sector_en, sector_en)
+                company_name_jp, company_name_en, sector_jp = resolve_ticker_metadata(ticker, info)
                 
                 per = info.get('forwardPE') or info.get('trailingPE')
                 pbr = info.get('priceToBook')
@@ -258,83 +459,191 @@ def dashboard():
                     
                 db.session.add(new_stock)
                 db.session.commit()
+                analytics.invalidate(current_user.id)
                 flash('新しい銘柄をリストに追加しました。')
+            except rate_limit.RateLimited as e:
+                flash(rate_limited_message(e))
             except Exception as e:
                 flash(f'エラーが発生しました: {e}')
         return redirect(url_for('dashboard'))
 
+    if os.environ.get('FINANCIAL_REFRESH_SCHEDULER') == 'in-process':
+        financial_scheduler.start()
     sort_by = request.args.get('sort_by', 'company_name')
+    if sort_by not in SORTABLE_COLUMNS:
+        sort_by = 'company_name'
     order = request.args.get('order', 'asc')
     filter_sector = request.args.get('filter_sector', '')
     filter_rating = request.args.get('filter_rating', '')
-    query = db.session.query(StockItem).filter(StockItem.user_id == current_user.id)
+    # 一覧には表示しない分析内容とメモは読み込まず、詳細を開いたときに /stock/<id>/analysis で取得する
+    query = (db.session.query(StockItem)
+             .options(defer(StockItem.analysis_text), defer(StockItem.memo))
+             .filter(StockItem.user_id == current_user.id))
     if filter_sector:
         query = query.filter(StockItem.sector == filter_sector)
     if filter_rating:
         query = query.filter(StockItem.rating == filter_rating)
-    if sort_by != 'performance':
-        sort_column = getattr(StockItem, sort_by, StockItem.company_name)
-        if order == 'desc':
-            query = query.order_by(desc(sort_column))
-        else:
-            query = query.order_by(asc(sort_column))
-    user_stocks = query.all()
-    if sort_by == 'performance':
-        user_stocks.sort(key=lambda x: x.performance, reverse=(order == 'desc'))
+    user_stocks, next_cursor = keyset_page(query, getattr(StockItem, sort_by), order == 'desc',
+                                           decode_cursor(request.args.get('after')), PAGE_SIZE)
     all_user_stocks = db.session.query(StockItem.sector).filter(StockItem.user_id == current_user.id).distinct().all()
     unique_sectors = sorted([s[0] for s in all_user_stocks if s[0]])
     
     return render_template('dashboard.html', 
                            username=current_user.username, 
                            stocks=user_stocks,
+                           active_job=jobs.get_active_job(current_user.id),
                            unique_sectors=unique_sectors,
                            current_filters={'sector': filter_sector, 'rating': filter_rating},
-                           current_sort={'by': sort_by, 'order': order})
+                           current_sort={'by': sort_by, 'order': order},
+                           next_cursor=next_cursor)
+def refresh_financial_data(user_id=None, tickers=None):
+    """株価と財務指標をまとめて取得し、一括UPDATEで書き戻す
+
+    user_id を省略すると全ユーザーの銘柄が対象になる。tickers を指定した場合はそのティッカーだけを更新する。
+    同じティッカーは1回だけ取得し、保有している全行に同じ値を書き込む。戻り値は (成功件数, 失敗した銘柄 -> エラー内容)。
+    """
+    if tickers is None:
+        query = db.session.query(StockItem.ticker).distinct()
+        if user_id is not None:
+            query = query.filter(StockItem.user_id == user_id)
+        tickers = [ticker for (ticker,) in query]
+    results, failures = market_data.fetch_financials(tickers)
+    for ticker, error in failures.items():
+        app.logger.warning(f"Could not update financial data for {ticker}: {error}")
+    save_financials(results, user_id)
+    return len(results), failures
+def save_financials(results, user_id=None):
+    """ティッカー -> 株価と財務指標 の辞書を、そのティッカーの全行 (user_id を指定するとそのユーザーの行) に書き込む"""
+    if not results:
+        return
+    table = StockItem.__table__
+    stmt = update(table).where(table.c.ticker == bindparam('b_ticker'))
+    if user_id is not None:
+        stmt = stmt.where(table.c.user_id == user_id)
+    stmt = stmt.values(
+        current_price=bindparam('b_current_price'),
+        per=bindparam('b_per'),
+        pbr=bindparam('b_pbr'),
+        dividend_yield=bindparam('b_dividend_yield'),
+    )
+    params = [
+        {'b_ticker': ticker, **{f'b_{key}': value for key, value in financials.items()}}
+        for ticker, financials in results.items()
+    ]
+    db.session.execute(stmt, params)
+    db.session.commit()
+    analytics.invalidate(user_id)
 @app.route('/update_financial_data')
 @login_required
 def update_financial_data():
     """株価と財務指標のみを更新する"""
-    stocks_to_update = current_user.stocks
-    for stock in stocks_to_update:
-        try:
-            stock_data = yf.Ticker(stock.ticker)
-            info = stock_data.info
-            
-            stock.current_price = info.get('currentPrice') or info.get('regularMarketPrice')
-            stock.per = info.get('forwardPE') or info.get('trailingPE')
-            stock.pbr = info.get('priceToBook')
-            stock.dividend_yield = info.get('dividendYield')
-        except Exception as e:
-            print(f"Could not update financial data for {stock.ticker}: {e}")
-            
-    db.session.commit()
-    flash('株価と財務指標を更新しました。')
+    success_count, failures = refresh_financial_data(current_user.id)
+    if failures:
+        flash(f'{success_count}件の銘柄の株価と財務指標を更新しました。（取得失敗: {len(failures)}件 {", ".join(sorted(failures))}）')
+    else:
+        flash(f'{success_count}件の銘柄の株価と財務指標を更新しました。')
     return redirect(url_for('dashboard'))
+# 全ユーザーの銘柄の株価を定期的に更新する。複数プロセスで動かす場合は flask refresh-scheduler を1つだけ起動する
+financial_scheduler = refresh_scheduler.RefreshScheduler(app, lambda tickers: refresh_financial_data(tickers=tickers))
+# ダッシュボードを開いている間の株価の配信。接続が何本あっても、プロセスごとに1つのスレッドがまとめて取得する
+live_prices = price_feed.PriceFeed(app, market_data.fetch_financials, save_financials)
+@app.route('/prices/stream')
+@login_required
+def price_stream():
+    """表示中の銘柄の株価・パフォーマンス・指標のうち、変わった項目だけを Server-Sent Events で送る
+
+    ids に表示中の銘柄の id をカンマ区切りで指定する (省略するとマイリストの全銘柄)。
+    接続中はDBも外部APIも使わず、live_prices の取得を待つだけ。STREAM_SECONDS で切り、ブラウザが接続し直す。
+    """
+    query = select(StockItem.id, StockItem.ticker, StockItem.entry_price, StockItem.current_price,
+                   StockItem.per, StockItem.pbr, StockItem.dividend_yield).where(StockItem.user_id == current_user.id)
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip().isdigit()]
+    if ids:
+        query = query.where(StockItem.id.in_(ids))
+    rows = price_feed.StockRows(db.session.execute(query).all())
+    subscription = live_prices.subscribe(rows.tickers)
+    if subscription is None:
+        return (jsonify({"error": "株価の自動更新の接続数が上限に達しています。しばらくしてから再接続してください。"}), 503,
+                {'Retry-After': str(price_feed.RETRY_MS // 1000)})
+
+    def events():
+        yield f"retry: {price_feed.RETRY_MS}\n\n"
+        stop = time.monotonic() + price_feed.STREAM_SECONDS
+        while (left := stop - time.monotonic()) > 0:
+            changed = rows.changes(subscription.get(min(price_feed.KEEPALIVE, left)))
+            yield sse_event({"stocks": changed}, event='prices') if changed else ": keepalive\n\n"
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # ブラウザが切断した場合も、送り始める前に閉じられた場合も購読をやめる
+    response.call_on_close(lambda: live_prices.unsubscribe(subscription))
+    return response
+# AI分析の一括更新はリクエスト内では行わず、バックグラウンドのワーカーで処理する
+analysis_worker = jobs.AnalysisJobWorker(app, refresh_stock_analysis)
 @app.route('/update_analysis_data')
 @login_required
 def update_analysis_data():
-    """AIによる分析内容のみを更新する"""
-    stocks_to_update = current_user.stocks
-    updated_count = 0
-    for stock in stocks_to_update:
-        try:
-            if stock.analysis_text:
-                new_analysis = update_analysis_with_news(stock.ticker, stock.company_name, stock.analysis_text)
-                if new_analysis.strip() != stock.analysis_text.strip():
-                    stock.analysis_text = new_analysis
-                    stock.has_update = True
-                    updated_count += 1
-                else:
-                    stock.has_update = False
-        except Exception as e:
-            print(f"Could not update analysis for {stock.ticker}: {e}")
-    
-    db.session.commit()
-    if updated_count > 0:
-        flash(f'{updated_count}件の銘柄で分析内容が更新されました。')
+    """AIによる分析内容の更新ジョブを登録する"""
+    job, created = jobs.enqueue_analysis_job(current_user.id)
+    if not created:
+        flash('分析の更新は既に実行中です。')
+    elif job.total == 0:
+        flash('分析内容が登録されている銘柄がありません。')
     else:
-        flash('分析内容をチェックしましたが、大きな変更はありませんでした。')
+        analysis_worker.start()
+        analysis_worker.wake()
+        flash(f'{job.total}件の銘柄の分析更新を開始しました。完了した銘柄から順に反映されます。')
     return redirect(url_for('dashboard'))
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = db.session.get(AnalysisJob, job_id)
+    if not job or job.user_id != current_user.id:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job.to_dict())
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 形式のメトリクス (リクエスト・SQL・yfinance・Gemini の所要時間、トークン数、キャッシュの参照結果)"""
+    if metrics.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {metrics.METRICS_TOKEN}":
+        return Response(status=401)
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    """キャッシュのヒット・ミス件数を返す"""
+    return jsonify(quotes=market_data.quote_cache.stats(), maps=map_cache.stats(), theme_graph=theme_graph.stats())
+@app.route('/stock/<int:stock_id>/analysis')
+@login_required
+def stock_analysis(stock_id):
+    """詳細モーダルに表示する分析内容とメモを返す"""
+    stock = db.session.get(StockItem, stock_id)
+    if not stock or stock.user_id != current_user.id:
+        return jsonify({"error": "銘柄が見つかりません"}), 404
+    return jsonify(company_name=stock.company_name,
+                   analysis_text=analysis_store.full_texts([stock])[stock.id],
+                   memo=stock.memo)
+@app.route('/analytics')
+@login_required
+def portfolio_analytics():
+    """マイリスト全体のセクター別・評価別の集計とバリュエーションの分布を返す"""
+    return jsonify(analytics.get(current_user.id))
+@app.route('/stock/<int:stock_id>/history')
+@login_required
+def stock_history(stock_id):
+    """保存済みの日足から終値の推移と、指定日数(days)の騰落率を返す"""
+    stock = db.session.get(StockItem, stock_id)
+    if not stock or stock.user_id != current_user.id:
+        return jsonify({"error": "銘柄が見つかりません"}), 404
+    import price_history
+    days = request.args.get('days', 365, type=int)
+    bars = price_history.load([stock.ticker]).get(stock.ticker.upper())
+    if bars is None or not len(bars['date']):
+        return jsonify(ticker=stock.ticker, dates=[], close=[], window_return=None)
+    as_of = bars['date'][-1]
+    recent = bars['date'] >= as_of - days
+    return jsonify(ticker=stock.ticker,
+                   dates=bars['date'][recent].astype(str).tolist(),
+                   close=bars['close'][recent].round(2).tolist(),
+                   window_return=price_history.window_returns({stock.ticker: bars}, days, as_of)[stock.ticker])
 @app.route('/delete_stock/<int:stock_id>', methods=['POST'])
 @login_required
 def delete_stock(stock_id):
@@ -342,8 +651,10 @@ def delete_stock(stock_id):
     if not stock_to_delete or stock_to_delete.owner != current_user:
         flash('権限がありません。')
         return redirect(url_for('dashboard'))
+    analysis_store.delete_sections(stock_to_delete.id)
     db.session.delete(stock_to_delete)
     db.session.commit()
+    analytics.invalidate(current_user.id)
     flash('銘柄を削除しました。')
     return redirect(url_for('dashboard'))
 @app.route('/register', methods=['GET', 'POST'])
@@ -408,83 +719,324 @@ def edit_stock(stock_id):
             stock_to_edit.rating_date = None
 
         db.session.commit()
+        analytics.invalidate(current_user.id)
         flash('銘柄の情報を更新しました。')
         return redirect(url_for('dashboard'))
 
     return render_template('edit_stock.html', stock=stock_to_edit)
-def get_news_from_ai():
+NEWS_GENERATION_CONFIG = {
+    "temperature": 1.0,
+    "response_mime_type": "application/json",
+    "response_schema": {"type": "object", "properties": {"headlines": {"type": "array", "items": {"type": "string"}}},
+                        "required": ["headlines"]},
+}
+_HEADLINE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+def parse_headlines(text):
+    """応答からヘッドラインのリストを読む。JSONが途中で切れている場合は、閉じている文字列だけを拾う"""
+    try:
+        data = json.loads(extract_json(text))
+    except json.JSONDecodeError:
+        start = text.find('[', text.find('"headlines"'))
+        if start < 0:
+            return []
+        return [json.loads(f'"{match.group(1)}"') for match in _HEADLINE.finditer(text, start)]
+    headlines = data.get("headlines", []) if isinstance(data, dict) else []
+    return [h for h in headlines if isinstance(h, str) and h.strip()]
+NEWS_FALLBACK_HEADLINES = ["（AIからのニュース取得に失敗しました）", "政府、子育て支援を強化...", "国内旅行が活況...", "AI半導体の需要が世界的に拡大...", "再生可能エネルギーへの投資が加速..."]
+def get_news_from_ai(fallback=True):
     if DEV_MODE:
         return ["（開発モード）...", "（開発モード）...", "（開発モード）...", "（開発モード）...", "（開発モード）..."]
     try:
-        model = GenerativeModel("gemini-1.5-flash")
         current_time_str = datetime.now().strftime("%Y年%m月%d日 %H時%M分%S秒")
         prompt = f"""
         現在の時刻は {current_time_str} です。この現時刻の情報を元に、日本の経済や株式市場に影響を与えそうな、最新のニュースヘッドラインを5つ生成してください。
         以下のJSON形式のみで回答してください。{{"headlines": ["ニュース1", "ニュース2", "ニュース3", "ニュース4", "ニュース5"]}}
         """
-        generation_config = {"temperature": 1.0}
-        response = model.generate_content(prompt, generation_config=generation_config)
-        json_string = extract_json(response.text)
-        if not json_string:
-            raise ValueError("AI response did not contain a valid JSON object.")
-        data = json.loads(json_string)
-        return data.get("headlines", [])
+        response = gemini_client.generate(prompt, generation_config=NEWS_GENERATION_CONFIG)
+        headlines = parse_headlines(response.text)
+        if not headlines:
+            raise ValueError("AI response did not contain any headlines.")
+        return headlines
     except Exception as e:
-        print(f"--- Error getting news from AI ---")
-        print(f"Error: {e}")
+        if not fallback:
+            raise
+        app.logger.warning(f"Error getting news from AI: {e}")
         if 'response' in locals() and hasattr(response, 'text'):
-            print(f"Raw AI Response: {response.text}")
-        print("---------------------------------")
-        return ["（AIからのニュース取得に失敗しました）", "政府、子育て支援を強化...", "国内旅行が活況...", "AI半導体の需要が世界的に拡大...", "再生可能エネルギーへの投資が加速..."]
-def process_ai_request(prompt):
+            app.logger.debug(f"Raw AI Response: {response.text}")
+        return NEWS_FALLBACK_HEADLINES
+DEV_MODE_MAP = {"name": "開発モード", "children": [{"name": "サンプル分野", "children": [{"name": "サンプル企業A", "ticker": "1111.T"}, {"name": "サンプル企業B", "ticker": "2222.T"}]}]}
+MAP_GENERATION_CONFIG = {"temperature": 0.7, "response_mime_type": "application/json",
+                         "response_schema": tree_parser.MAP_SCHEMA}
+CATEGORY_GENERATION_CONFIG = {"temperature": 0.7, "response_mime_type": "application/json",
+                              "response_schema": tree_parser.CATEGORY_SCHEMA}
+def process_ai_request(prompt, mode, text):
     if DEV_MODE:
-        sample_data = {"name": "開発モード", "children": [{"name": "サンプル分野", "children": [{"name": "サンプル企業A", "ticker": "1111.T"}, {"name": "サンプル企業B", "ticker": "2222.T"}]}]}
-        return jsonify(sample_data), 200
+        return jsonify(DEV_MODE_MAP), 200
     try:
-        model = GenerativeModel("gemini-1.5-flash")
-        generation_config = {"temperature": 0.7}
-        response = model.generate_content(prompt, generation_config=generation_config)
+        response = gemini_client.generate(prompt, generation_config=MAP_GENERATION_CONFIG)
         
         if not response.candidates:
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-                 print(f"Prompt Feedback: {response.prompt_feedback}")
+                 app.logger.warning(f"Prompt Feedback: {response.prompt_feedback}")
             return jsonify({"error": "AIからの応答がありませんでした。ブロックされた可能性があります。"}), 500
             
-        json_string = extract_json(response.text)
-        if not json_string:
-            print(f"--- No JSON found in AI response ---")
-            print(f"Raw AI Response: {response.text}")
-            print("------------------------------------")
+        tree, salvaged = tree_parser.parse_tree(response.text)
+        if tree is None:
+            app.logger.warning("No JSON found in AI response")
+            app.logger.debug(f"Raw AI Response: {response.text}")
             return jsonify({"error": "AIの応答から有効なデータ形式を抽出できませんでした。"}), 500
-        
-        json_response = json.loads(json_string)
-        print("--- Sending this JSON data to frontend ---")
-        print(json.dumps(json_response, indent=2, ensure_ascii=False))
-        print("------------------------------------------")
-        return jsonify(json_response), 200
-    except json.JSONDecodeError as e:
-        print(f"--- JSON Parsing Error ---")
-        print(f"Error: {e}")
-        print(f"Raw content being parsed: {json_string}")
-        print("--------------------------")
-        return jsonify({"error": "AIが不正な形式のデータを返しました。"}), 500
+        if salvaged:
+            app.logger.info(f"Salvaged {len(tree['children'])} categories from a malformed map for {mode} {text!r}")
+        validator = theme_graph.TickerValidator()
+        validator.load(tree_parser.tickers(tree))
+        raw_tree = tree
+        tree, broken = tree_parser.clean_tree(raw_tree, validator.ticker, theme_graph.MAX_CATEGORIES,
+                                              theme_graph.MAX_COMPANIES)
+        tree['name'] = tree['name'] or text
+        tree['children'] += repair_categories(mode, text, tree['children'], broken, validator)
+        if not tree['children']:
+            tree['children'] = format_checked_categories(raw_tree.get('children'))
+        if not tree['children']:
+            return jsonify({"error": "AIが不正な形式のデータを返しました。"}), 500
+        # ツリー全体の整形は重いので、DEBUG レベルのときだけ行う
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug(f"Sending this JSON data to frontend: {json.dumps(tree, ensure_ascii=False)}")
+        return jsonify(tree), 200
+    except rate_limit.RateLimited as e:
+        return rate_limited_response(e), 429
+    except (gemini_client.RequestDeadlineExceeded, TimeoutError) as e:
+        app.logger.warning(f"Map generation timed out: {e!r}")
+        return jsonify({"error": DEADLINE_EXCEEDED_MESSAGE}), 504
     except Exception as e:
-        print(f"--- An unexpected error occurred ---")
-        print(f"Error: {e}")
+        app.logger.exception(f"An unexpected error occurred: {e}")
         if 'response' in locals() and hasattr(response, 'text'):
-            print(f"Original AI response: {response.text}")
-        print("---------------------------------")
+            app.logger.debug(f"Original AI response: {response.text}")
         return jsonify({"error": "マップの生成中に予期せぬエラーが発生しました。"}), 500
+def format_checked_categories(categories):
+    """ティッカーの形式だけを確かめた分野のリスト
+
+    銘柄一覧に無いティッカーしか無く、作り直しても分野が残らなかった場合に使い、形式の正しいマップをエラーにはしない。
+    """
+    tree, _ = tree_parser.clean_tree({"children": categories if isinstance(categories, list) else []},
+                                     theme_graph.TickerValidator(check_listing=False).ticker,
+                                     theme_graph.MAX_CATEGORIES, theme_graph.MAX_COMPANIES)
+    return tree['children']
+def map_subject(mode, text):
+    return f"「{text}」というキーワード" if mode == 'keyword' else f"「{text}」というニュース"
+def category_prompt(mode, text, category):
+    return f"""
+    {map_subject(mode, text)}に関連する「{category}」の分野で、日本の主要な上場企業を3社挙げてください。
+    各企業について、name(企業名)、ticker(.T を含む日本の証券コード)、reason(関連する短い根拠)、description(ひとこと紹介)を必ず含めてください。
+    絶対にJSON形式のみで、他の文章は含めずに回答してください。
+    {{ "name": "{category}", "children": [ {{ "name": "企業名A", "ticker": "XXXX.T", "reason": "...", "description": "..." }} ] }}
+    """
+def more_categories_prompt(mode, text, exclude, count):
+    excluded = '、'.join(f"「{name}」" for name in exclude) or 'なし'
+    return f"""
+    {map_subject(mode, text)}に関連する分野を{count}つ挙げ、それぞれに関連する日本の主要な上場企業を3社ずつ挙げてください。
+    次の分野は既に挙げているので除いてください: {excluded}
+    各企業について、name(企業名)、ticker(.T を含む日本の証券コード)、reason(関連する短い根拠)、description(ひとこと紹介)を必ず含めてください。
+    絶対にJSON形式のみで、他の文章は含めずに回答してください。
+    {{ "name": "{text}", "children": [ {{ "name": "分野1", "children": [ {{ "name": "企業名A", "ticker": "XXXX.T", "reason": "...", "description": "..." }} ]}} ] }}
+    """
+def repair_categories(mode, text, categories, broken, validator):
+    """有効な企業が残らなかった分野 (broken) と、足りない分野の分だけを Gemini に作り直させ、追加する分野を返す
+
+    マップ全体は作り直さない。作り直しに失敗した分は諦め、手元の分野だけでマップを返す。
+    """
+    missing = theme_graph.MAX_CATEGORIES - len(categories) - len(broken)
+    if not broken and missing <= 0:
+        return []
+    names = [c['name'] for c in categories]
+    coros = [gemini_client.generate_async(category_prompt(mode, text, name), generation_config=CATEGORY_GENERATION_CONFIG)
+             for name in broken]
+    if missing > 0:
+        coros.append(gemini_client.generate_async(more_categories_prompt(mode, text, names + broken, missing),
+                                                  generation_config=MAP_GENERATION_CONFIG))
+    app.logger.info(f"Repairing map for {mode} {text!r}: {len(broken)} broken categories, {max(missing, 0)} missing")
+    responses = gemini_client.gather(*coros, return_exceptions=True)
+    repaired = []
+    for i, response in enumerate(responses):
+        if isinstance(response, Exception):
+            app.logger.warning(f"Could not repair map for {mode} {text!r}: {response!r}")
+            continue
+        if i < len(broken):
+            try:
+                found = [json.loads(extract_json(response.text))]
+            except json.JSONDecodeError:
+                found = []
+            for category in found:
+                if isinstance(category, dict):
+                    # 作り直しを頼んだ分野の名前のまま使う
+                    category['name'] = broken[i]
+        else:
+            tree, _ = tree_parser.parse_tree(response.text)
+            found = tree['children'] if tree else []
+        validator.load(tree_parser.tickers({"children": found}))
+        for category in found:
+            category = tree_parser.clean_category(category, validator.ticker, theme_graph.MAX_COMPANIES)
+            if category is None or not category['children'] or category['name'] in names:
+                continue
+            names.append(category['name'])
+            repaired.append(category)
+            if len(categories) + len(repaired) == theme_graph.MAX_CATEGORIES:
+                return repaired
+    return repaired
+def keyword_map_prompt(keyword):
+    return f"""
+    「{keyword}」というキーワードから連想される「モノやコト」を5つ挙げ、それぞれに関連する日本の主要な上場企業を3社ずつ挙げてください。
+    各企業について、以下の情報を必ず含めてください。
+    - name: 企業名
+    - ticker: .T を含む日本の証券コード
+    - reason: 「{keyword}」とどう関連するかの短い根拠
+    - description: その企業がどんな会社かの「ひとこと紹介」
+    絶対にJSON形式のみで、他の文章は含めずに回答してください。
+    {{ "name": "{keyword}", "children": [ {{ "name": "モノやコト1", "children": [ {{ "name": "企業名A", "ticker": "XXXX.T", "reason": "...", "description": "..." }} ]}} ] }}
+    """
+def news_map_prompt(news_headline):
+    return f"""
+    「{news_headline}」というニュースから恩恵を受けると考えられる「分野」を5つ挙げ、それぞれに関連する日本の主要な上場企業を3社ずつ挙げてください。
+    各企業について、以下の情報を必ず含めてください。
+    - name: 企業名
+    - ticker: .T を含む日本の証券コード
+    - reason: そのニュースから恩恵を受ける具体的な理由
+    - description: その企業がどんな会社かの「ひとこと紹介」
+    絶対にJSON形式のみで、他の文章は含めずに回答してください。
+    {{ "name": "{news_headline}", "children": [ {{ "name": "恩恵を受ける分野1", "children": [ {{ "name": "企業名A", "ticker": "XXXX.T", "reason": "...", "description": "..." }} ]}} ] }}
+    """
+def cached_map_json(mode, text):
+    """キャッシュ、テーマグラフの順にマップを引く。どちらにも無ければ None"""
+    tree_json = map_cache.get(mode, text)
+    if tree_json is not None or DEV_MODE:
+        return tree_json
+    try:
+        tree = theme_graph.lookup(text, mode)
+    except Exception as e:
+        app.logger.warning(f"Theme graph lookup failed for {mode} {text!r}: {e}")
+        db.session.rollback()
+        return None
+    return json.dumps(tree, ensure_ascii=False) if tree is not None else None
+def remember_map(mode, text, tree_json, generation_ms):
+    """生成したマップをキャッシュに保存し、テーマグラフに取り込む"""
+    map_cache.put(mode, text, tree_json, generation_ms)
+    try:
+        _, rejected = theme_graph.merge(json.loads(tree_json), text)
+        if rejected:
+            app.logger.info(f"Theme graph: dropped {rejected} companies with unknown tickers for {mode} {text!r}")
+    except Exception as e:
+        app.logger.warning(f"Could not merge map into theme graph for {mode} {text!r}: {e}")
+        db.session.rollback()
+def cached_map_request(mode, text, prompt):
+    """マップのキャッシュとテーマグラフを引き、無ければ Gemini で生成して保存する
+
+    リクエストに refresh=1 が付いている場合はキャッシュもグラフも使わずに生成し直す。
+    """
+    if request.values.get('refresh') != '1':
+        tree_json = cached_map_json(mode, text)
+        if tree_json is not None:
+            return Response(tree_json, mimetype='application/json')
+    start = time.perf_counter()
+    response, status = process_ai_request(prompt, mode, text)
+    if status == 200 and not DEV_MODE:
+        generation_ms = (time.perf_counter() - start) * 1000
+        remember_map(mode, text, response.get_data(as_text=True), generation_ms)
+    return response, status
+# ニュースはスケジューラーが定期的に取得し、各ページはその結果を共有して使う
+headline_store = news_store.NewsStore(lambda: get_news_from_ai(fallback=False))
+def ndjson_line(data):
+    return json.dumps(data, ensure_ascii=False) + "\n"
+def stream_map_request(mode, text, prompt):
+    """マップを生成しながら、完成した分野から順に1行1JSON (NDJSON) で返す
+
+    {"type": "root"} → {"type": "category"} × 分野数 → {"type": "done"} の順に送る。
+    キャッシュかテーマグラフにあればそれを同じ形式で送り、生成した場合は完成したツリーを両方に保存する。
+    ティッカーを確かめられなかった分野と足りない分野は、応答の最後に作り直して追加で送る。
+    """
+    tree_json = None if request.values.get('refresh') == '1' else cached_map_json(mode, text)
+
+    @stream_with_context
+    def lines():
+        if tree_json is not None or DEV_MODE:
+            tree = json.loads(tree_json) if tree_json is not None else DEV_MODE_MAP
+            yield ndjson_line({"type": "root", "name": tree.get("name", text)})
+            for category in tree.get("children", []):
+                yield ndjson_line({"type": "category", "node": category})
+            yield ndjson_line({"type": "done"})
+            return
+        parser = TreeStreamParser()
+        validator = theme_graph.TickerValidator()
+        cleaner = tree_parser.TreeCleaner(validator.ticker, theme_graph.MAX_CATEGORIES, theme_graph.MAX_COMPANIES)
+
+        def checked(categories):
+            # ティッカーを確かめ、有効な企業が残った分野だけを送る (残らなかった分野は最後に作り直す)
+            validator.load(tree_parser.tickers({"children": categories}))
+            return cleaner.add(categories)
+
+        root_sent = False
+        start = time.perf_counter()
+        try:
+            for chunk in gemini_client.stream(prompt, generation_config=MAP_GENERATION_CONFIG):
+                categories = parser.feed(chunk)
+                if not root_sent and parser.root_name is not None:
+                    yield ndjson_line({"type": "root", "name": parser.root_name or text})
+                    root_sent = True
+                for category in checked(categories):
+                    yield ndjson_line({"type": "category", "node": category})
+        except rate_limit.RateLimited as e:
+            if not cleaner.categories:
+                yield ndjson_line({"type": "error", "error": rate_limited_message(e), "retry_after": e.retry_after})
+                return
+        except Exception as e:
+            app.logger.warning(f"Error streaming map for {mode} {text!r}: {e}")
+            if not cleaner.categories:
+                yield ndjson_line({"type": "error", "error": "マップの生成中に予期せぬエラーが発生しました。"})
+                return
+        # 途中で切れた分野は読めた企業の分だけ使い、壊れた分野と足りない分野だけを作り直す
+        tail = checked(parser.finish())
+        if not cleaner.categories and not cleaner.broken:
+            yield ndjson_line({"type": "error", "error": "AIの応答から有効なデータ形式を抽出できませんでした。"})
+            return
+        repaired = repair_categories(mode, text, cleaner.categories, cleaner.broken, validator)
+        if not cleaner.categories and not repaired:
+            repaired = format_checked_categories(parser.categories)
+        if not cleaner.categories and not repaired:
+            yield ndjson_line({"type": "error", "error": "AIが不正な形式のデータを返しました。"})
+            return
+        if not root_sent:
+            yield ndjson_line({"type": "root", "name": parser.root_name or text})
+        for category in tail + repaired:
+            yield ndjson_line({"type": "category", "node": category})
+        generation_ms = (time.perf_counter() - start) * 1000
+        tree = {"name": parser.root_name or text, "children": cleaner.categories + repaired}
+        remember_map(mode, text, json.dumps(tree, ensure_ascii=False), generation_ms)
+        yield ndjson_line({"type": "done"})
+    return Response(lines(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
 @app.route('/idea_prism')
 @login_required
 def idea_prism():
-    initial_news = get_news_from_ai()
-    return render_template('idea_prism.html', sample_news=initial_news)
+    headline_store.start_scheduler(app)
+    snapshot = headline_store.latest()
+    return render_template('idea_prism.html',
+                           sample_news=snapshot.headlines if snapshot else [],
+                           news_fetched_at=snapshot.fetched_at.isoformat() if snapshot else '')
 @app.route('/get_latest_news', methods=['GET'])
 @login_required
 def get_latest_news():
-    news_list = get_news_from_ai()
-    return jsonify(headlines=news_list)
+    """共有ストアのヘッドラインを返す。cached=1 の場合は取得し直さない"""
+    headline_store.start_scheduler(app)
+    if request.args.get('cached') == '1':
+        snapshot = headline_store.latest()
+    else:
+        try:
+            snapshot = headline_store.refresh()
+        except Exception as e:
+            app.logger.warning(f"Could not refresh news headlines: {e}")
+            snapshot = headline_store.latest()
+            if snapshot is None:
+                return jsonify(headlines=NEWS_FALLBACK_HEADLINES, fetched_at=None)
+    if snapshot is None:
+        return jsonify(headlines=[], fetched_at=None)
+    return jsonify(headlines=snapshot.headlines, fetched_at=snapshot.fetched_at.isoformat())
 @app.route('/generate_map', methods=['POST'])
 @login_required
 def generate_map():
@@ -492,17 +1044,8 @@ def generate_map():
     if not keyword:
         return jsonify({"error": "キーワードがありません"}), 400
     
-    prompt = f"""
-    「{keyword}」というキーワードから連想される「モノやコト」を5つ挙げ、それぞれに関連する日本の主要な上場企業を3社ずつ挙げてください。
-    各企業について、以下の情報を必ず含めてください。
-    - name: 企業名
-    - ticker: .T を含む日本の証券コード
-    - reason: 「{keyword}」とどう関連するかの短い根拠
-    - description: その企業がどんな会社かの「ひとこと紹介」
-    絶対にJSON形式のみで、他の文章は含めずに回答してください。
-    {{ "name": "{keyword}", "children": [ {{ "name": "モノやコト1", "children": [ {{ "name": "企業名A", "ticker": "XXXX.T", "reason": "...", "description": "..." }} ]}} ] }}
-    """
-    return process_ai_request(prompt)
+    prompt = keyword_map_prompt(keyword)
+    return cached_map_request('keyword', keyword, prompt)
 @app.route('/generate_map_from_news', methods=['POST'])
 @login_required
 def generate_map_from_news():
@@ -510,17 +1053,22 @@ def generate_map_from_news():
     if not news_headline:
         return jsonify({"error": "ニュースが選択されていません"}), 400
 
-    prompt = f"""
-    「{news_headline}」というニュースから恩恵を受けると考えられる「分野」を5つ挙げ、それぞれに関連する日本の主要な上場企業を3社ずつ挙げてください。
-    各企業について、以下の情報を必ず含めてください。
-    - name: 企業名
-    - ticker: .T を含む日本の証券コード
-    - reason: そのニュースから恩恵を受ける具体的な理由
-    - description: その企業がどんな会社かの「ひとこと紹介」
-    絶対にJSON形式のみで、他の文章は含めずに回答してください。
-    {{ "name": "{news_headline}", "children": [ {{ "name": "恩恵を受ける分野1", "children": [ {{ "name": "企業名A", "ticker": "XXXX.T", "reason": "...", "description": "..." }} ]}} ] }}
-    """
-    return process_ai_request(prompt)
+    prompt = news_map_prompt(news_headline)
+    return cached_map_request('news', news_headline, prompt)
+@app.route('/generate_map/stream', methods=['POST'])
+@login_required
+def generate_map_stream():
+    keyword = request.form.get('keyword')
+    if not keyword:
+        return jsonify({"error": "キーワードがありません"}), 400
+    return stream_map_request('keyword', keyword, keyword_map_prompt(keyword))
+@app.route('/generate_map_from_news/stream', methods=['POST'])
+@login_required
+def generate_map_from_news_stream():
+    news_headline = request.form.get('news_headline')
+    if not news_headline:
+        return jsonify({"error": "ニュースが選択されていません"}), 400
+    return stream_map_request('news', news_headline, news_map_prompt(news_headline))
 @app.route('/add_stock_from_prism', methods=['POST'])
 @login_required
 def add_stock_from_prism():
@@ -533,23 +1081,27 @@ def add_stock_from_prism():
         if existing_stock:
             return jsonify(success=False, message="この銘柄は既に追加されています。"), 409
         
-        stock_data = yf.Ticker(ticker)
-        info = stock_data.info
+        info = market_data.get_info(ticker)
         current_price = info.get('currentPrice') or info.get('regularMarketPrice')
         
         if current_price is None:
             return jsonify(success=False, message=f"ティッカー「{ticker}」の株価を取得できませんでした。"), 404
 
-        company_name_en = info.get('longName', ticker)
-        company_name_jp = get_japanese_name_by_gemini(ticker)
-        sector_en = info.get('sector', 'N/A')
-        sector_jp = SECTOR_TRANSLATION.get(sector_en, sector_en)
+        metadata = db.session.get(TickerMetadata, ticker.upper())
+        if metadata and metadata.company_name:
+            japanese_name = metadata.company_name
+            analysis_text = generate_initial_analysis(ticker, japanese_name)
+        else:
+            # 社名の問い合わせと初期分析を同時に行う (分析のプロンプトには英語社名を使う)
+            japanese_name, analysis_text = gemini_client.gather(
+                get_japanese_name_by_gemini_async(ticker),
+                generate_initial_analysis_async(ticker, info.get('longName', ticker)),
+            )
+        company_name_jp, company_name_en, sector_jp = resolve_ticker_metadata(ticker, info, japanese_name)
         per = info.get('forwardPE') or info.get('trailingPE')
         pbr = info.get('priceToBook')
         dividend_yield = info.get('dividendYield')
 
-        analysis_text = generate_initial_analysis(ticker, company_name_jp)
-
         new_stock = StockItem(
             ticker=ticker.upper(),
             company_name=company_name_jp,
@@ -569,14 +1121,207 @@ def add_stock_from_prism():
         )
         db.session.add(new_stock)
         db.session.commit()
+        analytics.invalidate(current_user.id)
         return jsonify(success=True, message=f"{company_name_jp} をマイリストに追加しました。")
+    except rate_limit.RateLimited as e:
+        return rate_limited_response(e, success=False, message=rate_limited_message(e))
+    except gemini_client.RequestDeadlineExceeded as e:
+        return deadline_exceeded_response(e, success=False, message=DEADLINE_EXCEEDED_MESSAGE)
     except Exception as e:
-        print(f"Error adding stock from prism: {e}")
+        app.logger.exception(f"Error adding stock from prism: {e}")
         return jsonify(success=False, message="銘柄の追加中にエラーが発生しました。"), 500
+# ファイルからの一括登録では、社名はバッチごとに1回でまとめて問い合わせ、初期分析は分析ジョブで後から生成する
+watchlist_importer = watchlist_io.WatchlistImporter(get_japanese_names_by_gemini_async, SECTOR_TRANSLATION,
+                                                    save_names=not DEV_MODE)
+@app.route('/export_stocks')
+@login_required
+def export_stocks():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'json'):
+        return jsonify({"error": "ファイル形式は csv か json を指定してください。"}), 400
+    rows = watchlist_io.export_rows(current_user.id)
+    body = watchlist_io.to_csv(rows) if fmt == 'csv' else watchlist_io.to_json(rows)
+    return Response(body, mimetype='text/csv' if fmt == 'csv' else 'application/json',
+                    headers={'Content-Disposition': f'attachment; filename=stocks.{fmt}'})
+@app.route('/import_stocks', methods=['POST'])
+@login_required
+def import_stocks():
+    """CSV / JSON のファイルから銘柄をまとめて登録し、進捗を1行1JSON (NDJSON) で返す"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({"error": "ファイルが選択されていません"}), 400
+    fmt = request.form.get('format') or upload.filename.rsplit('.', 1)[-1].lower()
+    try:
+        records = watchlist_io.parse(upload.read(), fmt)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    user_id = current_user.id
+
+    @stream_with_context
+    def lines():
+        try:
+            for event in watchlist_importer.run(user_id, records):
+                if event['type'] == 'done' and event['job_id']:
+                    analysis_worker.start()
+                    analysis_worker.wake()
+                yield ndjson_line(event)
+        except Exception as e:
+            app.logger.exception(f"Error importing stocks: {e}")
+            db.session.rollback()
+            yield ndjson_line({"type": "error", "error": "銘柄の一括登録中にエラーが発生しました。"})
+    return Response(lines(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """既存のSQLite/PostgreSQLのデータベースに、足りないテーブルとインデックスを追加する"""
+    db.create_all()
+    existing = {index['name'] for index in inspect(db.engine).get_indexes(StockItem.__tablename__)}
+    for index in StockItem.__table__.indexes:
+        if index.name in existing:
+            continue
+        if index.unique:
+            duplicates = db.session.execute(
+                select(StockItem.user_id, StockItem.ticker)
+                .group_by(StockItem.user_id, StockItem.ticker)
+                .having(db.func.count() > 1)
+            ).all()
+            if duplicates:
+                print(f"{index.name} を作成できません。同じユーザーに重複した銘柄があります:")
+                for user_id, ticker in duplicates:
+                    print(f"  user_id={user_id} ticker={ticker}")
+                continue
+        index.create(db.engine)
+        print(f"インデックス {index.name} を作成しました。")
+    print("データベースの更新が完了しました。")
+@app.cli.command('refresh-financials')
+def refresh_financials_command():
+    """全ユーザーの銘柄の株価と財務指標を更新する"""
+    success_count, failures = refresh_financial_data()
+    print(f"更新成功: {success_count}件 / 取得失敗: {len(failures)}件")
+    for ticker, error in sorted(failures.items()):
+        print(f"  {ticker}: {error}")
+    update_price_history_command.callback()
+@app.cli.command('refresh-scheduler')
+@click.option('--once', is_flag=True, help='1回だけ更新して終了する (cron から呼ぶ場合)')
+@click.option('--force', is_flag=True, help='取引時間外の東証銘柄も更新する')
+@click.option('--interval', type=int, default=refresh_scheduler.INTERVAL, show_default=True, help='更新間隔(秒)')
+def refresh_scheduler_command(once, force, interval):
+    """全ユーザーの銘柄の株価と財務指標を定期的に更新する (東証銘柄は立会時間中と引け直後のみ)"""
+    financial_scheduler.interval = interval
+    if not once:
+        financial_scheduler.run()
+        return
+    total, success_count, failures = financial_scheduler.run_once(force=force)
+    print(f"対象: {total}件 / 更新成功: {success_count}件 / 取得失敗: {len(failures)}件")
+    for ticker, error in sorted(failures.items()):
+        print(f"  {ticker}: {error}")
+@app.cli.command('update-price-history')
+def update_price_history_command():
+    """全ユーザーの銘柄の日足を、保存済みの最終日以降の分だけ取得して追記する"""
+    import price_history
+    tickers = db.session.scalars(select(StockItem.ticker).distinct()).all()
+    updated, failures = price_history.update(tickers)
+    analytics.invalidate()
+    print(f"日足を更新: {updated}件 / 取得失敗: {len(failures)}件")
+    for ticker, error in sorted(failures.items()):
+        print(f"  {ticker}: {error}")
+@app.cli.command('build-theme-graph')
+def build_theme_graph_command():
+    """保存済みのマップからテーマグラフを作り直す"""
+    maps, added, rejected = theme_graph.rebuild()
+    stats = theme_graph.stats()
+    print(f"取り込んだマップ: {maps}件 / テーマ: {stats['themes']}件 / 企業: {stats['companies']}社 / 辺: {stats['edges']}本")
+    if rejected:
+        print(f"ティッカーが無効なため除外した企業: {rejected}件")
+def find_user(username):
+    user = db.session.scalar(select(User).where(User.username == username))
+    if user is None:
+        raise click.ClickException(f"ユーザー「{username}」が見つかりません。")
+    return user
+@app.cli.command('import-stocks')
+@click.argument('username')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), help='省略するとファイルの拡張子で判定する')
+def import_stocks_command(username, path, fmt):
+    """CSV / JSON のファイルから銘柄をまとめて登録する (初期分析は flask run-analysis-worker で生成する)"""
+    user = find_user(username)
+    with open(path, 'rb') as f:
+        try:
+            records = watchlist_io.parse(f.read(), fmt or path.rsplit('.', 1)[-1].lower())
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    for event in watchlist_importer.run(user.id, records):
+        if event['type'] == 'start':
+            print(f"新規: {event['total']}件 / 登録済み・重複: {event['duplicates']}件 / 不正な行: {event['invalid']}件")
+        elif event['type'] == 'progress':
+            print(f"  {event['done']} / {event['total']} 取得済み (失敗 {event['failed']}件)")
+        else:
+            print(f"登録: {event['added']}件 / 失敗: {len(event['failed'])}件")
+            for ticker, error in sorted(event['failed'].items()):
+                print(f"  {ticker}: {error}")
+            if event['job_id']:
+                print(f"初期分析のジョブ {event['job_id']} を登録しました。flask run-analysis-worker で生成されます。")
+@app.cli.command('export-stocks')
+@click.argument('username')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='省略すると標準出力に書き出す')
+def export_stocks_command(username, fmt, output):
+    """ユーザーの全銘柄を CSV / JSON で書き出す"""
+    rows = watchlist_io.export_rows(find_user(username).id)
+    body = watchlist_io.to_csv(rows) if fmt == 'csv' else watchlist_io.to_json(rows)
+    if output:
+        with open(output, 'w', encoding='utf-8', newline='') as f:
+            f.write(body)
+    else:
+        click.echo(body.lstrip('\ufeff'), nl=False)
+@app.cli.command('run-analysis-worker')
+@click.option('--until-idle', is_flag=True, help='キューが空になったら終了する')
+def run_analysis_worker_command(until_idle):
+    """AI分析更新ジョブのワーカーをこのプロセスで実行する"""
+    analysis_worker.run(until_idle=until_idle)
+# 東証上場銘柄一覧CSVの列名 (日本語/英語のどちらでも可)
+METADATA_CSV_COLUMNS = {
+    'ticker': ('ticker', 'code', 'コード'),
+    'company_name': ('company_name', 'japanese_name', '銘柄名'),
+    'company_name_en': ('company_name_en', 'english_name', '英語名'),
+    'sector': ('sector', 'セクター'),
+}
+@app.cli.command('load-ticker-metadata')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+def load_ticker_metadata_command(csv_path):
+    """東証上場銘柄一覧のCSVから TickerMetadata を一括登録する"""
+    rows = {}
+    with open(csv_path, encoding='utf-8-sig', newline='') as f:
+        for record in csv.DictReader(f):
+            row = {}
+            for field, names in METADATA_CSV_COLUMNS.items():
+                value = next((record[name].strip() for name in names if record.get(name)), None)
+                if value:
+                    row[field] = value
+            ticker = row.get('ticker', '').upper()
+            if not ticker:
+                continue
+            # 4桁の証券コードは東証のティッカーに変換する
+            if '.' not in ticker:
+                ticker += '.T'
+            row['ticker'] = ticker
+            if 'sector' in row:
+                row['sector'] = SECTOR_TRANSLATION.get(row['sector'], row['sector'])
+            row['updated_at'] = datetime.utcnow()
+            rows[ticker] = row
+
+    existing = set(db.session.scalars(select(TickerMetadata.ticker).where(TickerMetadata.ticker.in_(list(rows)))))
+    new_rows = [row for ticker, row in rows.items() if ticker not in existing]
+    updated_rows = [row for ticker, row in rows.items() if ticker in existing]
+    if new_rows:
+        db.session.execute(insert(TickerMetadata), new_rows)
+    if updated_rows:
+        db.session.execute(update(TickerMetadata), updated_rows)
+    # 一覧を読み込んだ後は、マップとテーマグラフで一覧に無いティッカーを除く
+    theme_graph.mark_listing_loaded()
+    db.session.commit()
+    print(f"新規登録: {len(new_rows)}件 / 更新: {len(updated_rows)}件")
 if __name__ == '__main__':
-    # 以下のブロックはローカル実行時のみ使用され、Renderでは使われません
-    with app.app_context():
-        db.create_all()
+    # 以下のブロックはローカル実行時のみ使用されます (テーブルは create_app か flask upgrade-db で作成する)
     # ポート番号を環境変数から取得し、デフォルトを8080に設定
     port = int(os.environ.get('PORT', 8080))
     app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""AI分析更新ジョブのスループットとユーザー間の公平性を計測する
+
+Gemini の代わりに一定時間待つだけのフェイクを使い、SQLite ファイルをキューにして実行する。
+
+    python benchmarks/bench_analysis_jobs.py --users 40 5 5 --latency 0.2 --workers 4 --rate 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench_jobs.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import jobs  # noqa: E402
+import rate_limit  # noqa: E402
+from app import app, db, User, StockItem, AnalysisJob  # noqa: E402
+from models import AnalysisJobItem  # noqa: E402
+
+
+def fake_analyze(latency, limiter):
+    def analyze(stock):
+        # 実際の Gemini の呼び出しと同じく、ジョブのユーザーの回数に数える
+        limiter.acquire()
+        time.sleep(latency)
+        # 半分の銘柄だけ更新ありにする
+        return int(stock.ticker.split('.')[0]) % 2 == 1
+    return analyze
+
+
+def seed(stock_counts):
+    db.drop_all()
+    db.create_all()
+    user_ids = []
+    for n, count in enumerate(stock_counts):
+        user = User(username=f'bench{n}')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all(
+            StockItem(ticker=f"{1000 + i}.T", company_name=f"銘柄{i}", rating='中立', user_id=user.id,
+                      entry_price=1000.0, analysis_text='ベンチマーク用の分析テキスト')
+            for i in range(count)
+        )
+        user_ids.append(user.id)
+    db.session.commit()
+    return user_ids
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[40, 5, 5], help='ユーザーごとの銘柄数')
+    parser.add_argument('--latency', type=float, default=0.2, help='フェイクモデルの応答時間(秒)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=20.0, help='1秒あたりの最大呼び出し回数 (1ユーザーあたりも同じ)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        user_ids = seed(args.users)
+        job_ids = [jobs.enqueue_analysis_job(user_id)[0].id for user_id in user_ids]
+
+    limiter = rate_limit.Limiter('gemini', args.rate, args.rate, args.rate, args.rate)
+    worker = jobs.AnalysisJobWorker(app, fake_analyze(args.latency, limiter), max_workers=args.workers,
+                                    poll_interval=0.05)
+    worker.start()
+    start = time.perf_counter()
+    finished = {}
+    with app.app_context():
+        while len(finished) < len(job_ids):
+            time.sleep(0.05)
+            db.session.expire_all()
+            for job_id in job_ids:
+                if job_id not in finished and db.session.get(AnalysisJob, job_id).status == 'done':
+                    finished[job_id] = time.perf_counter() - start
+        worker.stop()
+        elapsed = time.perf_counter() - start
+        total = db.session.query(AnalysisJobItem).count()
+        print(f"合計 {total}銘柄 / {elapsed:.2f}秒 / {total / elapsed:.1f}銘柄/秒 "
+              f"(workers={args.workers}, rate={args.rate}/s, latency={args.latency}s)")
+        print(f"{'ユーザー':>6} {'銘柄数':>6} {'完了(秒)':>10} {'更新あり':>8}")
+        for n, job_id in enumerate(job_ids):
+            job = db.session.get(AnalysisJob, job_id)
+            print(f"{n:>6} {job.total:>6} {finished[job_id]:>10.2f} {job.updated_count:>8}")
+
+
+if __name__ == '__main__':
+    main()
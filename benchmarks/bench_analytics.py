@@ -0,0 +1,92 @@
+"""ポートフォリオ分析 (/analytics) の集計時間を銘柄数ごとに計測する
+
+ORMオブジェクトを1行ずつ読んで Python で集計する場合と、列だけを読み込んで
+pandas/NumPy でまとめて集計する場合、キャッシュから返す場合を比べる。
+
+    python benchmarks/bench_analytics.py --sizes 100 1000 5000 --tickers 300
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_analytics.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import analytics  # noqa: E402
+import market_data  # noqa: E402
+import price_history  # noqa: E402
+from app import app, db, User, StockItem  # noqa: E402
+from benchmarks.fakes import FakeYFinance  # noqa: E402
+
+
+def seed(size, tickers):
+    db.drop_all()
+    db.create_all()
+    user = User(username='bench')
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.flush()
+    now = datetime.utcnow()
+    db.session.add_all(
+        StockItem(ticker=f"{1000 + i}.T", company_name=f"銘柄{i}", sector=('テクノロジー', '金融', '素材', None)[i % 4],
+                  rating=('買い', '中立', '売り')[i % 3], user_id=user.id, entry_price=1000.0,
+                  current_price=900.0 + i % 300, per=(None, 12.0 + i % 10)[i % 5 > 0], pbr=1.0 + i % 7 / 10,
+                  dividend_yield=i % 5 / 2, rating_date=now - timedelta(days=i % 900) if i % 3 == 0 else None)
+        for i in range(size)
+    )
+    db.session.commit()
+    price_history.update([f"{1000 + i}.T" for i in range(min(size, tickers))])
+    return user.id
+
+
+def python_baseline(user_id):
+    """従来の書き方: 全行をORMで読み込み、1行ずつ Python で集計する"""
+    stocks = db.session.query(StockItem).filter(StockItem.user_id == user_id).all()
+    by_sector = defaultdict(list)
+    by_rating = defaultdict(list)
+    for stock in stocks:
+        by_sector[stock.sector or '不明'].append(stock.performance)
+        by_rating[stock.rating].append(stock.performance)
+    return ({k: sum(v) / len(v) for k, v in by_sector.items()},
+            {k: statistics.median(v) for k, v in by_rating.items()},
+            {c: sorted(getattr(s, c) for s in stocks if getattr(s, c) is not None) for c in analytics.VALUATION_COLUMNS})
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--tickers', type=int, default=300, help='日足を用意する銘柄数 (残りは日足なし)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    market_data.yf = FakeYFinance(latency=0)
+
+    print(f"{'銘柄数':>6} {'Python 1行ずつ(ms)':>18} {'pandas/NumPy(ms)':>17} {'キャッシュ(ms)':>14}")
+    for size in args.sizes:
+        with app.app_context():
+            user_id = seed(size, args.tickers)
+            db.session.expire_all()
+            baseline = timed(lambda: python_baseline(user_id), args.repeat)
+            vectorized = timed(lambda: analytics.compute(analytics.load_frame(user_id)), args.repeat)
+            analytics.invalidate()
+            analytics.get(user_id)
+            cached = timed(lambda: analytics.get(user_id), args.repeat)
+        print(f"{size:>6} {baseline:>18.1f} {vectorized:>17.1f} {cached:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
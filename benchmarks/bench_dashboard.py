@@ -0,0 +1,83 @@
+"""ダッシュボードのレスポンスサイズ・応答時間・SQLの発行回数を銘柄数ごとに計測する
+
+    python benchmarks/bench_dashboard.py --sizes 50 200 1000 --analysis-chars 4000
+    python benchmarks/bench_dashboard.py --sizes 10000 --sort-by performance --order desc --pages 3
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_dashboard.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+from sqlalchemy import event  # noqa: E402
+from app import app, db, User, StockItem  # noqa: E402
+
+
+def seed(size, analysis_chars):
+    db.drop_all()
+    db.create_all()
+    user = User(username='bench')
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.flush()
+    analysis = ('### 1. 外部環境分析\n- ベンチマーク用の分析です。\n' * 100)[:analysis_chars]
+    db.session.add_all(
+        StockItem(ticker=f"{1000 + i}.T", company_name=f"銘柄{i}", company_name_en=f"Stock {i}",
+                  sector=('テクノロジー', '金融', '素材')[i % 3], rating=('買い', '中立', '売り')[i % 3], user_id=user.id,
+                  entry_price=1000.0, current_price=1000.0 + i % 200, per=15.0, pbr=1.2, dividend_yield=2.0,
+                  memo='ベンチマーク用のメモ' * 10, analysis_text=analysis)
+        for i in range(size)
+    )
+    db.session.commit()
+    # 従来はこの分が data-analysis / data-memo 属性として全行にインライン展開されていた
+    return size * (len(analysis.encode()) + len(('ベンチマーク用のメモ' * 10).encode()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--analysis-chars', type=int, default=4000, help='1銘柄あたりの分析テキストの文字数')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sort-by', default='company_name')
+    parser.add_argument('--order', default='asc', choices=['asc', 'desc'])
+    parser.add_argument('--pages', type=int, default=1, help='「次へ」をたどって計測するページ数')
+    args = parser.parse_args()
+
+    queries = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *_: queries.append(1))
+
+    client = app.test_client()
+    print(f"{'銘柄数':>6} {'ページ':>6} {'行数':>6} {'サイズ(KB)':>11} {'中央値(ms)':>11} {'SQL数':>6} "
+          f"{'インライン展開しなくなった分(KB)':>30}")
+    for size in args.sizes:
+        with app.app_context():
+            inlined = seed(size, args.analysis_chars)
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        params = {'sort_by': args.sort_by, 'order': args.order}
+        for page in range(1, args.pages + 1):
+            timings = []
+            for _ in range(args.repeat):
+                queries.clear()
+                start = time.perf_counter()
+                response = client.get('/dashboard', query_string=params)
+                timings.append((time.perf_counter() - start) * 1000)
+            body = response.get_data()
+            rows = body.count(b'data-stock-id=')
+            print(f"{size:>6} {page:>6} {rows:>6} {len(body) / 1024:>11.1f} {statistics.median(timings):>11.1f} "
+                  f"{len(queries):>6} {inlined / 1024:>30.1f}")
+            cursor = re.search(rb'after=([^"&]+)', body)
+            if cursor is None:
+                break
+            params['after'] = unquote(cursor.group(1).decode())
+
+
+if __name__ == '__main__':
+    main()
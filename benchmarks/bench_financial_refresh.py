@@ -0,0 +1,75 @@
+"""update_financial_data の所要時間をウォッチリストの銘柄数ごとに計測する
+
+Yahoo には接続せず、benchmarks/fakes.py のスタブを使う。
+
+    python benchmarks/bench_financial_refresh.py --latency 0.2 --sizes 10 30 60 120
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import market_data  # noqa: E402
+from app import app, db, User, StockItem, refresh_financial_data  # noqa: E402
+from benchmarks.fakes import FakeYFinance  # noqa: E402
+from quote_cache import MemoryBackend  # noqa: E402
+
+
+def seed_watchlist(size):
+    db.drop_all()
+    db.create_all()
+    user = User(username='bench')
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.flush()
+    db.session.add_all(
+        StockItem(ticker=f"{1000 + i}.T", rating='中立', user_id=user.id, entry_price=1000.0)
+        for i in range(size)
+    )
+    db.session.commit()
+    return user.id
+
+
+def serial_refresh(user_id):
+    """従来の実装: 1銘柄ずつ取得してORMオブジェクトをコミットする"""
+    for stock in db.session.scalars(db.select(StockItem).where(StockItem.user_id == user_id)):
+        try:
+            stock.current_price = market_data.fetch_info(stock.ticker).get('currentPrice')
+        except Exception:
+            pass
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.2, help='スタブの1銘柄あたりの応答時間(秒)')
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 30, 60, 120])
+    parser.add_argument('--skip-serial', action='store_true', help='従来実装の計測を省略する')
+    args = parser.parse_args()
+
+    market_data.yf = FakeYFinance(latency=args.latency, failure_rate=args.failure_rate)
+    market_data.RETRY_BACKOFF = 0.0
+    print(f"{'銘柄数':>6} {'従来(秒)':>10} {'並行+一括(秒)':>14} {'成功':>6} {'失敗':>6}")
+    with app.app_context():
+        for size in args.sizes:
+            user_id = seed_watchlist(size)
+            serial = float('nan')
+            if not args.skip_serial:
+                start = time.perf_counter()
+                serial_refresh(user_id)
+                serial = time.perf_counter() - start
+            # 前のサイズの結果がキャッシュに残らないようにする
+            market_data.quote_cache.backend = MemoryBackend()
+            start = time.perf_counter()
+            success_count, failures = refresh_financial_data(user_id)
+            elapsed = time.perf_counter() - start
+            print(f"{size:>6} {serial:>10.2f} {elapsed:>14.2f} {success_count:>6} {len(failures):>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""gemini_client の同時実行による所要時間の違いをフェイクモデルで計測する
+
+逐次・並行の列は回数制限 (rate_limit.gemini) を外して計測する。最後の列は同じ並行実行を回数制限ありで行い、
+制限による待ち時間を含めた所要時間と、制限で断られた件数を示す。
+
+    python benchmarks/bench_gemini_client.py --latency 0.5 --prompts 1 8 32
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import gemini_client  # noqa: E402
+import rate_limit  # noqa: E402
+
+
+def run_concurrent(prompts, limited):
+    """(所要時間, 失敗した件数, 回数制限で断られた件数)"""
+    enabled = rate_limit.gemini.enabled
+    rate_limit.gemini.enabled = limited
+    # 前の計測で使ったトークンを持ち越さない
+    rate_limit.gemini.backend = rate_limit.MemoryBackend()
+    try:
+        start = time.perf_counter()
+        results = gemini_client.generate_many(prompts)
+        elapsed = time.perf_counter() - start
+    finally:
+        rate_limit.gemini.enabled = enabled
+    limited_count = sum(isinstance(r, rate_limit.RateLimited) for r in results)
+    return elapsed, sum(isinstance(r, Exception) for r in results) - limited_count, limited_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.5, help='フェイクモデルの応答時間(秒)')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--prompts', type=int, nargs='+', default=[1, 8, 32])
+    args = parser.parse_args()
+
+    gemini_client.BACKOFF = 0.05
+    gemini_client.set_backend(
+        lambda name: gemini_client.FakeModel(name, latency=args.latency, failure_rate=args.failure_rate, seed=0))
+    print(f"同時実行数の上限: {gemini_client.MAX_CONCURRENCY} / 回数制限: {rate_limit.GEMINI_RATE}回/秒 "
+          f"(バースト {rate_limit.GEMINI_BURST})")
+    print(f"{'件数':>6} {'逐次(秒)':>10} {'並行(秒)':>10} {'失敗':>6} {'並行+回数制限(秒)':>18} {'制限で断った数':>14}")
+    for count in args.prompts:
+        prompts = [f"ベンチマーク {i}" for i in range(count)]
+        start = time.perf_counter()
+        for prompt in prompts:
+            try:
+                gemini_client.generate(prompt)
+            except Exception:
+                pass
+        serial = time.perf_counter() - start
+        concurrent, failures, _ = run_concurrent(prompts, limited=False)
+        limited, _, rejected = run_concurrent(prompts, limited=True)
+        print(f"{count:>6} {serial:>10.2f} {concurrent:>10.2f} {failures:>6} {limited:>18.2f} {rejected:>14}")
+
+
+if __name__ == '__main__':
+    main()
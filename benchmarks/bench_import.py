@@ -0,0 +1,99 @@
+"""銘柄の一括登録 (/import_stocks) のスループットを、1銘柄ずつ画面から追加する場合と比べる
+
+yfinance と Gemini はフェイクに差し替えるので、応答待ちの時間は --yf-latency / --gemini-latency で指定する。
+ファイルには登録済みの銘柄とファイル内の重複も混ぜておく。
+
+    python benchmarks/bench_import.py --sizes 50 200 500 --yf-latency 0.2 --gemini-latency 0.3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_import.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from sqlalchemy import event  # noqa: E402
+import gemini_client  # noqa: E402
+import market_data  # noqa: E402
+import watchlist_io  # noqa: E402
+from app import app, db, User, StockItem, watchlist_importer  # noqa: E402
+from models import AnalysisJobItem  # noqa: E402
+from benchmarks.fakes import FakeYFinance  # noqa: E402
+
+
+def seed(existing):
+    db.drop_all()
+    db.create_all()
+    user = User(username='bench')
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.flush()
+    db.session.add_all(
+        StockItem(ticker=f"{1000 + i}.T", company_name=f"銘柄{i}", rating='中立', user_id=user.id, entry_price=1000.0)
+        for i in range(existing)
+    )
+    db.session.commit()
+
+
+def import_file(size, existing):
+    """登録済みの銘柄を existing 件、ファイル内の重複を1割含む CSV"""
+    lines = ['ticker,rating,memo']
+    lines += [f"{1000 + i},{('買い', '中立', '売り')[i % 3]},一括登録 {i}" for i in range(size)]
+    lines += [f"{1000 + existing + i}.T,中立," for i in range(size // 10)]
+    return '\n'.join(lines).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--existing', type=int, default=20, help='登録済みの銘柄数')
+    parser.add_argument('--yf-latency', type=float, default=0.2)
+    parser.add_argument('--gemini-latency', type=float, default=0.3)
+    parser.add_argument('--serial-limit', type=int, default=20, help='1銘柄ずつの追加を計測する件数 (時間がかかるため)')
+    args = parser.parse_args()
+
+    market_data.yf = FakeYFinance(latency=args.yf_latency)
+    market_data.quote_cache.price_ttl = market_data.quote_cache.fundamentals_ttl = 0
+    gemini_client.set_backend(lambda name: gemini_client.FakeModel(name, latency=args.gemini_latency))
+
+    queries = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *_: queries.append(1))
+
+    client = app.test_client()
+    print(f"{'件数':>6} {'方式':<8} {'登録':>6} {'所要(秒)':>9} {'件/秒':>8} {'SQL数':>6} {'分析ジョブ':>10}")
+    for size in args.sizes:
+        with app.app_context():
+            seed(args.existing)
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+        # 従来の方法: 画面のフォームから1銘柄ずつ追加する (yfinance と社名の問い合わせが直列になる)
+        serial = min(size, args.serial_limit)
+        queries.clear()
+        start = time.perf_counter()
+        for i in range(args.existing, args.existing + serial):
+            client.post('/dashboard', data={'ticker': f"{1000 + i}.T", 'rating': '中立', 'memo': ''})
+        elapsed = time.perf_counter() - start
+        print(f"{size:>6} {'1件ずつ':<8} {serial:>6} {elapsed:>9.2f} {serial / elapsed:>8.1f} {len(queries):>6} {'-':>10}")
+
+        # 一括登録: 重複の確認は1回、株価と社名はバッチごとに並行して取得し、まとめてINSERTする
+        # (初期分析はジョブとして登録されるだけで、ここではワーカーを動かさない)
+        with app.app_context():
+            seed(args.existing)
+            user_id = db.session.scalar(db.select(User.id))
+            queries.clear()
+            start = time.perf_counter()
+            records = watchlist_io.parse(import_file(size, args.existing), 'csv')
+            done = list(watchlist_importer.run(user_id, records))[-1]
+            elapsed = time.perf_counter() - start
+            queued = db.session.scalar(db.select(db.func.count()).select_from(AnalysisJobItem))
+        print(f"{size:>6} {'一括':<8} {done['added']:>6} {elapsed:>9.2f} {done['added'] / elapsed:>8.1f} "
+              f"{len(queries):>6} {queued:>10}")
+
+
+if __name__ == '__main__':
+    main()
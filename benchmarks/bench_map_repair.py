@@ -0,0 +1,102 @@
+"""壊れたマップの応答を、マップ全体の作り直しで対処する場合と、壊れた分野だけ作り直す場合で比べる
+
+Gemini はフェイクに差し替え、--corrupt-rate の割合で途中で切れた応答か、1分野のティッカーが壊れた応答を返す。
+従来の方法は、JSON として読めなければマップ全体を生成し直す (ユーザーがもう一度ボタンを押すのと同じ)。
+ティッカーは確かめないので、壊れたティッカーはそのまま画面に届く。
+
+    python benchmarks/bench_map_repair.py --maps 40 --corrupt-rate 0.3 --latency 0.5
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_map_repair.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import gemini_client  # noqa: E402
+import theme_graph  # noqa: E402
+from app import app, db, User, keyword_map_prompt  # noqa: E402
+
+
+def legacy_extract_json(text):
+    """以前の extract_json (最初の { から最後の } までを取り出す)"""
+    text = re.sub(r'```json\s*(.*?)\s*```', r'\1', text, flags=re.DOTALL)
+    match = re.search(r'\{.*\}', text, re.DOTALL)
+    return match.group(0) if match else text
+
+
+def legacy_map(prompt, max_attempts):
+    """JSON として読めるまでマップ全体を生成し直す。読めなければ None"""
+    for _ in range(max_attempts):
+        response = gemini_client.generate(prompt, generation_config={"temperature": 0.7})
+        try:
+            return json.loads(legacy_extract_json(response.text))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def invalid_tickers(tree):
+    return sum(1 for category in tree.get('children', []) for company in category.get('children', [])
+               if not theme_graph.TICKER_PATTERN.match(theme_graph.normalize_ticker(company.get('ticker'))))
+
+
+def report(label, timings, models, ok, invalid, maps):
+    calls = sum(model.calls for model in models)
+    timings.sort()
+    print(f"{label:<14} {ok:>4}/{maps:<4} {calls / maps:>9.2f} {statistics.median(timings):>9.2f} "
+          f"{timings[int(len(timings) * 0.95)]:>9.2f} {invalid:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--maps', type=int, default=40)
+    parser.add_argument('--corrupt-rate', type=float, default=0.3)
+    parser.add_argument('--latency', type=float, default=0.5, help='Gemini の1回の応答時間(秒)')
+    parser.add_argument('--max-attempts', type=int, default=3, help='従来の方法でマップ全体を生成し直す上限')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+
+    print(f"{'方式':<14} {'成功':>9} {'呼び出し/件':>9} {'p50(秒)':>9} {'p95(秒)':>9} {'不正ティッカー':>10}")
+    for label in ('全体を作り直す', '壊れた分野だけ'):
+        models = []
+
+        def factory(name):
+            model = gemini_client.FakeModel(name, latency=args.latency, corrupt_rate=args.corrupt_rate, seed=1)
+            models.append(model)
+            return model
+
+        gemini_client.set_backend(factory)
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        timings, ok, invalid = [], 0, 0
+        for i in range(args.maps):
+            start = time.perf_counter()
+            if label == '全体を作り直す':
+                tree = legacy_map(keyword_map_prompt(f"テーマ{i}"), args.max_attempts)
+            else:
+                response = client.post('/generate_map', data={'keyword': f"テーマ{i}", 'refresh': '1'})
+                tree = response.get_json() if response.status_code == 200 else None
+            timings.append(time.perf_counter() - start)
+            if tree is not None:
+                ok += 1
+                invalid += invalid_tickers(tree)
+        report(label, timings, models, ok, invalid, args.maps)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""ダッシュボードの株価の更新を、ボタンでの更新 (従来) と /prices/stream の配信で比べる
+
+--clients 個のクライアントが --users 人のユーザーとしてダッシュボードを開いている状況を再現する
+(同じユーザーが複数のタブで開く場合を含む)。ユーザーの銘柄は --universe 銘柄の中から重なり合うように選ぶ。
+yfinance はフェイクに差し替え、取得のたびに株価が変わる。株価キャッシュは使わない (QUOTE_PRICE_TTL=0) ので、
+外部への問い合わせ回数はそのまま取得の回数になる。
+
+- ボタンで更新: 各クライアントが --interval 秒ごとに /update_financial_data を呼び、ダッシュボード全体を受け取る
+- 配信: 各クライアントが /prices/stream を開き、live_prices が --interval 秒ごとにまとめて取得する
+
+    python benchmarks/bench_price_feed.py --clients 50 --users 10 --stocks 30 --universe 100 --duration 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_price_feed.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['QUOTE_PRICE_TTL'] = '0'
+os.environ['PRICE_FEED_KEEPALIVE'] = '0.5'
+
+import market_data  # noqa: E402
+from app import app, db, User, StockItem, live_prices  # noqa: E402
+from benchmarks.fakes import FakeYFinance  # noqa: E402
+
+
+def seed(users, stocks, universe):
+    db.drop_all()
+    db.create_all()
+    step = max(1, universe // users)
+    for n in range(users):
+        user = User(username=f'feed{n}')
+        user.set_password('feed')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all(
+            StockItem(ticker=f"{1000 + (n * step + i) % universe}.T", company_name=f"銘柄{i}", rating='買い',
+                      user_id=user.id, entry_price=1000.0, current_price=1000.0, per=15.0, pbr=1.2,
+                      dividend_yield=2.0, analysis_text='### 1. 外部環境分析\n- ベンチマーク用の分析です。')
+            for i in range(min(stocks, universe))
+        )
+    db.session.commit()
+
+
+def login(n):
+    client = app.test_client()
+    client.post('/login', data={'username': f'feed{n}', 'password': 'feed'})
+    return client
+
+
+def run_clients(args, target):
+    """ログインしたクライアントごとのスレッドで target(client, 終了時刻, 結果) を動かす。(結果のリスト, CPU秒) を返す"""
+    clients = [login(i % args.users) for i in range(args.clients)]
+    results = [{'updates': 0, 'bytes': 0, 'lags': []} for _ in clients]
+    cpu = time.process_time()
+    stop = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=target, args=(client, stop, result)) for client, result in zip(clients, results)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.process_time() - cpu
+
+
+def button(args):
+    def target(client, stop, result):
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            response = client.get('/update_financial_data', follow_redirects=True)
+            result['bytes'] += len(response.data)
+            result['updates'] += 1
+            result['lags'].append(time.perf_counter() - started)
+            time.sleep(max(0.0, args.interval - (time.perf_counter() - started)))
+    return run_clients(args, target)
+
+
+def stream(args):
+    live_prices.interval = args.interval
+    live_prices.max_streams = args.clients
+    # 夜間でも計測できるよう、東証の立会時間に関係なく取得する
+    live_prices.market_hours = False
+    published = {'at': time.perf_counter()}
+    poll_once = live_prices.poll_once
+
+    def timed_poll(now=None):
+        result = poll_once(now)
+        published['at'] = time.perf_counter()
+        return result
+    live_prices.poll_once = timed_poll
+
+    def target(client, stop, result):
+        response = client.get('/prices/stream', buffered=False)
+        try:
+            for chunk in response.response:
+                text = chunk.decode() if isinstance(chunk, bytes) else chunk
+                result['bytes'] += len(text.encode())
+                if text.startswith('event: prices'):
+                    result['updates'] += 1
+                    # 取得を終えてから届くまでの時間
+                    result['lags'].append(time.perf_counter() - published['at'])
+                if time.perf_counter() >= stop:
+                    break
+        finally:
+            response.close()
+    try:
+        return run_clients(args, target)
+    finally:
+        live_prices.stop()
+        live_prices.poll_once = poll_once
+
+
+def report(label, results, fake, cpu, args):
+    updates = sum(r['updates'] for r in results)
+    lags = sorted(lag for r in results for lag in r['lags'])
+    p95 = lags[int(len(lags) * 0.95)] if lags else 0
+    print(f"{label:<10} {updates / len(results):>10.1f} {fake.calls:>8} {fake.calls / args.duration:>8.1f} "
+          f"{sum(r['bytes'] for r in results) / max(1, updates):>10.0f} {statistics.median(lags or [0]) * 1000:>9.1f} "
+          f"{p95 * 1000:>9.1f} {cpu:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50, help='ダッシュボードを開いているクライアント数')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--stocks', type=int, default=30, help='1ユーザーあたりの銘柄数')
+    parser.add_argument('--universe', type=int, default=100, help='全ユーザーの銘柄の種類')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=2, help='更新の間隔(秒)')
+    parser.add_argument('--yf-latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.users, args.stocks, args.universe)
+    print(f"クライアント: {args.clients} / ユーザー: {args.users} / 銘柄: {args.stocks}件 (全{args.universe}種類) / "
+          f"間隔: {args.interval}秒 / {args.duration}秒間")
+    print(f"{'方式':<10} {'更新/クライアント':>10} {'外部呼出':>8} {'呼出/秒':>8} {'バイト/更新':>10} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'CPU秒':>7}")
+    for label, run in (('ボタンで更新', button), ('配信', stream)):
+        market_data.yf = fake = FakeYFinance(latency=args.yf_latency)
+        results, cpu = run(args)
+        report(label, results, fake, cpu, args)
+    print("p50/p95: ボタンは更新のリクエストの応答時間、配信は取得を終えてからクライアントに届くまでの時間")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""外部APIの回数制限 (rate_limit.Limiter) の動作をフェイクの時計で確かめる
+
+1. 基本動作: バースト・一定間隔での予約・待ち時間の上限・ユーザーごとの順番待ちの上限と Retry-After
+2. 公平性: 1人が大量に呼び出している間の他のユーザーの待ち時間を、全体の上限だけの場合と比べる
+3. ワーカー間の共有: SQLite のバックエンドを複数プロセスから使い、全体で上限を超えないことを確かめる
+
+1 と 2 は実際には待たずに時計を進めるので一瞬で終わる。確認に失敗すると AssertionError で終了する。
+
+    python benchmarks/bench_rate_limit.py --seconds 120 --heavy-rate 20 --light-users 5
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_limit  # noqa: E402
+from benchmarks.fakes import FakeClock  # noqa: E402
+
+
+def check_basics():
+    clock = FakeClock(1000.0)
+    limiter = rate_limit.Limiter('test', rate=10, burst=5, user_rate=2, user_burst=3, max_wait=2,
+                                 user_max_queued=3, clock=clock)
+    # 全体のバースト分はすぐに呼べ、その後は 1/rate 秒ずつずれた時刻を予約する
+    waits = [limiter.reserve() for _ in range(7)]
+    assert waits[:5] == [0.0] * 5, waits
+    assert abs(waits[5] - 0.1) < 1e-9 and abs(waits[6] - 0.2) < 1e-9, waits
+    # 予約が max_wait を超える分は断り、Retry-After は待ち時間が max_wait に収まるまでの秒数
+    for _ in range(18):
+        limiter.reserve()
+    try:
+        limiter.reserve()
+        raise AssertionError("max_wait を超えたのに断られなかった")
+    except rate_limit.RateLimited as e:
+        assert e.retry_after == 1, e.retry_after
+    # 断った呼び出しはトークンを消費しない
+    clock.advance(10)
+    # ユーザーごと: バースト3回はすぐ、その後は 0.5 秒ずつ。順番待ちが3件になると次は断る
+    waits = [limiter.reserve('a') for _ in range(6)]
+    assert waits[:3] == [0.0] * 3 and waits[3:] == [0.5, 1.0, 1.5], waits
+    try:
+        limiter.reserve('a')
+        raise AssertionError("順番待ちの上限を超えたのに断られなかった")
+    except rate_limit.RateLimited as e:
+        assert e.retry_after == 1, e.retry_after
+    # 他のユーザーは a の順番待ちの後ろには並ばない (全体のバケットの分だけ待つ)
+    assert limiter.reserve('b') < 0.5
+    # 時間が経てば順番待ちが消化され、また呼べる
+    clock.advance(2)
+    assert limiter.reserve('a') == 0.0
+    print("基本動作: OK")
+
+
+def simulate(limiter, clock, seconds, heavy_rate, light_users, light_rate, per_user):
+    """heavy が heavy_rate 回/秒、light の各ユーザーが light_rate 回/秒で呼び出した場合の待ち時間と断られた数"""
+    arrivals = [(i / heavy_rate, 'heavy') for i in range(int(seconds * heavy_rate))]
+    for u in range(light_users):
+        # 同じ時刻に揃わないよう、ユーザーごとに少しずらす
+        arrivals += [((i + u / light_users) / light_rate, f'light{u}') for i in range(int(seconds * light_rate))]
+    results = {'heavy': ([], 0), 'light': ([], 0)}
+    for at, user in sorted(arrivals):
+        clock.now = 1000.0 + at
+        kind = 'heavy' if user == 'heavy' else 'light'
+        waits, rejected = results[kind]
+        try:
+            waits.append(limiter.reserve(user if per_user else None))
+        except rate_limit.RateLimited:
+            results[kind] = (waits, rejected + 1)
+    return results
+
+
+def report(label, results, seconds):
+    for kind, (waits, rejected) in results.items():
+        waits = sorted(waits)
+        p95 = waits[int(len(waits) * 0.95)] if waits else 0
+        print(f"{label:<16} {kind:<6} {len(waits) / seconds:>8.2f} {rejected:>6} "
+              f"{statistics.median(waits or [0]):>8.2f} {p95:>8.2f}")
+
+
+def check_fairness(args):
+    print(f"\n{'方式':<16} {'ユーザー':<6} {'呼出/秒':>8} {'429':>6} {'待ちp50':>8} {'待ちp95':>8}")
+    outcomes = {}
+    for label, per_user in (('全体の上限のみ', False), ('ユーザーごとも', True)):
+        clock = FakeClock()
+        limiter = rate_limit.Limiter('sim', rate=args.rate, burst=args.rate * 2, user_rate=args.user_rate,
+                                     user_burst=args.user_rate * 5, max_wait=10, user_max_queued=8, clock=clock)
+        results = simulate(limiter, clock, args.seconds, args.heavy_rate, args.light_users, args.light_rate, per_user)
+        report(label, results, args.seconds)
+        outcomes[per_user] = results
+    light_waits, light_rejected = outcomes[True]['light']
+    assert light_rejected == 0, "ユーザーごとの上限があるのに、少ししか呼ばないユーザーが断られた"
+    assert max(light_waits) < 1.0, "ユーザーごとの上限があるのに、少ししか呼ばないユーザーが待たされた"
+    print("公平性: OK")
+
+
+def _worker(path, count, queue):
+    backend = rate_limit.SQLiteBackend(path)
+    limiter = rate_limit.Limiter('shared', rate=20, burst=10, user_rate=100, user_burst=100, max_wait=0,
+                                 backend=backend)
+    granted = 0
+    for _ in range(count):
+        try:
+            limiter.reserve()
+            granted += 1
+        except rate_limit.RateLimited:
+            pass
+    queue.put(granted)
+
+
+def check_shared(processes, count):
+    path = os.path.join(tempfile.mkdtemp(), 'rate_limit.db')
+    rate_limit.SQLiteBackend(path)
+    queue = multiprocessing.Queue()
+    start = time.time()
+    workers = [multiprocessing.Process(target=_worker, args=(path, count, queue)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    granted = sum(queue.get() for _ in workers)
+    allowed = 10 + 20 * elapsed
+    print(f"\nワーカー間の共有: {processes}プロセス × {count}回 → 許可 {granted}回 "
+          f"(上限 {allowed:.0f}回 / {elapsed:.2f}秒)")
+    assert granted <= allowed + 1, "プロセス全体で上限を超えて許可した"
+    print("ワーカー間の共有: OK")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=120)
+    parser.add_argument('--rate', type=float, default=10, help='全体の上限 (回/秒)')
+    parser.add_argument('--user-rate', type=float, default=2, help='ユーザーごとの上限 (回/秒)')
+    parser.add_argument('--heavy-rate', type=float, default=20, help='大量に呼び出すユーザーの呼び出し頻度 (回/秒)')
+    parser.add_argument('--light-users', type=int, default=5)
+    parser.add_argument('--light-rate', type=float, default=0.5)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--calls', type=int, default=200, help='ワーカー間の共有の確認で1プロセスが呼び出す回数')
+    args = parser.parse_args()
+    check_basics()
+    check_fairness(args)
+    check_shared(args.processes, args.calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""コールドスタートの時間 (app のインポート時間と、最初のレスポンスまでの時間) を計測する
+
+毎回新しい Python プロセスを起動して計測する。--server を付けると gunicorn を起動し、
+/login が 200 を返すまでの時間を計測する (Cloud Run のコールドスタートに近い)。
+
+    python benchmarks/bench_startup.py --repeat 5
+    python benchmarks/bench_startup.py --repeat 3 --server
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行し、インポート時間・最初のレスポンスまでの時間と、読み込まれた重いモジュールを出力する
+CHILD = """
+import sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+status = client.get('/login').status_code
+responded = time.perf_counter()
+heavy = [m for m in ('vertexai', 'yfinance', 'pandas', 'numpy') if m in sys.modules]
+print(imported - start, responded - start, status, ','.join(heavy) or '-')
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_startup.db')
+    env['LOG_LEVEL'] = 'WARNING'
+    env['PYTHONPATH'] = ROOT
+    return env
+
+
+def measure_in_process(repeat):
+    rows = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, env=child_env(),
+                                capture_output=True, text=True, check=True).stdout.split()
+        rows.append((float(output[0]), float(output[1]), int(output[2]), output[3]))
+    return rows
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure_server(repeat, timeout=60):
+    timings = []
+    for _ in range(repeat):
+        port = free_port()
+        start = time.perf_counter()
+        process = subprocess.Popen(['gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', '1', 'app:app'],
+                                   cwd=ROOT, env=child_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < timeout:
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1) as response:
+                        if response.status == 200:
+                            timings.append(time.perf_counter() - start)
+                            break
+                except OSError:
+                    time.sleep(0.02)
+        finally:
+            process.terminate()
+            process.wait()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--server', action='store_true', help='gunicorn を起動して最初のレスポンスまでを計測する')
+    args = parser.parse_args()
+
+    rows = measure_in_process(args.repeat)
+    print(f"{'':<24} {'中央値(秒)':>10} {'最小(秒)':>9} {'最大(秒)':>9}")
+    for label, values in (('import app', [r[0] for r in rows]), ('最初のレスポンス (/login)', [r[1] for r in rows])):
+        print(f"{label:<24} {statistics.median(values):>10.3f} {min(values):>9.3f} {max(values):>9.3f}")
+    print(f"/login のステータス: {rows[-1][2]} / 起動時に読み込まれた重いモジュール: {rows[-1][3]}")
+    if args.server:
+        timings = measure_server(args.repeat)
+        if timings:
+            print(f"{'gunicorn 起動 → /login':<24} {statistics.median(timings):>10.3f} {min(timings):>9.3f} {max(timings):>9.3f}")
+        else:
+            print("gunicorn が時間内に応答しませんでした。")
+
+
+if __name__ == '__main__':
+    main()
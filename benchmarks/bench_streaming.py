@@ -0,0 +1,63 @@
+"""ストリーミング版エンドポイントの最初の1バイトまでの時間(TTFB)を従来版と比べる
+
+Gemini の代わりに応答を少しずつ返すフェイクモデルを使う。
+
+    python benchmarks/bench_streaming.py --latency 3 --chunk-size 40
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import gemini_client  # noqa: E402
+import market_data  # noqa: E402
+from app import app, db  # noqa: E402
+from benchmarks.fakes import FakeYFinance  # noqa: E402
+
+
+def measure(client, url, data):
+    """(最初の断片までの秒数, 全体の秒数, 断片数) を返す"""
+    start = time.perf_counter()
+    response = client.post(url, data=data, buffered=False)
+    first = None
+    chunks = 0
+    for chunk in response.response:
+        if chunk and first is None:
+            first = time.perf_counter() - start
+        chunks += 1
+    response.close()
+    return first, time.perf_counter() - start, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=3.0, help='フェイクモデルが応答を返し終えるまでの秒数')
+    parser.add_argument('--chunk-size', type=int, default=40, help='1断片あたりの文字数')
+    args = parser.parse_args()
+
+    market_data.yf = FakeYFinance(latency=0)
+    gemini_client.set_backend(
+        lambda name: gemini_client.FakeModel(name, latency=args.latency, chunk_size=args.chunk_size))
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    client.post('/register', data={'username': 'bench', 'password': 'bench'})
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+    cases = [
+        ('分析', '/generate_analysis', '/generate_analysis/stream', {'ticker': '7203.T'}),
+        ('マップ', '/generate_map', '/generate_map/stream', {'keyword': '半導体', 'refresh': '1'}),
+    ]
+    print(f"{'':<8} {'TTFB(秒)':>10} {'全体(秒)':>10} {'断片数':>6}")
+    for label, url, stream_url, data in cases:
+        for name, target in (('従来', url), ('ストリーム', stream_url)):
+            first, total, chunks = measure(client, target, data)
+            print(f"{label + name:<8} {first:>10.2f} {total:>10.2f} {chunks:>6}")
+
+
+if __name__ == '__main__':
+    main()
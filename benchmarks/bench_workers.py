@@ -0,0 +1,144 @@
+"""gunicorn のワーカー数ごとに、ダッシュボード (GET /dashboard) のスループットを計測する
+
+gunicorn.conf.py の設定で gunicorn を起動し、ログインしたクライアントを --clients 個のスレッドで同時に動かす。
+yfinance と Gemini はフェイクに差し替える。DB は一時ファイルの SQLite を使い、
+--database-url を指定すると Postgres などで計測できる (本番に近いのはこちら)。
+ワーカー数を増やしたときの伸びは CPU のコア数が上限になる。
+
+    python benchmarks/bench_workers.py --workers 1 2 4 --stocks 200 --duration 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def fake_app():
+    """gunicorn から 'benchmarks.bench_workers:fake_app()' として読み込む。外部APIをフェイクにしたアプリを返す"""
+    import gemini_client
+    import market_data
+    from app import app
+    from benchmarks.fakes import FakeYFinance
+    market_data.yf = FakeYFinance(latency=0.05)
+    gemini_client.set_backend(lambda name: gemini_client.FakeModel(name, latency=0.5))
+    return app
+
+
+def seed(database_url, stocks):
+    os.environ['DATABASE_URL'] = database_url
+    from app import app, db, User, StockItem
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all(
+            StockItem(ticker=f"{1000 + i}.T", company_name=f"銘柄{i}", sector=('テクノロジー', '金融', '素材')[i % 3],
+                      rating=('買い', '中立', '売り')[i % 3], user_id=user.id, entry_price=1000.0,
+                      current_price=1000.0 + i % 200, per=15.0, pbr=1.2, dividend_yield=2.0, memo='ベンチマーク用のメモ')
+            for i in range(stocks)
+        )
+        db.session.commit()
+
+
+def wait_ready(url, timeout=60):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url + '/login', timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("gunicorn が時間内に応答しませんでした。")
+
+
+def login(url):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+    data = urllib.parse.urlencode({'username': 'bench', 'password': 'bench'}).encode()
+    opener.open(url + '/login', data=data, timeout=10).read()
+    return opener
+
+
+def hammer(url, clients, duration):
+    """duration 秒の間、clients 個のスレッドから /dashboard を取得し続け、応答時間(秒)と失敗数を返す"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    openers = [login(url) for _ in range(clients)]
+    stop = time.perf_counter() + duration
+
+    def run(opener):
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            try:
+                with opener.open(url + '/dashboard', timeout=30) as response:
+                    response.read()
+                ok = response.status == 200
+            except (OSError, urllib.error.HTTPError):
+                ok = False
+            with lock:
+                (latencies if ok else errors).append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=run, args=(opener,)) for opener in openers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=4, help='ワーカーごとのスレッド数 (GUNICORN_THREADS)')
+    parser.add_argument('--clients', type=int, default=16, help='同時に接続するクライアント数')
+    parser.add_argument('--stocks', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    database_url = args.database_url or 'sqlite:///' + os.path.join(workdir, 'bench_workers.db')
+    seed(database_url, args.stocks)
+
+    url = f'http://127.0.0.1:{args.port}'
+    env = dict(os.environ, DATABASE_URL=database_url, PORT=str(args.port), PYTHONPATH=ROOT, LOG_LEVEL='WARNING',
+               GUNICORN_THREADS=str(args.threads), QUOTE_CACHE_BACKEND='sqlite',
+               QUOTE_CACHE_PATH=os.path.join(workdir, 'quote_cache.db'),
+               RATE_LIMIT_ENABLED=os.environ.get('RATE_LIMIT_ENABLED', '0'))
+    print(f"CPU: {os.cpu_count()} / 銘柄数: {args.stocks} / 同時接続: {args.clients} / スレッド: {args.threads}")
+    print(f"{'ワーカー':>8} {'件/秒':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'失敗':>6}")
+    for workers in args.workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+        process = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{args.port}',
+                                    'benchmarks.bench_workers:fake_app()'],
+                                   cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(url)
+            hammer(url, args.clients, 1)  # ウォームアップ
+            latencies, errors = hammer(url, args.clients, args.duration)
+        finally:
+            process.terminate()
+            process.wait()
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0
+        print(f"{workers:>8} {len(latencies) / args.duration:>8.1f} {statistics.median(latencies or [0]) * 1000:>9.1f} "
+              f"{p95 * 1000:>9.1f} {errors:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""ベンチマーク用に yfinance の代わりに使うローカルのスタブ"""
+import random
+import time
+from datetime import date
+import numpy as np
+import pandas as pd
+
+
+class FakeTicker:
+    def __init__(self, symbol, backend):
+        self.ticker = symbol
+        self._backend = backend
+
+    def _request(self):
+        backend = self._backend
+        backend.calls += 1
+        time.sleep(backend.latency)
+        if backend.failure_rate and backend.random.random() < backend.failure_rate:
+            raise ConnectionError(f"stub failure for {self.ticker}")
+
+    @property
+    def fast_info(self):
+        self._request()
+        return {'lastPrice': 1000 + sum(ord(c) for c in self.ticker) % 500 + self._backend.random.random()}
+
+    @property
+    def info(self):
+        backend = self._backend
+        self._request()
+        seed = sum(ord(c) for c in self.ticker)
+        return {
+            'longName': f"Stub Corp {self.ticker}",
+            'sector': 'Technology',
+            'currentPrice': 1000 + seed % 500 + backend.random.random(),
+            'forwardPE': 10 + seed % 20,
+            'priceToBook': 1 + seed % 5 / 10,
+            'dividendYield': seed % 4 / 2,
+        }
+
+    def history(self, start=None, end=None, interval='1d', auto_adjust=False):
+        """start から今日までの営業日の日足を、ティッカーごとに決まった乱数で作る"""
+        self._request()
+        seed = sum(ord(c) for c in self.ticker)
+        days = pd.bdate_range(start or date.today(), date.today(), tz='Asia/Tokyo')
+        ordinals = np.array([d.toordinal() for d in days])
+        close = 1000 + seed % 500 + 50 * np.sin(ordinals / 20 + seed)
+        return pd.DataFrame({
+            'Open': close * 0.99, 'High': close * 1.01, 'Low': close * 0.98, 'Close': close,
+            'Volume': (ordinals % 1000 + 1000) * 100,
+        }, index=days)
+
+
+
+class FakeYFinance:
+    """yf モジュールの代わりに market_data.yf へ差し込む"""
+
+    def __init__(self, latency=0.2, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def Ticker(self, symbol):
+        return FakeTicker(symbol, self)
+
+
+class FakeClock:
+    """rate_limit.Limiter の clock に渡すフェイクの時計。時刻は advance / set で進める"""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def sleep(self, seconds):
+        # 待つ代わりに時計を進める (1スレッドで使う場合)
+        self.now += seconds
@@ -0,0 +1,226 @@
+"""yfinance と Gemini をフェイクに差し替えて、主要な画面・処理に負荷をかける
+
+SQLite ファイルを使ってアプリを起動し、複数ユーザーが同時にアクセスする状況を再現する。
+シナリオごとにスループットと p50/p95/p99 の応答時間を表示する。API の利用枠は消費しない。
+
+    python benchmarks/load_test.py --stocks 200 --users 8 --concurrency 8 --requests 80
+    python benchmarks/load_test.py --scenarios dashboard prism --gemini-latency 0.5 --gemini-failure-rate 0.1
+
+CI では --quick で件数を減らし、--budget で p95 の上限(ミリ秒)を指定する。上限を超えると終了コード 1 を返す。
+
+    python benchmarks/load_test.py --quick --budget dashboard=300 login=1000 --json load_test.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load_test.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import gemini_client  # noqa: E402
+import jobs  # noqa: E402
+import market_data  # noqa: E402
+from app import app, db, User, StockItem, analysis_worker  # noqa: E402
+from benchmarks.fakes import FakeYFinance  # noqa: E402
+
+SCENARIOS = ('login', 'dashboard', 'refresh', 'analysis', 'prism')
+KEYWORDS = ('半導体', '電気自動車', '再生可能エネルギー', 'インバウンド', '生成AI', '防衛', '宇宙', '農業')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def seed(users, stocks):
+    db.drop_all()
+    db.create_all()
+    usernames = []
+    for n in range(users):
+        user = User(username=f'load{n}')
+        user.set_password('load')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all(
+            StockItem(ticker=f"{1000 + i}.T", company_name=f"銘柄{i}", company_name_en=f"Stock {i}",
+                      sector=('テクノロジー', '金融', '素材', '小売')[i % 4], rating=('買い', '中立', '売り')[i % 3],
+                      user_id=user.id, entry_price=1000.0, current_price=1000.0 + i % 200, per=15.0, pbr=1.2,
+                      dividend_yield=2.0, analysis_text='### 1. 外部環境分析\n- 負荷試験用の分析です。')
+            for i in range(stocks)
+        )
+        usernames.append(user.username)
+    db.session.commit()
+    return usernames
+
+
+class Client:
+    """ユーザーごとにログイン済みのテストクライアントを持つ"""
+
+    def __init__(self, username):
+        self.username = username
+        self.http = app.test_client()
+
+    def login(self):
+        response = self.http.post('/login', data={'username': self.username, 'password': 'load'})
+        return response.status_code == 302 and '/dashboard' in response.headers.get('Location', '')
+
+
+def step_login(client, i):
+    client.http.get('/logout')
+    return client.login()
+
+
+def step_dashboard(client, i):
+    return client.http.get('/dashboard').status_code == 200
+
+
+def step_refresh(client, i):
+    return client.http.get('/update_financial_data').status_code == 302
+
+
+def step_analysis(client, i):
+    """AI分析の一括更新を依頼し、ジョブが終わるまで待つ"""
+    response = client.http.get('/update_analysis_data')
+    if response.status_code != 302:
+        return False
+    with app.app_context():
+        user_id = db.session.scalar(db.select(User.id).where(User.username == client.username))
+        job = jobs.get_active_job(user_id)
+        job_id = job.id if job else None
+    while job_id is not None:
+        status = client.http.get(f'/jobs/{job_id}').get_json()
+        if status['status'] == 'done':
+            return status['failed_count'] == 0
+        time.sleep(0.05)
+    return True
+
+
+def step_prism(client, i):
+    # 同じキーワードが繰り返し使われるので、2回目以降はキャッシュから返る
+    response = client.http.post('/generate_map', data={'keyword': KEYWORDS[i % len(KEYWORDS)]})
+    return response.status_code == 200
+
+
+STEPS = {'login': step_login, 'dashboard': step_dashboard, 'refresh': step_refresh,
+         'analysis': step_analysis, 'prism': step_prism}
+
+
+def run_scenario(name, clients, requests, concurrency):
+    step = STEPS[name]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    # 1つのクライアント(ユーザー)を同時に複数のスレッドで使わないよう、スレッドごとに割り当てる
+    pools = [clients[n::concurrency] for n in range(concurrency)]
+
+    def worker(n):
+        nonlocal errors
+        own = pools[n] or [clients[n % len(clients)]]
+        for i in range(n, requests, concurrency):
+            client = own[(i // concurrency) % len(own)]
+            start = time.perf_counter()
+            try:
+                ok = step(client, i)
+            except Exception:
+                ok = False
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                errors += 0 if ok else 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scenario': name,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / wall if wall else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def parse_budgets(values):
+    budgets = {}
+    for value in values or []:
+        name, _, limit = value.partition('=')
+        if name not in SCENARIOS or not limit:
+            raise SystemExit(f"--budget は scenario=ミリ秒 の形式で指定してください: {value}")
+        budgets[name] = float(limit)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--stocks', type=int, default=200, help='1ユーザーあたりの銘柄数')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=80, help='シナリオごとのリクエスト数')
+    parser.add_argument('--yf-latency', type=float, default=0.05)
+    parser.add_argument('--yf-failure-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-latency', type=float, default=0.2)
+    parser.add_argument('--gemini-failure-rate', type=float, default=0.0)
+    parser.add_argument('--analysis-jobs', type=int, help='analysis シナリオのジョブ数 (省略時はユーザー数)')
+    parser.add_argument('--analysis-workers', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='CI向けに件数を減らす')
+    parser.add_argument('--budget', nargs='+', metavar='SCENARIO=MS', help='p95 の上限(ミリ秒)')
+    parser.add_argument('--json', help='結果をJSONで書き出すファイル')
+    args = parser.parse_args()
+    if args.quick:
+        args.users, args.stocks, args.requests = min(args.users, 4), min(args.stocks, 50), min(args.requests, 20)
+        args.concurrency = min(args.concurrency, 4)
+    budgets = parse_budgets(args.budget)
+
+    market_data.yf = FakeYFinance(latency=args.yf_latency, failure_rate=args.yf_failure_rate, seed=args.seed)
+    market_data.RETRY_BACKOFF = 0.0
+    # 毎回 yfinance (のフェイク) まで取りに行くようにして、キャッシュの効き具合に結果が左右されないようにする
+    market_data.quote_cache.price_ttl = market_data.quote_cache.fundamentals_ttl = 0
+    gemini_client.set_backend(lambda name: gemini_client.FakeModel(
+        name, latency=args.gemini_latency, failure_rate=args.gemini_failure_rate, seed=args.seed))
+    gemini_client.BACKOFF = 0.05
+    analysis_worker.max_workers = args.analysis_workers
+    analysis_worker.poll_interval = 0.1
+
+    with app.app_context():
+        usernames = seed(args.users, args.stocks)
+    clients = [Client(username) for username in usernames]
+    for client in clients:
+        client.login()
+
+    results = []
+    print(f"{'シナリオ':<10} {'件数':>6} {'失敗':>6} {'req/s':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9}")
+    for name in args.scenarios:
+        # 分析ジョブは1件でユーザーの全銘柄を処理するので、件数を別に指定する
+        requests = (args.analysis_jobs or len(clients)) if name == 'analysis' else args.requests
+        result = run_scenario(name, clients, requests, args.concurrency)
+        results.append(result)
+        print(f"{name:<10} {result['requests']:>6} {result['errors']:>6} {result['throughput']:>8.1f} "
+              f"{result['p50']:>9.1f} {result['p95']:>9.1f} {result['p99']:>9.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+    over = [r for r in results if r['scenario'] in budgets and r['p95'] > budgets[r['scenario']]]
+    for result in over:
+        print(f"p95 が上限を超えました: {result['scenario']} {result['p95']:.1f}ms > {budgets[result['scenario']]:.1f}ms")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
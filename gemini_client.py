@@ -0,0 +1,383 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import metrics
+import rate_limit
+import tree_parser
+
+MODEL_NAME = "gemini-1.5-flash"
+# 1回の呼び出しのタイムアウト(秒)、リトライ回数、プロセス全体での同時呼び出し数
+TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', 90))
+RETRIES = int(os.environ.get('GEMINI_RETRIES', 2))
+BACKOFF = 1.0
+MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', 8))
+
+logger = logging.getLogger(__name__)
+_retryable_errors = None
+
+
+def retryable_errors():
+    """リトライする例外。google.api_core は読み込みに時間がかかるので、初めて例外が起きたときに読み込む"""
+    global _retryable_errors
+    if _retryable_errors is None:
+        from google.api_core import exceptions as api_exceptions
+        _retryable_errors = (
+            asyncio.TimeoutError,
+            ConnectionError,
+            api_exceptions.ResourceExhausted,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.DeadlineExceeded,
+            api_exceptions.InternalServerError,
+        )
+    return _retryable_errors
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens=0):
+        self.text = text
+        self.candidates = [text]
+        self.prompt_feedback = None
+        # 日本語はおおよそ1文字1トークンとして数える
+        self.usage_metadata = FakeUsage(prompt_tokens, len(text))
+
+
+class FakeModel:
+    """Gemini を呼ばずにプロンプトの種類に応じた固定の応答を返すモデル
+
+    latency 秒待ってから応答し、failure_rate の割合で ConnectionError を送出する。
+    stream=True の場合は chunk_size 文字ずつ、latency を均等に分けて返す。
+    マップの応答は corrupt_rate の割合で、途中で切れたものか、1分野のティッカーが壊れたものにする。
+    """
+
+    def __init__(self, model_name=MODEL_NAME, latency=0.5, failure_rate=0.0, seed=None, chunk_size=40,
+                 corrupt_rate=0.0):
+        self.model_name = model_name
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.failure_rate = failure_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def _company(self, i, j):
+        return {"name": f"企業{i}{j}", "ticker": f"{1300 + i * 10 + j}.T",
+                "reason": "フェイクの根拠", "description": "フェイクの紹介"}
+
+    def _map(self):
+        tree = {"name": "フェイク", "children": [
+            {"name": f"分野{i}", "children": [self._company(i, j) for j in range(3)]} for i in range(5)]}
+        if not self.corrupt_rate or self.random.random() >= self.corrupt_rate:
+            return json.dumps(tree, ensure_ascii=False)
+        if self.random.random() < 0.5:
+            text = json.dumps(tree, ensure_ascii=False)
+            return text[:self.random.randrange(len(text) // 3, len(text) - 1)]
+        for company in self.random.choice(tree["children"])["children"]:
+            company["ticker"] = "不明"
+        return json.dumps(tree, ensure_ascii=False)
+
+    def respond(self, prompt, generation_config=None):
+        schema = generation_config.get('response_schema') if isinstance(generation_config, dict) else None
+        if schema == tree_parser.CATEGORY_SCHEMA:
+            # 分野1つ分の生成 (壊れた分野の作り直し)
+            i = self.random.randrange(5, 10)
+            return json.dumps({"name": f"分野{i}", "children": [self._company(i, j) for j in range(3)]},
+                              ensure_ascii=False)
+        if '"companies"' in prompt:
+            # 社名のまとめての問い合わせ: プロンプトに並んだティッカーそれぞれに答える
+            tickers = re.findall(r'\b\d{4}\.T\b', prompt)
+            return json.dumps({"companies": [{"ticker": t, "japanese_name": f"フェイク株式会社{t[:4]}"} for t in tickers]},
+                              ensure_ascii=False)
+        if '"japanese_name"' in prompt:
+            return json.dumps({"japanese_name": "フェイク株式会社"}, ensure_ascii=False)
+        if '"headlines"' in prompt:
+            return json.dumps({"headlines": [f"フェイクニュース{i}" for i in range(1, 6)]}, ensure_ascii=False)
+        if 'NO_CHANGE' in prompt:
+            return "- フェイクの変更点です。" if self.random.random() < 0.5 else "NO_CHANGE"
+        if '"children"' in prompt or schema == tree_parser.MAP_SCHEMA:
+            return self._map()
+        return "### 1. 外部環境分析\n- フェイクの分析です。\n\n### 2. SWOT分析\n- 強み: なし\n\n### 3. 将来性\n- 不明"
+
+    def _maybe_fail(self):
+        self.calls += 1
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise ConnectionError("fake Gemini failure")
+
+    def _chunks(self, contents, generation_config=None):
+        text = self.respond(contents, generation_config)
+        chunks = []
+        for i in range(0, len(text), self.chunk_size):
+            chunk = FakeResponse(text[i:i + self.chunk_size], len(contents))
+            # 実際の Gemini と同じく、使用量はそこまでの累計を返す
+            chunk.usage_metadata.candidates_token_count = min(i + self.chunk_size, len(text))
+            chunks.append(chunk)
+        return chunks
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        self._maybe_fail()
+        if stream:
+            return self._stream(self._chunks(contents, generation_config))
+        time.sleep(self.latency)
+        return FakeResponse(self.respond(contents, generation_config), len(contents))
+
+    def _stream(self, chunks):
+        for chunk in chunks:
+            time.sleep(self.latency / len(chunks))
+            yield chunk
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        self._maybe_fail()
+        if stream:
+            return self._stream_async(self._chunks(contents, generation_config))
+        await asyncio.sleep(self.latency)
+        return FakeResponse(self.respond(contents, generation_config), len(contents))
+
+    async def _stream_async(self, chunks):
+        for chunk in chunks:
+            await asyncio.sleep(self.latency / len(chunks))
+            yield chunk
+
+
+_vertexai_ready = False
+
+
+def _init_vertexai():
+    """Vertex AI を初期化する。vertexai の読み込みには数秒かかるので、起動時ではなく最初のモデル作成時に行う"""
+    global _vertexai_ready
+    if _vertexai_ready:
+        return
+    import vertexai
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
+    location = os.environ.get("GOOGLE_CLOUD_LOCATION")
+    # ローカル認証とGCP環境での認証を両立させるため、projectとlocationが取得できた場合のみ初期化
+    if project_id and location:
+        try:
+            vertexai.init(project=project_id, location=location)
+        except Exception as e:
+            logger.exception(f"Vertex AIの初期化中にエラーが発生しました: {e}")
+    _vertexai_ready = True
+
+
+def _default_factory(model_name):
+    if os.environ.get('GEMINI_BACKEND') == 'fake':
+        return FakeModel(model_name, latency=float(os.environ.get('GEMINI_FAKE_LATENCY', 0.5)))
+    _init_vertexai()
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(model_name)
+
+
+_model_factory = _default_factory
+_models = {}
+_models_lock = threading.Lock()
+
+
+def set_backend(factory):
+    """モデルの生成関数を差し替える (ベンチマークでフェイクを使う場合など)"""
+    global _model_factory
+    with _models_lock:
+        _model_factory = factory
+        _models.clear()
+
+
+def get_model(model_name=MODEL_NAME):
+    """モデル名ごとに1つのインスタンスを使い回す"""
+    with _models_lock:
+        model = _models.get(model_name)
+        if model is None:
+            model = _models[model_name] = _model_factory(model_name)
+        return model
+
+
+class _Loop:
+    """非同期呼び出し専用のイベントループを別スレッドで動かす
+
+    Vertex AI の非同期クライアントは最初に使ったループに紐づくため、
+    すべての呼び出しを同じループで実行して接続を使い回す。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+                threading.Thread(target=self._loop.run_forever, name='gemini-loop', daemon=True).start()
+            return self._loop
+
+    @property
+    def semaphore(self):
+        return self._semaphore
+
+
+_loop = _Loop()
+
+
+def _generation_config(model, generation_config):
+    """response_schema を含む設定は Vertex AI の GenerationConfig に変換する (dict のままではスキーマを受け付けないため)
+
+    変換時に渡した dict が書き換えられるので、コピーを渡す。
+    """
+    if isinstance(model, FakeModel) or not isinstance(generation_config, dict) \
+            or 'response_schema' not in generation_config:
+        return generation_config
+    from vertexai.generative_models import GenerationConfig
+    return GenerationConfig(**copy.deepcopy(generation_config))
+
+
+class RequestDeadlineExceeded(Exception):
+    """ルートごとの処理時間の上限を超えた"""
+
+
+def _time_left(timeout):
+    """リクエストの締め切りまでの残り時間で timeout を切り詰める。締め切りを過ぎていればリトライせずに失敗させる"""
+    left = metrics.time_left(timeout)
+    if left <= 0:
+        raise RequestDeadlineExceeded("リクエストの処理時間の上限を超えました")
+    return left
+
+
+async def generate_async(prompt, generation_config=None, timeout=None, retries=None):
+    """同時実行数を制限し、タイムアウトと指数バックオフ(ジッター付き)のリトライを行う
+
+    リクエストの中から呼ばれた場合は、ルートごとの締め切りを超えないようにタイムアウトとリトライを打ち切る。
+    """
+    timeout = TIMEOUT if timeout is None else timeout
+    retries = RETRIES if retries is None else retries
+    model = get_model()
+    generation_config = _generation_config(model, generation_config)
+    for attempt in range(retries + 1):
+        # 回数制限の順番待ちは同時実行数の枠を取る前に行い、待っている間に他のユーザーの呼び出しを止めない
+        await rate_limit.gemini.acquire_async()
+        try:
+            async with _loop.semaphore:
+                with metrics.timed('gemini', 'generate'):
+                    response = await asyncio.wait_for(
+                        model.generate_content_async(prompt, generation_config=generation_config),
+                        _time_left(timeout),
+                    )
+                metrics.record_tokens(response)
+                return response
+        except retryable_errors():
+            if attempt == retries:
+                raise
+            await asyncio.sleep(min(random.uniform(0, BACKOFF * 2 ** attempt), _time_left(timeout)))
+
+
+def run(coro):
+    """コルーチンを共有ループで実行し、結果を待って返す"""
+    return asyncio.run_coroutine_threadsafe(metrics.bind_coroutine(coro), _loop.get()).result()
+
+
+async def _gather(coros, return_exceptions, limit):
+    if limit:
+        semaphore = asyncio.Semaphore(limit)
+
+        async def limited(coro):
+            async with semaphore:
+                return await coro
+        coros = [limited(coro) for coro in coros]
+    return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+
+def gather(*coros, return_exceptions=False, limit=None):
+    """複数のコルーチンを共有ループで同時に実行する。limit を指定すると同時に実行する数をそこまでにする"""
+    return run(_gather(coros, return_exceptions, limit))
+
+
+def generate(prompt, generation_config=None, timeout=None):
+    return run(generate_async(prompt, generation_config=generation_config, timeout=timeout))
+
+
+_STREAM_END = object()
+
+
+def stream(prompt, generation_config=None, timeout=None, retries=None):
+    """応答をテキストの断片ごとに返すジェネレーター
+
+    最初の断片が届くまでは generate_async と同じくリトライし、その後は断片ごとにタイムアウトを適用する。
+    """
+    timeout = TIMEOUT if timeout is None else timeout
+    retries = RETRIES if retries is None else retries
+    chunks = queue.Queue()
+
+    async def produce():
+        start = time.perf_counter()
+        usage_response = None
+        model = get_model()
+        try:
+            await rate_limit.gemini.acquire_async()
+            async with _loop.semaphore:
+                for attempt in range(retries + 1):
+                    try:
+                        if attempt:
+                            await rate_limit.gemini.acquire_async()
+                        responses = await asyncio.wait_for(
+                            model.generate_content_async(prompt, generation_config=_generation_config(
+                                model, generation_config), stream=True),
+                            _time_left(timeout),
+                        )
+                        break
+                    except retryable_errors():
+                        if attempt == retries:
+                            raise
+                        await asyncio.sleep(min(random.uniform(0, BACKOFF * 2 ** attempt), _time_left(timeout)))
+                iterator = responses.__aiter__()
+                while True:
+                    try:
+                        response = await asyncio.wait_for(iterator.__anext__(), _time_left(timeout))
+                    except StopAsyncIteration:
+                        break
+                    if getattr(response, 'usage_metadata', None) is not None:
+                        usage_response = response
+                    try:
+                        text = response.text
+                    except ValueError:
+                        # テキストを含まない断片(終了理由のみなど)は読み飛ばす
+                        continue
+                    if text:
+                        chunks.put(text)
+        except Exception as e:
+            metrics.record_call('gemini', 'stream', time.perf_counter() - start, e)
+            chunks.put(e)
+        else:
+            metrics.record_call('gemini', 'stream', time.perf_counter() - start)
+            if usage_response is not None:
+                # 使用量は最後の断片の値が全体の合計になっている
+                metrics.record_tokens(usage_response)
+        finally:
+            chunks.put(_STREAM_END)
+
+    future = asyncio.run_coroutine_threadsafe(metrics.bind_coroutine(produce()), _loop.get())
+    try:
+        while True:
+            item = chunks.get()
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # クライアントが途中で切断した場合は生成を打ち切る
+        future.cancel()
+
+
+def generate_many(prompts, generation_config=None, timeout=None):
+    """複数のプロンプトを同時に送る。失敗したものは例外オブジェクトが入る"""
+    return gather(*(generate_async(p, generation_config=generation_config, timeout=timeout) for p in prompts),
+                  return_exceptions=True)
@@ -0,0 +1,65 @@
+"""本番用の gunicorn の設定 (gunicorn -c gunicorn.conf.py app:app)
+
+ワーカープロセスを複数起動し、各プロセスはスレッドでリクエストを並行処理する。
+Gemini・yfinance の応答待ちはルートごとの締め切り (app.ROUTE_TIMEOUTS) で打ち切るので、
+ここでの timeout は応答しなくなったワーカーを再起動するためのもの。
+
+プロセスをまたいで共有する状態:
+- 株価キャッシュ: QUOTE_CACHE_BACKEND=sqlite で同じコンテナのワーカー間で共有する
+- yfinance・Gemini の回数制限: RATE_LIMIT_BACKEND=sqlite で同じく共有する
+- ポートフォリオ分析のキャッシュ: 破棄を CacheGeneration テーブルの世代番号で全プロセスに伝える
+- マップ・ニュース・分析ジョブ・日足: DB に保存する
+- 株価の定期更新: ワーカーごとに動かさず、flask refresh-scheduler を1つだけ起動する
+- ダッシュボードへの株価の配信 (/prices/stream): ワーカーごとに1つのスレッドが取得し、株価キャッシュを通すので
+  外部への問い合わせはワーカー数によらず QUOTE_PRICE_TTL ごとに1回になる
+- /metrics の値はワーカープロセスごとの集計になる
+
+配信の接続は開いている間スレッドを1つ使う (DB接続は使わない)。1ワーカーの接続数は PRICE_FEED_MAX_STREAMS までとし、
+残りのスレッドで通常のリクエストを処理する。
+DB接続の予算: 1ワーカーのプールは既定で スレッド数 + app.BACKGROUND_THREADS (分析ジョブ・株価の配信・ニュース・
+株価の定期更新のスレッド) 本で、オーバーフローはしない。1コンテナの接続数は ワーカー数 × (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+で、既定では 4 × (8 + 4) = 48 になる。これにコンテナ数を掛け、flask refresh-scheduler などのバッチ処理の分を足したものを
+Postgres の max_connections 以内にする。
+
+ワーカー数はこのプロセスに割り当てられたCPU数 × 2 で、MAX_WORKERS までにする。ホスト全体のCPU数
+(multiprocessing.cpu_count) を使うと、大きなホストのコンテナではワーカーとDB接続が桁違いに増えてしまう。
+"""
+import os
+
+# WEB_CONCURRENCY を指定しない場合のワーカー数の上限
+MAX_WORKERS = int(os.environ.get('GUNICORN_MAX_WORKERS', 4))
+
+
+def default_workers():
+    # process_cpu_count は Python 3.13 から。それより前は CPU affinity で数える
+    count = getattr(os, 'process_cpu_count', None)
+    if count is not None:
+        cpus = count()
+    elif hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count()
+    return max(1, min((cpus or 1) * 2, MAX_WORKERS))
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+# メモリの断片化に備えて、一定数のリクエストを処理したワーカーは入れ替える
+max_requests = 1000
+max_requests_jitter = 100
+# アプリはマスタープロセスで1回だけ読み込み、ワーカーはそれを fork して使う
+preload_app = True
+# アクセスログはアプリが1リクエスト1行のJSONで出力する
+accesslog = None
+
+
+def post_fork(server, worker):
+    """マスタープロセスで作ったDB接続をワーカーで使い回さないよう、プールを作り直す"""
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
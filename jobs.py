@@ -0,0 +1,252 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, insert
+import metrics
+import rate_limit
+from models import db, StockItem, AnalysisJob, AnalysisJobItem
+
+# Gemini を同時に呼び出す数。1秒あたりの呼び出し回数は rate_limit.gemini でジョブのユーザーごとに制限する
+MAX_WORKERS = int(os.environ.get('ANALYSIS_JOB_WORKERS', 4))
+# この時間を過ぎても running のままの項目は、落ちたプロセスのものとみなして再実行する
+STALE_AFTER = timedelta(minutes=10)
+# DBのエラーでキューを読めなかった場合に待つ時間(秒)。続けて失敗するたびに倍にし、MAX_ERROR_BACKOFF までにする
+MAX_ERROR_BACKOFF = 60.0
+ACTIVE_STATUSES = ('queued', 'running')
+
+logger = logging.getLogger(__name__)
+
+
+def get_active_job(user_id):
+    stmt = (select(AnalysisJob)
+            .where(AnalysisJob.user_id == user_id, AnalysisJob.status.in_(ACTIVE_STATUSES))
+            .order_by(AnalysisJob.id.desc()))
+    return db.session.scalars(stmt).first()
+
+
+def enqueue_analysis_job(user_id):
+    """分析テキストのある全銘柄の更新ジョブを登録する
+
+    実行中のジョブがあれば新しく作らずにそれを返す。戻り値は (ジョブ, 新規作成したか)。
+    """
+    active_job = get_active_job(user_id)
+    if active_job:
+        return active_job, False
+    stock_ids = db.session.scalars(
+        select(StockItem.id).where(
+            StockItem.user_id == user_id,
+            StockItem.analysis_text.is_not(None),
+            StockItem.analysis_text != '',
+        )
+    ).all()
+    return create_analysis_job(user_id, stock_ids), True
+
+
+def create_analysis_job(user_id, stock_ids):
+    """指定した銘柄の分析ジョブを登録する (一括登録した銘柄の初期分析を後から生成する場合など)"""
+    now = datetime.utcnow()
+    job = AnalysisJob(user_id=user_id, total=len(stock_ids), created_at=now)
+    if not stock_ids:
+        job.status = 'done'
+        job.finished_at = now
+    db.session.add(job)
+    db.session.flush()
+    if stock_ids:
+        db.session.execute(
+            insert(AnalysisJobItem),
+            [{'job_id': job.id, 'user_id': user_id, 'stock_id': stock_id} for stock_id in stock_ids],
+        )
+    db.session.commit()
+    return job
+
+
+class AnalysisJobWorker:
+    """analysis_job_item テーブルをキューとして、銘柄ごとの分析更新を並行実行する
+
+    analyze は StockItem を受け取って分析を更新 (分析が無ければ生成) し、更新があったかどうかを返す関数。
+    キューからはユーザーごとに順番に取り出すので、銘柄数の多いユーザーがいても
+    他のユーザーのジョブが待たされ続けることはない。結果は1銘柄ごとにコミットする。
+    Gemini の呼び出しは rate_limit.gemini でジョブのユーザーの回数に数え、上限に達した項目はキューに戻す。
+    上限に達したユーザーの項目は Retry-After の間だけ取り出さず、その間も他のユーザーの項目を処理する。
+    """
+
+    def __init__(self, app, analyze, max_workers=MAX_WORKERS, poll_interval=2.0):
+        self.app = app
+        self.analyze = analyze
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self._last_served = {}
+        # ユーザー id -> 回数制限が解けるまで取り出さない時刻 (time.monotonic)
+        self._not_before = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self.run, name='analysis-job-worker', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self, until_idle=False):
+        """キューを処理し続ける。until_idle=True の場合はキューが空になった時点で戻る
+
+        DBのエラー (接続の切断など) ではスレッドを止めず、ログに残して待ってからやり直す。
+        """
+        try:
+            self._requeue_stale()
+        except Exception as e:
+            logger.exception(f"Could not requeue stale analysis job items: {e}")
+        slots = threading.Semaphore(self.max_workers)
+        backoff = self.poll_interval
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not self._stopped.is_set():
+                slots.acquire()
+                try:
+                    item_id = self._claim_next()
+                except Exception as e:
+                    slots.release()
+                    logger.exception(f"Could not claim the next analysis job item; retrying in {backoff:g}s: {e}")
+                    self._stopped.wait(backoff)
+                    backoff = min(backoff * 2, MAX_ERROR_BACKOFF)
+                    continue
+                backoff = self.poll_interval
+                if item_id is None:
+                    slots.release()
+                    resume_in = self._resume_in()
+                    if until_idle and resume_in is None:
+                        break
+                    self._wakeup.wait(self.poll_interval if resume_in is None else min(self.poll_interval, resume_in))
+                    self._wakeup.clear()
+                    continue
+                future = executor.submit(self._process, item_id)
+                future.add_done_callback(lambda _: slots.release())
+
+    def _resume_in(self):
+        """回数制限で待っているユーザーがいれば、最初に待ちが解けるまでの秒数。いなければ None"""
+        now = time.monotonic()
+        waits = [t - now for t in self._not_before.values() if t > now]
+        return min(waits) if waits else None
+
+    def _requeue_stale(self):
+        with self.app.app_context():
+            try:
+                db.session.execute(
+                    update(AnalysisJobItem)
+                    .where(AnalysisJobItem.status == 'running',
+                           AnalysisJobItem.claimed_at < datetime.utcnow() - STALE_AFTER)
+                    .values(status='queued', claimed_at=None)
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _claim_next(self):
+        with self.app.app_context():
+            try:
+                return self._claim_next_item()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _claim_next_item(self):
+        user_ids = db.session.scalars(
+            select(AnalysisJobItem.user_id).where(AnalysisJobItem.status == 'queued').distinct()
+        ).all()
+        # 回数制限で待っているユーザーを除き、最後に処理した時刻が一番古いユーザーから取り出す
+        now = time.monotonic()
+        user_ids = [u for u in user_ids if self._not_before.get(u, 0.0) <= now]
+        for user_id in sorted(user_ids, key=lambda u: self._last_served.get(u, 0.0)):
+            item = db.session.execute(
+                select(AnalysisJobItem.id, AnalysisJobItem.job_id)
+                .where(AnalysisJobItem.user_id == user_id, AnalysisJobItem.status == 'queued')
+                .order_by(AnalysisJobItem.id)
+                .limit(1)
+            ).first()
+            if item is None:
+                continue
+            # 他のワーカープロセスと取り合った場合は rowcount が 0 になる
+            result = db.session.execute(
+                update(AnalysisJobItem)
+                .where(AnalysisJobItem.id == item.id, AnalysisJobItem.status == 'queued')
+                .values(status='running', claimed_at=datetime.utcnow())
+            )
+            if result.rowcount != 1:
+                db.session.rollback()
+                continue
+            db.session.execute(
+                update(AnalysisJob)
+                .where(AnalysisJob.id == item.job_id, AnalysisJob.status == 'queued')
+                .values(status='running')
+            )
+            db.session.commit()
+            self._last_served[user_id] = time.monotonic()
+            return item.id
+        return None
+
+    def _process(self, item_id):
+        with self.app.app_context():
+            item = db.session.get(AnalysisJobItem, item_id)
+            stock = db.session.get(StockItem, item.stock_id)
+            user_id, stock_id = item.user_id, item.stock_id
+            updated = failed = 0
+            try:
+                # 分析テキストの無い銘柄は analyze 側で初期分析を生成する
+                if stock:
+                    # Gemini の呼び出しはジョブのユーザーの回数に数える
+                    with metrics.task(user_id=item.user_id):
+                        stock.has_update = bool(self.analyze(stock))
+                    updated = int(stock.has_update)
+                item.status = 'done'
+            except rate_limit.RateLimited as e:
+                # 回数の上限に達した場合は失敗にせず、キューに戻す。このスレッドでは待たずに枠を空け、
+                # このユーザーの項目だけを Retry-After の間取り出さないようにする
+                db.session.rollback()
+                db.session.execute(
+                    update(AnalysisJobItem).where(AnalysisJobItem.id == item_id).values(status='queued', claimed_at=None)
+                )
+                db.session.commit()
+                self._not_before[user_id] = time.monotonic() + e.retry_after
+                logger.info(f"Rate limited while updating stock {stock_id}; retrying user {user_id} in {e.retry_after}s")
+                self.wake()
+                return
+            except Exception as e:
+                logger.warning(f"Could not update analysis for stock {item.stock_id}: {e}")
+                db.session.rollback()
+                item = db.session.get(AnalysisJobItem, item_id)
+                item.status = 'failed'
+                item.error = str(e)
+                failed = 1
+            try:
+                db.session.execute(
+                    update(AnalysisJob)
+                    .where(AnalysisJob.id == item.job_id)
+                    .values(processed=AnalysisJob.processed + 1,
+                            updated_count=AnalysisJob.updated_count + updated,
+                            failed_count=AnalysisJob.failed_count + failed)
+                )
+                db.session.execute(
+                    update(AnalysisJob)
+                    .where(AnalysisJob.id == item.job_id,
+                           AnalysisJob.processed >= AnalysisJob.total,
+                           AnalysisJob.status.in_(ACTIVE_STATUSES))
+                    .values(status='done', finished_at=datetime.utcnow())
+                )
+                db.session.commit()
+            except Exception as e:
+                # 項目は running のまま残り、STALE_AFTER を過ぎてから再実行される
+                logger.exception(f"Could not save the result for analysis job item {item_id}: {e}")
+                db.session.rollback()
@@ -0,0 +1,112 @@
+import os
+import re
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, delete, update, bindparam
+from sqlalchemy.exc import IntegrityError
+import metrics
+from models import db, MapCache
+
+TTL = timedelta(seconds=int(os.environ.get('MAP_CACHE_TTL', 3 * 24 * 60 * 60)))
+MAX_ENTRIES = int(os.environ.get('MAP_CACHE_MAX_ENTRIES', 5000))
+# ヒット数と最終利用日時はプロセス内で貯めておき、この間隔でまとめて書き込む (put での削除はその分遅れた値で判断する)
+TOUCH_INTERVAL = timedelta(seconds=int(os.environ.get('MAP_CACHE_TOUCH_INTERVAL', 60)))
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'saved_ms': 0.0}
+# キャッシュの id -> (まだ書き込んでいないヒット数, 最後に使った日時)
+_pending = {}
+_last_touch = datetime.utcnow()
+
+
+def normalize_key(text):
+    """全角・半角や大文字・小文字、空白の違いを吸収したキーにする"""
+    text = unicodedata.normalize('NFKC', text).strip().lower()
+    return re.sub(r'\s+', ' ', text)[:500]
+
+
+def get(mode, text):
+    """有効期限内のキャッシュがあればツリーJSONの文字列を返す
+
+    読むだけでDBには書き込まない。ヒット数と最終利用日時は TOUCH_INTERVAL ごとに _touch でまとめて書き込む。
+    """
+    global _last_touch
+    now = datetime.utcnow()
+    entry = db.session.execute(
+        select(MapCache.id, MapCache.cache_key, MapCache.tree_json, MapCache.generation_ms)
+        .where(MapCache.mode == mode, MapCache.cache_key == normalize_key(text), MapCache.created_at >= now - TTL)
+    ).first()
+    touched = None
+    with _lock:
+        if entry is None:
+            _stats['misses'] += 1
+        else:
+            _stats['hits'] += 1
+            _stats['saved_ms'] += entry.generation_ms
+            _pending[entry.id] = (_pending.get(entry.id, (0, now))[0] + 1, now)
+            if now - _last_touch >= TOUCH_INTERVAL:
+                touched = dict(_pending)
+                _pending.clear()
+                _last_touch = now
+        stats = dict(_stats)
+    metrics.record_cache('map', 'miss' if entry is None else 'hit')
+    if entry is None:
+        return None
+    if touched:
+        # SQLite では書き込みのロックを待つことがあるので、リクエストを待たせないよう別スレッドで書き込む
+        threading.Thread(target=_touch, args=(current_app._get_current_object(), touched),
+                         name='map-cache-touch', daemon=True).start()
+    total = stats['hits'] + stats['misses']
+    current_app.logger.info(
+        "map cache hit mode=%s key=%r saved=%.0fms hit_ratio=%.2f total_saved=%.0fms",
+        mode, entry.cache_key, entry.generation_ms, stats['hits'] / total, stats['saved_ms'])
+    return entry.tree_json
+
+
+def _touch(app, pending):
+    """貯めておいたヒット数と最終利用日時を1回のUPDATEで書き込む
+
+    呼び出し元のセッションの未コミットの変更を巻き込まないよう、別の接続・トランザクションで行う。
+    """
+    statement = (update(MapCache.__table__)
+                 .where(MapCache.__table__.c.id == bindparam('entry_id'))
+                 .values(hits=MapCache.__table__.c.hits + bindparam('added'), last_used_at=bindparam('used_at')))
+    with app.app_context():
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement, [{'entry_id': entry_id, 'added': hits, 'used_at': used_at}
+                                               for entry_id, (hits, used_at) in pending.items()])
+        except Exception as e:
+            # ヒット数は目安なので、書き込めなかった分は捨てる
+            app.logger.warning(f"Could not record map cache hits: {e}")
+
+
+def put(mode, text, tree_json, generation_ms):
+    """生成結果を保存し、件数の上限を超えた分は最後に使われたのが古い順に削除する"""
+    now = datetime.utcnow()
+    key = normalize_key(text)
+    entry = db.session.scalar(select(MapCache).where(MapCache.mode == mode, MapCache.cache_key == key))
+    if entry is None:
+        entry = MapCache(mode=mode, cache_key=key, hits=0)
+        db.session.add(entry)
+    entry.tree_json = tree_json
+    entry.generation_ms = generation_ms
+    entry.created_at = now
+    entry.last_used_at = now
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 別のワーカーが同じキーを先に保存した
+        db.session.rollback()
+        return
+    stale_ids = select(MapCache.id).order_by(MapCache.last_used_at.desc()).offset(MAX_ENTRIES)
+    db.session.execute(delete(MapCache).where(MapCache.id.in_(stale_ids)))
+    db.session.commit()
+
+
+def stats():
+    with _lock:
+        total = _stats['hits'] + _stats['misses']
+        return dict(_stats, hit_ratio=round(_stats['hits'] / total, 4) if total else 0.0)
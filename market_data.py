@@ -0,0 +1,134 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+import rate_limit
+from quote_cache import QuoteCache, create_backend
+
+# 同時に問い合わせる銘柄数と、1銘柄あたりのタイムアウト(秒)・リトライ回数
+MAX_WORKERS = int(os.environ.get('MARKET_DATA_WORKERS', 8))
+TICKER_TIMEOUT = float(os.environ.get('MARKET_DATA_TIMEOUT', 15))
+RETRIES = int(os.environ.get('MARKET_DATA_RETRIES', 2))
+RETRY_BACKOFF = 0.5
+# yfinance は pandas ごと読み込むので起動が遅くなる。最初の問い合わせで読み込む (テストではフェイクに差し替える)
+yf = None
+
+
+def _yfinance():
+    global yf
+    if yf is None:
+        import yfinance
+        yf = yfinance
+    return yf
+
+
+def fetch_info(ticker):
+    """yfinance から銘柄情報(info)を取得する"""
+    rate_limit.yfinance.acquire()
+    with metrics.timed('yfinance', 'info'):
+        return _yfinance().Ticker(ticker).info
+
+
+def fetch_price(ticker):
+    """info より軽い fast_info から株価だけを取得する"""
+    rate_limit.yfinance.acquire()
+    with metrics.timed('yfinance', 'fast_info'):
+        return _yfinance().Ticker(ticker).fast_info['lastPrice']
+
+
+def fetch_history(ticker, start):
+    """start 以降の日足(OHLCV)を pandas の DataFrame で取得する"""
+    rate_limit.yfinance.acquire()
+    with metrics.timed('yfinance', 'history'):
+        return _yfinance().Ticker(ticker).history(start=start, interval='1d', auto_adjust=False)
+
+
+# プロセス全体で共有する株価・財務指標キャッシュ
+quote_cache = QuoteCache(fetch_info, fetch_price, backend=create_backend())
+
+
+def get_info(ticker):
+    """キャッシュを通して銘柄情報を取得する"""
+    return quote_cache.get_info(ticker)
+
+
+def extract_financials(info):
+    """info から株価と財務指標を取り出す"""
+    return {
+        'current_price': info.get('currentPrice') or info.get('regularMarketPrice'),
+        'per': info.get('forwardPE') or info.get('trailingPE'),
+        'pbr': info.get('priceToBook'),
+        'dividend_yield': info.get('dividendYield'),
+    }
+
+
+def extract_profile(info):
+    """銘柄の一括登録用に、株価と財務指標に加えて英語社名とセクターを取り出す"""
+    return {**extract_financials(info), 'long_name': info.get('longName'), 'sector': info.get('sector')}
+
+
+def _fetch_with_retry(ticker, retries, extract):
+    last_error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            financials = extract(get_info(ticker))
+            if financials['current_price'] is not None:
+                return financials
+            last_error = '株価を取得できませんでした'
+            quote_cache.invalidate_prices(ticker)
+        except rate_limit.RateLimited:
+            # 上限に達している間はリトライしても断られるだけなので、すぐに失敗にする
+            raise
+        except Exception as e:
+            last_error = str(e) or e.__class__.__name__
+    raise RuntimeError(last_error)
+
+
+def fetch_financials(tickers, max_workers=None, timeout=None, retries=None, extract=extract_financials):
+    """複数銘柄の株価と財務指標をワーカープールで並行取得する
+
+    戻り値は (成功した銘柄 -> 指標の辞書, 失敗した銘柄 -> エラー内容) のタプル。
+    1銘柄がタイムアウトしても他の銘柄の結果は返す。extract で info から取り出す項目を変えられる。
+    """
+    max_workers = max_workers or MAX_WORKERS
+    # リクエストの中から呼ばれた場合は、ルートごとの締め切りまでの残り時間を超えて待たない
+    timeout = metrics.time_left(TICKER_TIMEOUT if timeout is None else timeout)
+    retries = RETRIES if retries is None else retries
+    tickers = list(dict.fromkeys(tickers))
+    results, failures = {}, {}
+    if not tickers:
+        return results, failures
+
+    started = {}
+
+    def task(ticker):
+        started[ticker] = time.monotonic()
+        return _fetch_with_retry(ticker, retries, extract)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(tickers)))
+    futures = {executor.submit(metrics.bind(task), ticker): ticker for ticker in tickers}
+    pending = set(futures)
+    # 全ワーカーが応答待ちで詰まった場合に備えて全体の締め切りも設ける
+    batches = -(-len(tickers) // max_workers)
+    deadline = time.monotonic() + metrics.time_left(timeout * (batches + 1))
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=min(timeout, 0.5), return_when=FIRST_COMPLETED)
+            for future in done:
+                ticker = futures[future]
+                try:
+                    results[ticker] = future.result()
+                except Exception as e:
+                    failures[ticker] = str(e)
+            now = time.monotonic()
+            for future in list(pending):
+                ticker = futures[future]
+                if now - started.get(ticker, now) > timeout or now > deadline:
+                    failures[ticker] = 'タイムアウトしました'
+                    pending.discard(future)
+    finally:
+        # タイムアウトしたスレッドの終了は待たずに戻る
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results, failures
@@ -0,0 +1,368 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 秒単位のヒストグラムのバケット
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 設定されている場合、/metrics は Authorization: Bearer <METRICS_TOKEN> が無いと返さない
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+request_logger = logging.getLogger('kabu.request')
+
+
+class Registry:
+    """Prometheus のテキスト形式で出力できるカウンターとヒストグラムの集まり"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def inc(self, name, value=1, help='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('counter', help))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, help='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('histogram', help))
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(entry['buckets']):
+                if value <= bound:
+                    entry['counts'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(entry, counts=list(entry['counts'])) for key, entry in self._histograms.items()}
+            help_texts = dict(self._help)
+        lines = []
+        for name in sorted(help_texts):
+            kind, help_text = help_texts[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            for (key_name, labels), entry in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                for bound, count in zip(entry['buckets'], entry['counts']):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {entry['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {entry['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {entry['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+registry = Registry()
+
+
+class RequestStats:
+    """1リクエストの中で使った時間を外部呼び出しの種類ごとに集計する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.calls = {}
+        self.tokens = {'prompt': 0, 'output': 0}
+        self.cache = {}
+        # time.perf_counter() の値。これを過ぎたら外部呼び出しを始めない
+        self.deadline = None
+        # 外部APIの呼び出し回数を数えるユーザー (rate_limit)
+        self.user_id = None
+
+    def add_call(self, service, seconds):
+        with self._lock:
+            self.seconds[service] = self.seconds.get(service, 0.0) + seconds
+            self.calls[service] = self.calls.get(service, 0) + 1
+
+    def add_tokens(self, prompt, output):
+        with self._lock:
+            self.tokens['prompt'] += prompt
+            self.tokens['output'] += output
+
+    def add_cache(self, cache, result):
+        with self._lock:
+            key = f"{cache}_{result}"
+            self.cache[key] = self.cache.get(key, 0) + 1
+
+
+_current = ContextVar('request_stats', default=None)
+
+
+def current():
+    return _current.get()
+
+
+def bind(func):
+    """別スレッドで実行する関数に、呼び出し元のリクエストの集計先を引き継ぐ"""
+    stats = _current.get()
+
+    def wrapper(*args, **kwargs):
+        token = _current.set(stats)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+
+def bind_coroutine(coro):
+    """別スレッドのイベントループで実行するコルーチンに、呼び出し元のリクエストの集計先を引き継ぐ"""
+    stats = _current.get()
+
+    async def runner():
+        # タスクごとにコンテキストがコピーされるので、ここで設定しても他のタスクには影響しない
+        _current.set(stats)
+        return await coro
+    return runner()
+
+
+@contextmanager
+def task(user_id=None):
+    """リクエストの外の処理 (分析ジョブなど) に集計先を設定する。外部呼び出しは user_id の回数に数える"""
+    stats = RequestStats()
+    stats.user_id = user_id
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def time_left(timeout):
+    """外部呼び出しに使えるタイムアウト(秒)。リクエストの締め切りまでの残り時間と timeout の短い方
+
+    リクエストの外 (ワーカーやCLI) から呼ばれた場合は timeout をそのまま返す。
+    """
+    stats = _current.get()
+    if stats is None or stats.deadline is None:
+        return timeout
+    return max(0.0, min(timeout, stats.deadline - time.perf_counter()))
+
+
+def record_call(service, operation, seconds, error=None):
+    registry.observe('external_call_duration_seconds', seconds, help='外部呼び出しの所要時間',
+                     service=service, operation=operation)
+    if error is not None:
+        registry.inc('external_call_errors_total', help='外部呼び出しの失敗回数',
+                     service=service, operation=operation, error=error.__class__.__name__)
+    stats = _current.get()
+    if stats is not None:
+        stats.add_call(service, seconds)
+
+
+@contextmanager
+def timed(service, operation):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_call(service, operation, time.perf_counter() - start, e)
+        raise
+    record_call(service, operation, time.perf_counter() - start)
+
+
+def record_tokens(response):
+    """Gemini の応答に含まれるトークン数を記録する"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    prompt = getattr(usage, 'prompt_token_count', 0) or 0
+    output = getattr(usage, 'candidates_token_count', 0) or 0
+    registry.inc('gemini_tokens_total', prompt, help='Gemini のトークン数', kind='prompt')
+    registry.inc('gemini_tokens_total', output, help='Gemini のトークン数', kind='output')
+    stats = _current.get()
+    if stats is not None:
+        stats.add_tokens(prompt, output)
+
+
+def record_cache(cache, result):
+    """キャッシュの参照結果 (hit / miss / coalesced) を記録する"""
+    registry.inc('cache_requests_total', help='キャッシュの参照回数', cache=cache, result=result)
+    stats = _current.get()
+    if stats is not None:
+        stats.add_cache(cache, result)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['metrics_query_start'].pop()
+    registry.observe('db_query_duration_seconds', seconds, help='SQLの実行時間')
+    stats = _current.get()
+    if stats is not None:
+        stats.add_call('db', seconds)
+    logging.getLogger('kabu.sql').debug('sql', extra={'fields': {'statement': statement, 'ms': round(seconds * 1000, 2)}})
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # 失敗したSQLは after_cursor_execute が呼ばれないので、開始時刻をここで捨てる
+    if context.connection is not None and context.connection.info.get('metrics_query_start'):
+        context.connection.info['metrics_query_start'].pop()
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行1JSONで出力する。extra={'fields': {...}} で渡した値もそのまま含める"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S%z'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def configure_logging(app):
+    """ルートロガーに LOG_FORMAT (json / text) の形式で標準エラーへ出力するハンドラーを付ける"""
+    from flask.logging import default_handler
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(LOG_LEVEL)
+
+
+def _finish(stats, exc=None):
+    seconds = time.perf_counter() - stats.start
+    endpoint = stats.endpoint
+    registry.inc('http_requests_total', help='リクエスト数', method=stats.method, endpoint=endpoint,
+                 status=stats.status)
+    registry.observe('http_request_duration_seconds', seconds, help='リクエストの所要時間', endpoint=endpoint)
+    registry.observe('http_response_size_bytes', stats.response_bytes, buckets=SIZE_BUCKETS,
+                     help='レスポンスのサイズ', endpoint=endpoint)
+    for service, service_seconds in stats.seconds.items():
+        registry.observe('http_request_component_seconds', service_seconds,
+                         help='1リクエストの中でDB・外部APIに使った時間', endpoint=endpoint, component=service)
+    if endpoint == 'static':
+        return
+    request_logger.info('request', extra={'fields': {
+        'method': stats.method,
+        'path': stats.path,
+        'endpoint': endpoint,
+        'status': stats.status,
+        'duration_ms': round(seconds * 1000, 1),
+        'response_bytes': stats.response_bytes,
+        'streamed': stats.streamed,
+        **{f"{service}_ms": round(value * 1000, 1) for service, value in stats.seconds.items()},
+        **{f"{service}_calls": value for service, value in stats.calls.items()},
+        **({'prompt_tokens': stats.tokens['prompt'], 'output_tokens': stats.tokens['output']}
+           if stats.tokens['prompt'] or stats.tokens['output'] else {}),
+        **stats.cache,
+        'error': repr(exc) if exc else None,
+    }})
+
+
+def _stream(iterable, stats):
+    """ストリーミングの応答を送りながらサイズを数え、送り終わった時点で記録する
+
+    Gemini の呼び出しは送信中に行われるので、その間も集計先を設定しておく。
+    """
+    token = _current.set(stats)
+    error = None
+    try:
+        for chunk in iterable:
+            stats.response_bytes += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass
+        _finish(stats, error)
+
+
+def init_app(app):
+    """リクエストごとの所要時間の内訳を記録し、終了時に1行のJSONログとして出力する
+
+    app.config の ROUTE_TIMEOUTS (エンドポイント -> 秒) と REQUEST_TIMEOUT から各リクエストの締め切りを決める。
+    """
+    configure_logging(app)
+
+    @app.before_request
+    def start_request():
+        stats = RequestStats()
+        stats.start = time.perf_counter()
+        stats.method = request.method
+        stats.path = request.path
+        stats.endpoint = request.endpoint or 'unknown'
+        stats.status = 500
+        stats.response_bytes = 0
+        stats.streamed = False
+        timeout = app.config.get('ROUTE_TIMEOUTS', {}).get(stats.endpoint, app.config.get('REQUEST_TIMEOUT'))
+        stats.deadline = stats.start + timeout if timeout else None
+        # ユーザーを読み込まずに済むよう、Flask-Login がセッションに保存した ID を使う
+        stats.user_id = session.get('_user_id')
+        g.metrics_stats = stats
+        g.metrics_token = _current.set(stats)
+
+    @app.after_request
+    def measure_response(response):
+        stats = g.get('metrics_stats')
+        if stats is None:
+            return response
+        stats.status = response.status_code
+        if response.is_streamed:
+            stats.streamed = True
+            response.response = _stream(response.response, stats)
+        else:
+            stats.response_bytes = response.calculate_content_length() or 0
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        stats = g.pop('metrics_stats', None)
+        if stats is None:
+            return
+        try:
+            _current.reset(g.pop('metrics_token'))
+        except ValueError:
+            pass
+        # ストリーミングの応答は送り終わった時点で _stream が記録する
+        if not stats.streamed or exc is not None:
+            _finish(stats, exc)
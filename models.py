@@ -0,0 +1,159 @@
+import json
+from flask_sqlalchemy import SQLAlchemy
+from werkzeug.security import generate_password_hash, check_password_hash
+from flask_login import UserMixin
+from sqlalchemy import case
+from sqlalchemy.ext.hybrid import hybrid_property
+
+db = SQLAlchemy()
+
+
+def performance(current_price, entry_price):
+    """登録時の株価からの騰落率(%)"""
+    if current_price and entry_price and entry_price > 0:
+        return (current_price / entry_price - 1) * 100
+    return 0
+
+
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    password_hash = db.Column(db.String(200), nullable=False)
+    stocks = db.relationship('StockItem', backref='owner', lazy=True)
+
+    def set_password(self, password):
+        self.password_hash = generate_password_hash(password)
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+class StockItem(db.Model):
+    __table_args__ = (
+        db.Index('uq_stock_item_user_ticker', 'user_id', 'ticker', unique=True),
+        db.Index('ix_stock_item_user_sector', 'user_id', 'sector'),
+        db.Index('ix_stock_item_user_rating', 'user_id', 'rating'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    ticker = db.Column(db.String(20), nullable=False)
+    company_name = db.Column(db.String(100), nullable=True)
+    company_name_en = db.Column(db.String(100), nullable=True)
+    sector = db.Column(db.String(50), nullable=True)
+    memo = db.Column(db.Text, nullable=True)
+    rating = db.Column(db.String(10), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    entry_price = db.Column(db.Float, nullable=False)
+    current_price = db.Column(db.Float, nullable=True)
+    rating_date = db.Column(db.DateTime, nullable=True)
+    per = db.Column(db.Float, nullable=True)
+    pbr = db.Column(db.Float, nullable=True)
+    dividend_yield = db.Column(db.Float, nullable=True)
+    analysis_text = db.Column(db.Text, nullable=True)
+    has_update = db.Column(db.Boolean, default=False, nullable=False)
+    @hybrid_property
+    def performance(self):
+        return performance(self.current_price, self.entry_price)
+    @performance.expression
+    def performance(cls):
+        # 並べ替えや絞り込みをDB側で行うためのSQL式
+        return case(
+            ((cls.current_price > 0) & (cls.entry_price > 0), (cls.current_price / cls.entry_price - 1) * 100),
+            else_=0.0,
+        )
+class TickerMetadata(db.Model):
+    """全ユーザーで共有する銘柄ごとの社名・セクター"""
+    ticker = db.Column(db.String(20), primary_key=True)
+    company_name = db.Column(db.String(100), nullable=True)
+    company_name_en = db.Column(db.String(100), nullable=True)
+    sector = db.Column(db.String(50), nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+class AnalysisJob(db.Model):
+    """AI分析の一括更新ジョブ"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    status = db.Column(db.String(10), default='queued', nullable=False)
+    total = db.Column(db.Integer, default=0, nullable=False)
+    processed = db.Column(db.Integer, default=0, nullable=False)
+    updated_count = db.Column(db.Integer, default=0, nullable=False)
+    failed_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    items = db.relationship('AnalysisJobItem', backref='job', lazy=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'updated_count': self.updated_count,
+            'failed_count': self.failed_count,
+        }
+class AnalysisJobItem(db.Model):
+    """ジョブ内の1銘柄分の処理。status が queued の行がキューになる"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('analysis_job.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock_item.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(10), default='queued', nullable=False, index=True)
+    error = db.Column(db.Text, nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+class MapCache(db.Model):
+    """アイデア・プリズムで生成したマップ(ツリーJSON)のキャッシュ"""
+    __table_args__ = (db.UniqueConstraint('mode', 'cache_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    mode = db.Column(db.String(10), nullable=False)
+    cache_key = db.Column(db.String(500), nullable=False)
+    tree_json = db.Column(db.Text, nullable=False)
+    generation_ms = db.Column(db.Float, nullable=False, default=0)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False)
+    last_used_at = db.Column(db.DateTime, nullable=False, index=True)
+class NewsSnapshot(db.Model):
+    """全ユーザーで共有する最新ニュースヘッドライン"""
+    id = db.Column(db.Integer, primary_key=True)
+    headlines_json = db.Column(db.Text, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @property
+    def headlines(self):
+        return json.loads(self.headlines_json)
+class AnalysisSection(db.Model):
+    """銘柄の分析レポート。最初のレポート(base)と、更新のたびに追加する差分(delta)を別々の行で持つ"""
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock_item.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = db.Column(db.String(10), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+class PriceHistory(db.Model):
+    """全ユーザーで共有するティッカーごとの日足(OHLCV)。列ごとのNumPy配列をまとめて data に保存する"""
+    ticker = db.Column(db.String(20), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    first_date = db.Column(db.Date, nullable=True)
+    last_date = db.Column(db.Date, nullable=True)
+    bar_count = db.Column(db.Integer, nullable=False, default=0)
+    checked_on = db.Column(db.Date, nullable=True)
+class ThemeNode(db.Model):
+    """テーマ・分野・企業のグラフの頂点。テーマは正規化した名前、企業はティッカーを key にして重複させない"""
+    __table_args__ = (db.UniqueConstraint('kind', 'key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    key = db.Column(db.String(500), nullable=False)
+    name = db.Column(db.String(500), nullable=False)
+    ticker = db.Column(db.String(20), nullable=True)
+    description = db.Column(db.Text, nullable=True)
+class ThemeEdge(db.Model):
+    """テーマ → 分野、分野 → 企業の辺。weight は同じ組み合わせがマップに現れた回数"""
+    __table_args__ = (db.UniqueConstraint('parent_id', 'child_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('theme_node.id', ondelete='CASCADE'), nullable=False)
+    child_id = db.Column(db.Integer, db.ForeignKey('theme_node.id', ondelete='CASCADE'), nullable=False, index=True)
+    reason = db.Column(db.Text, nullable=True)
+    weight = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False)
+class ThemeTerm(db.Model):
+    """テーマ名の2文字ずつの断片 → テーマの転置インデックス (キーワードを含むテーマを探すため)"""
+    term = db.Column(db.String(2), primary_key=True)
+    node_id = db.Column(db.Integer, db.ForeignKey('theme_node.id', ondelete='CASCADE'), primary_key=True)
+class CacheGeneration(db.Model):
+    """プロセスごとのキャッシュを破棄するための世代番号。破棄するときに1つ増やし、読むときに手元の値と比べる"""
+    key = db.Column(db.String(100), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
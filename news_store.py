@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete
+from models import db, NewsSnapshot
+
+# スケジューラーが取り直す間隔と、ユーザーのリロードをまとめる間隔(秒)
+REFRESH_INTERVAL = int(os.environ.get('NEWS_REFRESH_INTERVAL', 15 * 60))
+MIN_REFRESH_INTERVAL = int(os.environ.get('NEWS_MIN_REFRESH_INTERVAL', 2 * 60))
+KEEP_SNAPSHOTS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class NewsStore:
+    """ニュースヘッドラインをDBに保存して全ユーザーで共有する
+
+    fetch はヘッドラインのリストを返す関数 (失敗時は例外を送出する)。
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        # 取得中の重複を防ぐロックと、スケジューラーの起動だけに使うロック
+        self._lock = threading.Lock()
+        self._scheduler_lock = threading.Lock()
+        self._scheduler = None
+        self._stopped = threading.Event()
+
+    def latest(self):
+        return db.session.scalars(select(NewsSnapshot).order_by(NewsSnapshot.fetched_at.desc()).limit(1)).first()
+
+    def refresh(self, max_age=MIN_REFRESH_INTERVAL):
+        """max_age 秒以内に取得したヘッドラインがあればそれを返し、無ければ取得し直す
+
+        他のスレッドが取得中の場合は待たずに保存済みの最新のヘッドラインを返す
+        (まだ1つも無い場合だけ、取得が終わるのを待ってその結果を受け取る)。
+        """
+        if not self._lock.acquire(blocking=False):
+            snapshot = self.latest()
+            if snapshot is not None:
+                return snapshot
+            self._lock.acquire()
+        try:
+            snapshot = self.latest()
+            if snapshot and datetime.utcnow() - snapshot.fetched_at < timedelta(seconds=max_age):
+                return snapshot
+            headlines = self.fetch()
+            snapshot = NewsSnapshot(headlines_json=json.dumps(headlines, ensure_ascii=False),
+                                    fetched_at=datetime.utcnow())
+            db.session.add(snapshot)
+            db.session.commit()
+            old_ids = select(NewsSnapshot.id).order_by(NewsSnapshot.fetched_at.desc()).offset(KEEP_SNAPSHOTS)
+            db.session.execute(delete(NewsSnapshot).where(NewsSnapshot.id.in_(old_ids)))
+            db.session.commit()
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def start_scheduler(self, app, interval=REFRESH_INTERVAL):
+        """interval 秒ごとにヘッドラインを取り直すバックグラウンドスレッドを起動する
+
+        リクエストごとに呼ばれるので、取得中でも待たされないよう refresh とは別のロックを使う。
+        """
+        with self._scheduler_lock:
+            if self._scheduler is not None and self._scheduler.is_alive():
+                return
+            self._stopped.clear()
+            self._scheduler = threading.Thread(target=self._run_scheduler, args=(app, interval),
+                                               name='news-scheduler', daemon=True)
+            self._scheduler.start()
+
+    def stop_scheduler(self):
+        self._stopped.set()
+
+    def _run_scheduler(self, app, interval):
+        while not self._stopped.is_set():
+            with app.app_context():
+                try:
+                    self.refresh(max_age=interval)
+                except Exception as e:
+                    logger.warning(f"Could not refresh news headlines: {e}")
+                finally:
+                    db.session.remove()
+            self._stopped.wait(interval / 2)
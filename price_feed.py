@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import models
+import refresh_scheduler
+from models import db
+
+# 購読中のティッカーを取得する間隔(秒)。株価は quote_cache を通すので、新しい値は QUOTE_PRICE_TTL ごとに届く
+INTERVAL = float(os.environ.get('PRICE_FEED_INTERVAL', 15))
+# 1つの接続を開いておく最大の秒数。切れたらブラウザが RETRY_MS ミリ秒後に自動で接続し直す
+STREAM_SECONDS = float(os.environ.get('PRICE_FEED_STREAM_SECONDS', 300))
+RETRY_MS = int(os.environ.get('PRICE_FEED_RETRY_MS', 5000))
+# 変化が無い間もこの間隔で空のコメントを送り、切れた接続を検出する
+KEEPALIVE = float(os.environ.get('PRICE_FEED_KEEPALIVE', 15))
+# 1プロセスで同時に開ける接続の数。接続中はスレッドを1つ使うので、gunicorn のスレッド数より少なくする
+MAX_STREAMS = int(os.environ.get('PRICE_FEED_MAX_STREAMS', 4))
+FIELDS = ('current_price', 'performance', 'per', 'pbr', 'dividend_yield')
+
+logger = logging.getLogger(__name__)
+
+
+def _round(value):
+    # 画面は小数点以下2桁で表示するので、表示が変わらない変化は送らない
+    return round(value, 2) if isinstance(value, (int, float)) else value
+
+
+class Subscription:
+    """1つの接続が購読しているティッカーと、まだ送っていない指標 (ティッカーごとに最新の値だけを残す)"""
+
+    def __init__(self, tickers):
+        self.tickers = frozenset(tickers)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def put(self, quotes):
+        with self._lock:
+            self._pending.update(quotes)
+            self._ready.set()
+
+    def get(self, timeout):
+        """届いた指標 (ティッカー -> 指標の辞書) を返す。timeout 秒待っても届かなければ空の辞書"""
+        self._ready.wait(timeout)
+        with self._lock:
+            quotes, self._pending = self._pending, {}
+            self._ready.clear()
+        return quotes
+
+
+class StockRows:
+    """1つの接続が表示している行。届いた指標から、表示中の値と変わった項目だけを取り出す
+
+    rows は id・ticker・entry_price・current_price・per・pbr・dividend_yield を持つ行 (DBから読んだ値)。
+    """
+
+    def __init__(self, rows):
+        self._entries = {}
+        self._shown = {}
+        for row in rows:
+            self._entries.setdefault(row.ticker, []).append((row.id, row.entry_price))
+            self._shown[row.id] = self._values(row._mapping, row.entry_price)
+
+    @property
+    def tickers(self):
+        return list(self._entries)
+
+    @staticmethod
+    def _values(financials, entry_price):
+        values = {field: financials.get(field) for field in FIELDS if field != 'performance'}
+        values['performance'] = models.performance(values['current_price'], entry_price)
+        return {field: _round(value) for field, value in values.items()}
+
+    def changes(self, quotes):
+        """行の id -> 変わった項目の辞書"""
+        changed = {}
+        for ticker, financials in quotes.items():
+            for stock_id, entry_price in self._entries.get(ticker, ()):
+                values = self._values(financials, entry_price)
+                shown = self._shown[stock_id]
+                diff = {field: value for field, value in values.items() if shown.get(field) != value}
+                if diff:
+                    shown.update(diff)
+                    changed[stock_id] = diff
+        return changed
+
+
+class PriceFeed:
+    """購読中のティッカーの株価と財務指標を1つのスレッドで定期的に取得し、変わった値を購読者に配る
+
+    fetch はティッカーのリストを受け取り (ティッカー -> 指標の辞書, 失敗した銘柄 -> エラー内容) を返す関数。
+    何人が同じティッカーを見ていても、取得は間隔ごとに1回で済む。save は値が変わった分
+    (ティッカー -> 指標の辞書) を受け取ってDBに書き戻す関数で、アプリケーションコンテキストの中で呼ぶ。
+    東証の銘柄は RefreshScheduler と同じく立会時間中と引け直後だけ取得する (market_hours=False で常に取得する)。
+    """
+
+    def __init__(self, app, fetch, save=None, interval=INTERVAL, max_streams=MAX_STREAMS, market_hours=True):
+        self.app = app
+        self.fetch = fetch
+        self.save = save
+        self.interval = interval
+        self.max_streams = max_streams
+        self.market_hours = market_hours
+        self.latest = {}
+        self.polls = 0
+        self.last_run = None
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, tickers):
+        """購読を始める。接続数が上限に達している場合は None を返す
+
+        取得済みの指標があれば、次の取得を待たずに最初の更新として届ける。
+        """
+        subscription = Subscription(tickers)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_streams:
+                return None
+            self._subscriptions.add(subscription)
+            known = {ticker: self.latest[ticker] for ticker in subscription.tickers if ticker in self.latest}
+            self._active.set()
+        if known:
+            subscription.put(known)
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if not self._subscriptions:
+                self._active.clear()
+
+    def streams(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def poll_once(self, now=None):
+        """購読中のティッカーを1回取得して配る。戻り値は (取得した件数, 値が変わった件数, 失敗した銘柄 -> エラー内容)"""
+        now = now or datetime.now(refresh_scheduler.JST)
+        with self._lock:
+            subscribed = set().union(*(s.tickers for s in self._subscriptions))
+        tickers = sorted(subscribed)
+        if self.market_hours:
+            last_run = self.last_run or now - timedelta(seconds=self.interval)
+            tickers = refresh_scheduler.due_tickers(tickers, now, last_run)
+        results, failures = self.fetch(tickers) if tickers else ({}, {})
+        self.last_run = now
+        self.polls += 1
+        with self._lock:
+            changed = {ticker: quotes for ticker, quotes in results.items() if self.latest.get(ticker) != quotes}
+            # 誰も見ていないティッカーの値は持ち続けない
+            self.latest = {ticker: quotes for ticker, quotes in {**self.latest, **results}.items()
+                           if ticker in subscribed}
+            subscriptions = list(self._subscriptions)
+        if changed and self.save is not None:
+            with self.app.app_context():
+                try:
+                    self.save(changed)
+                except Exception as e:
+                    logger.exception(f"Could not save streamed prices: {e}")
+                finally:
+                    db.session.remove()
+        for subscription in subscriptions:
+            quotes = {ticker: changed[ticker] for ticker in subscription.tickers if ticker in changed}
+            if quotes:
+                subscription.put(quotes)
+        return len(tickers), len(changed), failures
+
+    def run(self):
+        while not self._stopped.is_set():
+            # 購読者がいない間は取得しない
+            self._active.wait(1.0)
+            if not self._active.is_set():
+                continue
+            started = time.monotonic()
+            try:
+                total, changed, failures = self.poll_once()
+                if failures:
+                    logger.info(f"Price feed: {changed}/{total} tickers changed, {len(failures)} failed")
+            except Exception as e:
+                logger.exception(f"Price feed poll failed: {e}")
+            self._stopped.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        """このプロセスの中でバックグラウンドスレッドとして実行する (最初の購読で呼ばれる)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self.run, name='price-feed', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,152 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import select
+import market_data
+import metrics
+from models import db, PriceHistory
+
+# 初めて取得する銘柄は何日分さかのぼるか
+INITIAL_DAYS = int(os.environ.get('PRICE_HISTORY_DAYS', 5 * 365))
+PRICE_COLUMNS = ('open', 'high', 'low', 'close')
+COLUMNS = ('date',) + PRICE_COLUMNS + ('volume',)
+_DTYPES = {'date': 'datetime64[D]', 'open': 'float64', 'high': 'float64', 'low': 'float64', 'close': 'float64',
+           'volume': 'int64'}
+
+
+def empty_bars():
+    return {column: np.array([], dtype=dtype) for column, dtype in _DTYPES.items()}
+
+
+def encode(bars):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **bars)
+    return buffer.getvalue()
+
+
+def decode(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        return {column: arrays[column] for column in COLUMNS}
+
+
+def frame_to_bars(frame):
+    """yfinance の history() の DataFrame を列ごとの配列に変換する"""
+    if frame is None or frame.empty:
+        return empty_bars()
+    frame = frame.dropna(subset=['Close'])
+    bars = {'date': np.array([d.date() for d in frame.index], dtype='datetime64[D]')}
+    for column in PRICE_COLUMNS:
+        bars[column] = frame[column.capitalize()].to_numpy(dtype='float64')
+    bars['volume'] = frame['Volume'].fillna(0).to_numpy(dtype='int64')
+    return bars
+
+
+def merge(old, new):
+    """2つの日足をつなげて日付順に並べる。同じ日付は new の値を残す"""
+    combined = {column: np.concatenate([old[column], new[column]]) for column in COLUMNS}
+    # 逆順にしてから unique を取ると、同じ日付では後ろ(new)の行が選ばれる
+    reversed_dates = combined['date'][::-1]
+    _, first = np.unique(reversed_dates, return_index=True)
+    keep = len(reversed_dates) - 1 - first
+    return {column: values[keep] for column, values in combined.items()}
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load(tickers):
+    """複数ティッカーの日足を1回のクエリで読み込む。保存されていないティッカーは含まない"""
+    tickers = list(dict.fromkeys(t.upper() for t in tickers))
+    result = {}
+    if not tickers:
+        return result
+    rows = db.session.execute(
+        select(PriceHistory.ticker, PriceHistory.last_date, PriceHistory.bar_count, PriceHistory.data)
+        .where(PriceHistory.ticker.in_(tickers))
+    )
+    for ticker, last_date, bar_count, data in rows:
+        version = (last_date, bar_count, len(data))
+        with _cache_lock:
+            cached = _cache.get(ticker)
+        if cached is None or cached[0] != version:
+            cached = (version, decode(data))
+            with _cache_lock:
+                _cache[ticker] = cached
+        result[ticker] = cached[1]
+    return result
+
+
+def update(tickers, today=None, max_workers=None):
+    """保存済みの最終日以降の日足だけを取得して追記する
+
+    最終日の足は取引時間中に保存したものかもしれないので取り直す。同じ日に確認済みの
+    ティッカーは問い合わせない。戻り値は (更新したティッカー数, 失敗したティッカー -> エラー内容)。
+    """
+    today = today or date.today()
+    tickers = list(dict.fromkeys(t.upper() for t in tickers))
+    if not tickers:
+        return 0, {}
+    rows = {row.ticker: row for row in db.session.scalars(
+        select(PriceHistory).where(PriceHistory.ticker.in_(tickers)))}
+    targets = [t for t in tickers if t not in rows or rows[t].checked_on is None or rows[t].checked_on < today]
+    if not targets:
+        return 0, {}
+
+    def fetch(ticker):
+        row = rows.get(ticker)
+        start = row.last_date if row is not None and row.last_date else today - timedelta(days=INITIAL_DAYS)
+        try:
+            return ticker, frame_to_bars(market_data.fetch_history(ticker, start)), None
+        except Exception as e:
+            return ticker, None, str(e) or e.__class__.__name__
+
+    failures = {}
+    updated = 0
+    with ThreadPoolExecutor(max_workers=min(max_workers or market_data.MAX_WORKERS, len(targets))) as executor:
+        fetched = list(executor.map(metrics.bind(fetch), targets))
+    for ticker, new_bars, error in fetched:
+        if error is not None:
+            failures[ticker] = error
+            continue
+        row = rows.get(ticker)
+        if row is None:
+            row = PriceHistory(ticker=ticker)
+            db.session.add(row)
+            bars = merge(empty_bars(), new_bars)
+        else:
+            bars = merge(decode(row.data), new_bars)
+        row.data = encode(bars)
+        row.bar_count = len(bars['date'])
+        row.first_date = bars['date'][0].item() if row.bar_count else None
+        row.last_date = bars['date'][-1].item() if row.bar_count else None
+        row.checked_on = today
+        updated += 1
+    db.session.commit()
+    return updated, failures
+
+
+def closes_at(bars_by_ticker, when):
+    """各ティッカーの when 時点(その日以前で最後の取引日)の終値。データが無ければ NaN"""
+    when = np.datetime64(when, 'D')
+    closes = {}
+    for ticker, bars in bars_by_ticker.items():
+        index = np.searchsorted(bars['date'], when, side='right') - 1
+        closes[ticker] = float(bars['close'][index]) if index >= 0 else float('nan')
+    return closes
+
+
+def window_returns(bars_by_ticker, days, as_of=None):
+    """直近 days 日間の騰落率(%)をティッカーごとに返す"""
+    as_of = np.datetime64(date.today() if as_of is None else as_of, 'D')
+    start = closes_at(bars_by_ticker, as_of - np.timedelta64(days, 'D'))
+    end = closes_at(bars_by_ticker, as_of)
+    tickers = list(bars_by_ticker)
+    start_values = np.array([start[t] for t in tickers])
+    end_values = np.array([end[t] for t in tickers])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = (end_values / start_values - 1) * 100
+    return {t: (None if np.isnan(r) or np.isinf(r) else float(r)) for t, r in zip(tickers, returns)}
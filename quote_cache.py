@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+# 株価は短く、めったに変わらない財務指標・社名・セクターは長くキャッシュする
+PRICE_FIELDS = ('currentPrice', 'regularMarketPrice')
+FUNDAMENTAL_FIELDS = ('longName', 'sector', 'forwardPE', 'trailingPE', 'priceToBook', 'dividendYield')
+PRICE_TTL = float(os.environ.get('QUOTE_PRICE_TTL', 60))
+FUNDAMENTALS_TTL = float(os.environ.get('QUOTE_FUNDAMENTALS_TTL', 6 * 60 * 60))
+MAX_ENTRIES = int(os.environ.get('QUOTE_CACHE_MAX_ENTRIES', 5000))
+
+
+class MemoryBackend:
+    """プロセス内のLRUキャッシュ"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """複数ワーカーで共有するためのSQLiteファイルを使ったLRUキャッシュ"""
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS quote_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_quote_cache_accessed_at ON quote_cache (accessed_at)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM quote_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE quote_cache SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO quote_cache (key, value, accessed_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), time.time()),
+            )
+            conn.execute(
+                'DELETE FROM quote_cache WHERE key IN ('
+                'SELECT key FROM quote_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM quote_cache').fetchone()[0]
+
+
+def create_backend():
+    """環境変数 QUOTE_CACHE_BACKEND (memory / sqlite) からバックエンドを作る"""
+    if os.environ.get('QUOTE_CACHE_BACKEND', 'memory') == 'sqlite':
+        return SQLiteBackend(os.environ.get('QUOTE_CACHE_PATH', 'quote_cache.db'))
+    return MemoryBackend()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QuoteCache:
+    """ティッカーごとの株価・財務指標キャッシュ
+
+    fetch_info は info 全体を、fetch_price は株価だけを取得する関数。
+    財務指標がまだ有効で株価だけ期限切れの場合は fetch_price だけを呼ぶ。
+    同じティッカーへの同時リクエストは1回の取得にまとめる。
+    """
+
+    def __init__(self, fetch_info, fetch_price=None, backend=None,
+                 price_ttl=PRICE_TTL, fundamentals_ttl=FUNDAMENTALS_TTL):
+        self.fetch_info = fetch_info
+        self.fetch_price = fetch_price
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.price_ttl = price_ttl
+        self.fundamentals_ttl = fundamentals_ttl
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.price_refreshes = 0
+        self.coalesced = 0
+
+    def get_info(self, ticker):
+        """キャッシュを通して info 相当の辞書を返す"""
+        key = ticker.upper()
+        entry = self.backend.get(key)
+        now = time.time()
+        if entry and self._is_fresh(entry, now):
+            self.hits += 1
+            metrics.record_cache('quote', 'hit')
+            return self._merge(entry)
+
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+        if not leader:
+            self.coalesced += 1
+            metrics.record_cache('quote', 'coalesced')
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return self._merge(call.result)
+
+        self.misses += 1
+        metrics.record_cache('quote', 'miss')
+        try:
+            call.result = self._refresh(key, entry, now)
+            self.backend.set(key, call.result)
+            return self._merge(call.result)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+
+    def invalidate_prices(self, ticker):
+        """次回の get_info で株価を取り直させる"""
+        key = ticker.upper()
+        entry = self.backend.get(key)
+        if entry:
+            entry['price_at'] = 0
+            self.backend.set(key, entry)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'price_refreshes': self.price_refreshes,
+            'coalesced': self.coalesced,
+            'entries': len(self.backend),
+        }
+
+    def _is_fresh(self, entry, now):
+        return (now - entry['price_at'] < self.price_ttl
+                and now - entry['fundamentals_at'] < self.fundamentals_ttl)
+
+    def _refresh(self, key, entry, now):
+        if (entry and self.fetch_price is not None
+                and now - entry['fundamentals_at'] < self.fundamentals_ttl):
+            try:
+                price = self.fetch_price(key)
+            except Exception:
+                price = None
+            if price is not None:
+                self.price_refreshes += 1
+                return dict(entry, price={field: price for field in PRICE_FIELDS}, price_at=now)
+        info = self.fetch_info(key)
+        return {
+            'price': {field: info[field] for field in PRICE_FIELDS if info.get(field) is not None},
+            'fundamentals': {field: info[field] for field in FUNDAMENTAL_FIELDS if info.get(field) is not None},
+            'price_at': now,
+            'fundamentals_at': now,
+        }
+
+    @staticmethod
+    def _merge(entry):
+        return {**entry['fundamentals'], **entry['price']}
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+# 外部APIごとの、全体とユーザーごとの1秒あたりの呼び出し回数と、まとめて呼べる回数 (バースト)
+GEMINI_RATE = float(os.environ.get('GEMINI_RATE', 5))
+GEMINI_BURST = float(os.environ.get('GEMINI_BURST', 10))
+GEMINI_USER_RATE = float(os.environ.get('GEMINI_USER_RATE', 1))
+GEMINI_USER_BURST = float(os.environ.get('GEMINI_USER_BURST', 5))
+YFINANCE_RATE = float(os.environ.get('YFINANCE_RATE', 10))
+YFINANCE_BURST = float(os.environ.get('YFINANCE_BURST', 30))
+YFINANCE_USER_RATE = float(os.environ.get('YFINANCE_USER_RATE', 5))
+YFINANCE_USER_BURST = float(os.environ.get('YFINANCE_USER_BURST', 30))
+# 順番待ちをする最大の秒数と、1ユーザーが同時に順番待ちできる呼び出しの数。超える分はすぐに断る
+MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 10))
+USER_MAX_QUEUED = int(os.environ.get('RATE_LIMIT_USER_MAX_QUEUED', 8))
+# 0 にすると制限しない (ローカルの開発やフェイクを使うベンチマーク向け)
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+
+
+class RateLimited(Exception):
+    """外部APIの呼び出し回数の上限に達した。retry_after 秒後に再試行できる"""
+
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} の呼び出し回数の上限に達しました ({retry_after}秒後に再試行できます)")
+        self.service = service
+        self.retry_after = retry_after
+
+
+class MemoryBackend:
+    """プロセス内でバケットの状態を持つ"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def transact(self, keys, update):
+        """keys の状態を update に渡し、返された新しい状態を保存する。update が例外を送出した場合は保存しない"""
+        with self._lock:
+            states, result = update({key: self._data.get(key) for key in keys})
+            self._data.update(states)
+            return result
+
+
+class SQLiteBackend:
+    """同じホストの複数ワーカーでバケットを共有するためのSQLiteファイル"""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_limit (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def transact(self, keys, update):
+        conn = self._connect()
+        try:
+            # 読んでから書くまでの間に他のワーカーが書き込まないよう、最初に書き込みロックを取る
+            conn.execute('BEGIN IMMEDIATE')
+            rows = dict(conn.execute(
+                f"SELECT key, value FROM rate_limit WHERE key IN ({','.join('?' * len(keys))})", keys).fetchall())
+            try:
+                states, result = update({key: json.loads(rows[key]) if key in rows else None for key in keys})
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.executemany('INSERT OR REPLACE INTO rate_limit (key, value) VALUES (?, ?)',
+                             [(key, json.dumps(state)) for key, state in states.items()])
+            conn.execute('COMMIT')
+            return result
+        finally:
+            conn.close()
+
+
+def create_backend():
+    """環境変数 RATE_LIMIT_BACKEND (memory / sqlite) からバックエンドを作る"""
+    if os.environ.get('RATE_LIMIT_BACKEND', 'memory') == 'sqlite':
+        return SQLiteBackend(os.environ.get('RATE_LIMIT_PATH', 'rate_limit.db'))
+    return MemoryBackend()
+
+
+def current_user_id():
+    """回数を数えるユーザー。リクエストの外 (CLI・スケジューラー) では None になり、全体の上限だけを適用する"""
+    stats = metrics.current()
+    return getattr(stats, 'user_id', None)
+
+
+class Limiter:
+    """全体とユーザーごとのトークンバケットで外部APIの呼び出しを制限する
+
+    トークンが足りない場合はその分の時刻を予約して順番を待つ (トークンは負の値になる)。
+    待ち時間が max_wait を超える場合と、そのユーザーの順番待ちが user_max_queued 件に達している場合は
+    RateLimited を送出する。1人のユーザーが大量に呼び出しても、全体の待ち行列はユーザーごとの上限までしか
+    埋まらないので、他のユーザーの呼び出しは待たされ続けない。
+    clock と sleep はテストやベンチマークでフェイクの時計に差し替えられる。enabled が False なら常に待たずに呼べる。
+    """
+
+    def __init__(self, service, rate, burst, user_rate, user_burst, max_wait=MAX_WAIT,
+                 user_max_queued=USER_MAX_QUEUED, backend=None, clock=time.time, sleep=time.sleep, enabled=True):
+        self.service = service
+        self.rate = rate
+        self.burst = burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_wait = max_wait
+        self.user_max_queued = user_max_queued
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.clock = clock
+        self.sleep = sleep
+        self.enabled = enabled
+
+    @staticmethod
+    def _refill(state, rate, burst, now):
+        if state is None:
+            return {'tokens': burst, 'at': now}
+        return dict(state, tokens=min(burst, state['tokens'] + (now - state['at']) * rate), at=now)
+
+    def reserve(self, user_id=None, max_wait=None):
+        """1回分のトークンを予約し、呼び出してよい時刻までの待ち時間(秒)を返す"""
+        if not self.enabled:
+            return 0.0
+        max_wait = self.max_wait if max_wait is None else max_wait
+        global_key = f"{self.service}:*"
+        user_key = f"{self.service}:user:{user_id}" if user_id is not None else None
+        keys = [global_key] + ([user_key] if user_key else [])
+
+        def update(states):
+            now = self.clock()
+            new_states = {global_key: self._refill(states[global_key], self.rate, self.burst, now)}
+            new_states[global_key]['tokens'] -= 1
+            wait = max(0.0, -new_states[global_key]['tokens'] / self.rate)
+            if user_key:
+                user = self._refill(states[user_key], self.user_rate, self.user_burst, now)
+                user['tokens'] -= 1
+                user['queued'] = [t for t in user.get('queued', []) if t > now]
+                wait = max(wait, -user['tokens'] / self.user_rate)
+                if wait > 0 and len(user['queued']) >= self.user_max_queued:
+                    raise RateLimited(self.service, max(1, math.ceil(user['queued'][0] - now)))
+                if wait > 0:
+                    user['queued'].append(now + wait)
+                new_states[user_key] = user
+            if wait > max_wait:
+                raise RateLimited(self.service, max(1, math.ceil(wait - max_wait)))
+            return new_states, wait
+
+        try:
+            wait = self.backend.transact(keys, update)
+        except RateLimited:
+            metrics.registry.inc('rate_limited_total', help='回数制限で断った外部呼び出しの数', service=self.service)
+            raise
+        if wait:
+            metrics.registry.observe('rate_limit_wait_seconds', wait, help='回数制限で順番を待った時間',
+                                     service=self.service)
+        return wait
+
+    def _max_wait(self):
+        # リクエストの締め切りを過ぎてまで待たない
+        return metrics.time_left(self.max_wait)
+
+    def acquire(self, user_id=None):
+        """呼び出せるようになるまで待つ。user_id を省略すると現在のリクエストのユーザーの回数に数える"""
+        wait = self.reserve(current_user_id() if user_id is None else user_id, self._max_wait())
+        if wait:
+            self.sleep(wait)
+
+    async def acquire_async(self, user_id=None):
+        if not self.enabled:
+            return
+        # SQLite のバックエンドはロックを待つことがあるので、共有のイベントループを止めないよう別スレッドで予約する
+        wait = await asyncio.to_thread(self.reserve, current_user_id() if user_id is None else user_id,
+                                       self._max_wait())
+        if wait:
+            await asyncio.sleep(wait)
+
+
+_backend = create_backend()
+gemini = Limiter('gemini', GEMINI_RATE, GEMINI_BURST, GEMINI_USER_RATE, GEMINI_USER_BURST, backend=_backend,
+                 enabled=ENABLED)
+yfinance = Limiter('yfinance', YFINANCE_RATE, YFINANCE_BURST, YFINANCE_USER_RATE, YFINANCE_USER_BURST,
+                   backend=_backend, enabled=ENABLED)
@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
+from sqlalchemy import select
+from models import db, StockItem
+
+# 定期更新の間隔(秒)
+INTERVAL = int(os.environ.get('FINANCIAL_REFRESH_INTERVAL', 5 * 60))
+JST = ZoneInfo('Asia/Tokyo')
+# 東証の立会時間 (前場・後場)
+TSE_SESSIONS = ((dtime(9, 0), dtime(11, 30)), (dtime(12, 30), dtime(15, 30)))
+# 年末年始の休場日 (祝日は TSE_HOLIDAYS に YYYY-MM-DD をカンマ区切りで指定する)
+TSE_YEAR_END_HOLIDAYS = ((12, 31), (1, 1), (1, 2), (1, 3))
+TSE_HOLIDAYS = {d.strip() for d in os.environ.get('TSE_HOLIDAYS', '').split(',') if d.strip()}
+
+logger = logging.getLogger(__name__)
+
+
+def is_tse_ticker(ticker):
+    return ticker.upper().endswith('.T')
+
+
+def is_tse_trading_day(day):
+    return (day.weekday() < 5 and (day.month, day.day) not in TSE_YEAR_END_HOLIDAYS
+            and day.isoformat() not in TSE_HOLIDAYS)
+
+
+def is_tse_open(now=None):
+    now = (now or datetime.now(JST)).astimezone(JST)
+    if not is_tse_trading_day(now.date()):
+        return False
+    return any(start <= now.time() < end for start, end in TSE_SESSIONS)
+
+
+def tse_closed_between(since, now):
+    """since から now までの間に前場・後場の終わりがあったか (引け値を1回だけ取り込むため)"""
+    since, now = since.astimezone(JST), now.astimezone(JST)
+    day = since.date()
+    while day <= now.date():
+        if is_tse_trading_day(day):
+            for _, end in TSE_SESSIONS:
+                close = datetime.combine(day, end, JST)
+                if since < close <= now:
+                    return True
+        day += timedelta(days=1)
+    return False
+
+
+def due_tickers(tickers, now, last_run):
+    """今回更新するティッカー
+
+    東証の銘柄は立会時間中か、前回から今回までの間に引けを迎えた場合だけ対象にする。
+    それ以外の市場の銘柄は取引時間が分からないので毎回対象にする。
+    """
+    tse_due = is_tse_open(now) or tse_closed_between(last_run, now)
+    return [t for t in tickers if not is_tse_ticker(t) or tse_due]
+
+
+def all_tickers():
+    """全ユーザーの銘柄から重複を除いたティッカー"""
+    return db.session.scalars(select(StockItem.ticker).distinct()).all()
+
+
+class RefreshScheduler:
+    """全ユーザーの銘柄の株価と財務指標を定期的に更新する
+
+    refresh はティッカーのリストを受け取り (成功件数, 失敗した銘柄 -> エラー内容) を返す関数。
+    同じティッカーは1回だけ取得し、保有している全ユーザーの行へ書き込むのは refresh 側で行う。
+    """
+
+    def __init__(self, app, refresh, interval=INTERVAL):
+        self.app = app
+        self.refresh = refresh
+        self.interval = interval
+        self.last_run = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def run_once(self, now=None, force=False):
+        """対象のティッカーを1回更新する。戻り値は (対象件数, 成功件数, 失敗した銘柄 -> エラー内容)"""
+        now = now or datetime.now(JST)
+        last_run = self.last_run or now - timedelta(seconds=self.interval)
+        with self.app.app_context():
+            try:
+                tickers = all_tickers()
+                if not force:
+                    tickers = due_tickers(tickers, now, last_run)
+                success_count, failures = self.refresh(tickers) if tickers else (0, {})
+            finally:
+                db.session.remove()
+        self.last_run = now
+        return len(tickers), success_count, failures
+
+    def run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                total, success_count, failures = self.run_once()
+                if total:
+                    logger.info(f"Scheduled financial refresh: {success_count}/{total} tickers, {len(failures)} failed")
+            except Exception as e:
+                logger.exception(f"Scheduled financial refresh failed: {e}")
+            self._stopped.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        """このプロセスの中でバックグラウンドスレッドとして実行する"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self.run, name='financial-refresh-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,242 @@
+import json
+import os
+import re
+import unicodedata
+from datetime import datetime
+from sqlalchemy import select, delete, func
+import metrics
+from map_cache import normalize_key
+from models import db, ThemeNode, ThemeEdge, ThemeTerm, TickerMetadata, MapCache, CacheGeneration
+
+# グラフから組み立てるマップの分野数・1分野あたりの企業数と、グラフで答えるのに必要な最小の分野数
+MAX_CATEGORIES = 5
+MAX_COMPANIES = 3
+MIN_CATEGORIES = int(os.environ.get('THEME_GRAPH_MIN_CATEGORIES', 3))
+# 東証の証券コード (4桁の数字、または2024年以降の英字を含む4文字) + .T
+TICKER_PATTERN = re.compile(r'^[0-9][0-9A-Z]{3}\.T$')
+# flask load-ticker-metadata で東証の全銘柄の一覧を読み込んだ印 (CacheGeneration の行)
+LISTING_KEY = 'ticker_metadata:listing'
+
+
+def normalize_ticker(ticker):
+    ticker = unicodedata.normalize('NFKC', str(ticker or '')).strip().upper()
+    if re.fullmatch(r'[0-9][0-9A-Z]{3}', ticker):
+        ticker += '.T'
+    return ticker
+
+
+def terms(key):
+    """転置インデックスに登録する2文字ずつの断片"""
+    return {key[i:i + 2] for i in range(len(key) - 1) if not key[i:i + 2].isspace()}
+
+
+class TickerValidator:
+    """ティッカーの形式と、東証の銘柄一覧 (TickerMetadata) に載っているかを確認する
+
+    銘柄の追加や一括登録でも TickerMetadata に行が増えるので、行があるだけでは一覧とはみなさない。
+    flask load-ticker-metadata で一覧を読み込んだ印 (LISTING_KEY) がある場合だけ一覧に無いティッカーを無効にし、
+    それ以外は形式だけを確認する。check_listing=False なら印があっても形式だけを確認する。
+    """
+
+    def __init__(self, check_listing=True):
+        self._metadata = {}
+        self._checked = set()
+        self._has_listing = None if check_listing else False
+
+    def load(self, tickers):
+        tickers = [t for t in {normalize_ticker(t) for t in tickers} if TICKER_PATTERN.match(t) and t not in self._checked]
+        if self._has_listing is None:
+            self._has_listing = db.session.get(CacheGeneration, LISTING_KEY) is not None
+        self._checked.update(tickers)
+        if tickers:
+            for row in db.session.scalars(select(TickerMetadata).where(TickerMetadata.ticker.in_(tickers))):
+                self._metadata[row.ticker] = row
+
+    def validate(self, ticker):
+        """有効なら (正規化したティッカー, TickerMetadata または None)、無効なら (None, None) を返す"""
+        ticker = normalize_ticker(ticker)
+        if not TICKER_PATTERN.match(ticker):
+            return None, None
+        if self._has_listing is None or ticker not in self._checked:
+            self.load([ticker])
+        metadata = self._metadata.get(ticker)
+        if self._has_listing and metadata is None:
+            return None, None
+        return ticker, metadata
+
+    def ticker(self, ticker):
+        """有効なら正規化したティッカー、無効なら None を返す"""
+        return self.validate(ticker)[0]
+
+
+def mark_listing_loaded():
+    """TickerMetadata に全銘柄の一覧を読み込んだことを記録する (コミットは呼び出し側で行う)"""
+    if db.session.get(CacheGeneration, LISTING_KEY) is None:
+        db.session.add(CacheGeneration(key=LISTING_KEY, generation=1))
+
+
+class _Writer:
+    """マップをグラフに取り込む。頂点と辺は取り込みの間メモリに持ち、同じものを何度も問い合わせない"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.edges = {}
+        self.validator = TickerValidator()
+        self.added_nodes = 0
+        self.rejected = 0
+
+    def node(self, kind, key, name, **fields):
+        node = self.nodes.get((kind, key))
+        if node is None:
+            node = db.session.scalar(select(ThemeNode).where(ThemeNode.kind == kind, ThemeNode.key == key))
+        if node is None:
+            node = ThemeNode(kind=kind, key=key, name=name, **fields)
+            db.session.add(node)
+            db.session.flush()
+            if kind == 'theme':
+                db.session.add_all(ThemeTerm(term=term, node_id=node.id) for term in terms(key))
+            self.added_nodes += 1
+        else:
+            for field, value in fields.items():
+                if value and not getattr(node, field):
+                    setattr(node, field, value)
+        self.nodes[(kind, key)] = node
+        return node
+
+    def edge(self, parent, child, reason=None):
+        edge = self.edges.get((parent.id, child.id))
+        if edge is None:
+            edge = db.session.scalar(
+                select(ThemeEdge).where(ThemeEdge.parent_id == parent.id, ThemeEdge.child_id == child.id))
+        if edge is None:
+            edge = ThemeEdge(parent_id=parent.id, child_id=child.id, reason=reason, weight=0)
+            db.session.add(edge)
+        edge.weight += 1
+        edge.updated_at = datetime.utcnow()
+        if reason:
+            edge.reason = reason
+        self.edges[(parent.id, child.id)] = edge
+        return edge
+
+    def merge(self, tree, text=None):
+        # 中心のテーマは AI の応答の name ではなく、利用者が入力したキーワードやニュースで登録する
+        name = str(text or tree.get('name') or '').strip()
+        if not name:
+            return
+        categories = [c for c in tree.get('children') or [] if isinstance(c, dict)]
+        self.validator.load(company.get('ticker') for category in categories
+                            for company in category.get('children') or [] if isinstance(company, dict))
+        root = self.node('theme', normalize_key(name), name)
+        for category in categories:
+            category_name = str(category.get('name') or '').strip()
+            if not category_name:
+                continue
+            theme = self.node('theme', normalize_key(category_name), category_name)
+            if theme.id == root.id:
+                continue
+            self.edge(root, theme)
+            for company in category.get('children') or []:
+                if not isinstance(company, dict):
+                    continue
+                ticker, metadata = self.validator.validate(company.get('ticker'))
+                if ticker is None:
+                    self.rejected += 1
+                    continue
+                company_name = (metadata.company_name if metadata and metadata.company_name
+                                else str(company.get('name') or ticker))
+                node = self.node('company', ticker, company_name, ticker=ticker,
+                                 description=company.get('description'))
+                self.edge(theme, node, company.get('reason'))
+
+
+def merge(tree, text=None):
+    """生成したマップをグラフに取り込む。戻り値は (追加した頂点数, ティッカーが無効で除外した企業数)"""
+    writer = _Writer()
+    writer.merge(tree, text)
+    db.session.commit()
+    return writer.added_nodes, writer.rejected
+
+
+def rebuild():
+    """MapCache に残っている過去のマップからグラフを作り直す"""
+    db.session.execute(delete(ThemeTerm))
+    db.session.execute(delete(ThemeEdge))
+    db.session.execute(delete(ThemeNode))
+    writer = _Writer()
+    maps = 0
+    for cache_key, tree_json in db.session.execute(select(MapCache.cache_key, MapCache.tree_json)):
+        try:
+            tree = json.loads(tree_json)
+        except ValueError:
+            continue
+        if isinstance(tree, dict):
+            writer.merge(tree, cache_key)
+            maps += 1
+    db.session.commit()
+    return maps, writer.added_nodes, writer.rejected
+
+
+def _children(parent_ids, kind):
+    """parent_ids の子を辺の重みの大きい順に返す。戻り値は 親ID -> [(頂点, 辺)]"""
+    children = {}
+    if not parent_ids:
+        return children
+    rows = db.session.execute(
+        select(ThemeEdge, ThemeNode)
+        .join(ThemeNode, ThemeNode.id == ThemeEdge.child_id)
+        .where(ThemeEdge.parent_id.in_(parent_ids), ThemeNode.kind == kind)
+        .order_by(ThemeEdge.weight.desc(), ThemeEdge.id)
+    )
+    for edge, node in rows:
+        children.setdefault(edge.parent_id, []).append((node, edge))
+    return children
+
+
+def _matching_themes(key):
+    """キーワードを名前に含むテーマを転置インデックスから探す"""
+    key_terms = terms(key)
+    if not key_terms:
+        return []
+    node_ids = db.session.scalars(
+        select(ThemeTerm.node_id)
+        .where(ThemeTerm.term.in_(key_terms))
+        .group_by(ThemeTerm.node_id)
+        .having(func.count() == len(key_terms))
+    ).all()
+    if not node_ids:
+        return []
+    nodes = db.session.scalars(select(ThemeNode).where(ThemeNode.id.in_(node_ids))).all()
+    return [node for node in nodes if key in node.key and node.key != key]
+
+
+def lookup(text, mode='keyword'):
+    """グラフだけでマップを組み立てられればツリーを返し、足りなければ None を返す
+
+    キーワードと同じテーマが過去のマップの中心にあればその分野を使う。連想モードでは、
+    足りない分をキーワードを名前に含むテーマ (「半導体」に対する「パワー半導体」など) で補う。
+    """
+    key = normalize_key(text)
+    root = db.session.scalar(select(ThemeNode).where(ThemeNode.kind == 'theme', ThemeNode.key == key))
+    categories = [node for node, _ in _children([root.id], 'theme').get(root.id, [])] if root else []
+    if len(categories) < MIN_CATEGORIES and mode == 'keyword':
+        known = {node.id for node in categories}
+        categories += [node for node in _matching_themes(key) if node.id not in known]
+    companies = _children([node.id for node in categories], 'company')
+    categories = [node for node in categories if companies.get(node.id)][:MAX_CATEGORIES]
+    if len(categories) < MIN_CATEGORIES:
+        metrics.record_cache('theme_graph', 'miss')
+        return None
+    metrics.record_cache('theme_graph', 'hit')
+    return {"name": text, "children": [
+        {"name": category.name, "children": [
+            {"name": node.name, "ticker": node.ticker, "reason": edge.reason or '', "description": node.description or ''}
+            for node, edge in companies[category.id][:MAX_COMPANIES]
+        ]}
+        for category in categories
+    ]}
+
+
+def stats():
+    counts = dict(db.session.execute(select(ThemeNode.kind, func.count()).group_by(ThemeNode.kind)).all())
+    return {'themes': counts.get('theme', 0), 'companies': counts.get('company', 0),
+            'edges': db.session.scalar(select(func.count()).select_from(ThemeEdge))}
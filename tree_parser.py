@@ -0,0 +1,226 @@
+import json
+import re
+
+_ROOT_NAME = re.compile(r'"name"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_CATEGORY_NAME = re.compile(r'\{\s*"name"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_FENCE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+_decoder = json.JSONDecoder()
+
+
+def _schema(properties, required, **fields):
+    # Gemini は指定がなければ項目をアルファベット順に出力するので、name が先に来るよう順序も指定する
+    return {"type": "object", "properties": properties, "required": required,
+            "property_ordering": list(properties), **fields}
+
+
+_STRING = {"type": "string"}
+COMPANY_SCHEMA = _schema({"name": _STRING, "ticker": _STRING, "reason": _STRING, "description": _STRING},
+                         ["name", "ticker", "reason", "description"])
+# Gemini の構造化出力 (response_schema) に渡すスキーマ。分野1つ分と、マップ全体
+CATEGORY_SCHEMA = _schema({"name": _STRING, "children": {"type": "array", "items": COMPANY_SCHEMA}},
+                          ["name", "children"])
+MAP_SCHEMA = _schema({"name": _STRING, "children": {"type": "array", "items": CATEGORY_SCHEMA}},
+                     ["name", "children"])
+
+
+def extract_json(text):
+    """応答からJSONの部分を取り出す。最初の { から始まるJSONを読み、後ろに続く文章は捨てる
+
+    最後まで読めない (途中で切れている・壊れている) 場合は { 以降をそのまま返す。
+    """
+    text = _FENCE.sub(r'\1', text)
+    start = text.find('{')
+    if start < 0:
+        return text
+    try:
+        _, end = _decoder.raw_decode(text, start)
+    except json.JSONDecodeError:
+        return text[start:]
+    return text[start:end]
+
+
+class TreeStreamParser:
+    """Gemini が少しずつ返すマップのJSONから、完成した分野(children の要素)を順に取り出す
+
+    {"name": "...", "children": [ {分野}, {分野}, ... ]} という形を前提に、
+    文字列の中かどうかと括弧の深さだけを追いかける。
+    分野の中の企業も1社ずつ読んでおき、分野のJSONが壊れていても読めた企業だけで分野を組み立て直す。
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.root_name = None
+        self.categories = []
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._category_start = None
+        self._company_start = None
+        self._companies = []
+
+    def feed(self, text):
+        """テキストの断片を追加し、新しく完成した分野のリストを返す"""
+        self.buffer += text
+        completed = []
+        while self._pos < len(self.buffer):
+            ch = self.buffer[self._pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"' and self._stack:
+                self._in_string = True
+            elif ch in '{[':
+                self._stack.append(ch)
+                if self._stack == ['{', '[', '{']:
+                    self._category_start = self._pos
+                    self._companies = []
+                elif self._stack == ['{', '[', '{', '[', '{']:
+                    self._company_start = self._pos
+                elif self._stack == ['{', '['] and self.root_name is None:
+                    match = _ROOT_NAME.search(self.buffer, 0, self._pos)
+                    self.root_name = json.loads(f'"{match.group(1)}"') if match else ''
+            elif ch in '}]' and self._stack:
+                self._stack.pop()
+                if self._stack == ['{', '[', '{', '['] and ch == '}' and self._company_start is not None:
+                    try:
+                        self._companies.append(json.loads(self.buffer[self._company_start:self._pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._company_start = None
+                elif self._stack == ['{', '['] and ch == '}' and self._category_start is not None:
+                    try:
+                        category = json.loads(self.buffer[self._category_start:self._pos + 1])
+                    except json.JSONDecodeError:
+                        category = self._recover_category()
+                    if category is not None:
+                        self.categories.append(category)
+                        completed.append(category)
+                    self._category_start = None
+            self._pos += 1
+        return completed
+
+    def _recover_category(self):
+        """読み終えた企業だけで、書きかけ・壊れた分野を組み立てる。名前も企業も読めなければ None"""
+        match = _CATEGORY_NAME.match(self.buffer, self._category_start)
+        if match is None or not self._companies:
+            return None
+        try:
+            name = json.loads(f'"{match.group(1)}"')
+        except json.JSONDecodeError:
+            return None
+        return {"name": name, "children": list(self._companies)}
+
+    def finish(self):
+        """応答が途中で切れている場合に、書きかけの分野を読めた企業の分だけ追加する。追加した分野のリストを返す"""
+        if self._category_start is None:
+            return []
+        category = self._recover_category()
+        self._category_start = None
+        if category is None:
+            return []
+        self.categories.append(category)
+        return [category]
+
+    def tree(self):
+        """ここまでに完成した分野だけで組み立てたツリー"""
+        return {"name": self.root_name or '', "children": list(self.categories)}
+
+
+def parse_tree(text):
+    """応答全体をマップとして読む。(ツリー, 壊れていた部分を捨てたか) を返し、1分野も読めなければツリーは None"""
+    try:
+        tree = json.loads(extract_json(text))
+    except json.JSONDecodeError:
+        tree = None
+    if isinstance(tree, dict):
+        return tree, False
+    parser = TreeStreamParser()
+    parser.feed(text)
+    parser.finish()
+    if not parser.categories:
+        return None, True
+    return parser.tree(), True
+
+
+def _text(value):
+    return value.strip() if isinstance(value, str) else ''
+
+
+def clean_category(category, validate_ticker, max_companies):
+    """分野の企業のうち、名前があり validate_ticker が通したものだけを残す (ティッカーは正規化した値にする)
+
+    validate_ticker はティッカーを受け取り、有効なら正規化したティッカー、無効なら None を返す関数。
+    分野の名前が無ければ None を返す。有効な企業が残らなかった場合は children が空になる。
+    """
+    if not isinstance(category, dict) or not _text(category.get('name')):
+        return None
+    companies = []
+    seen = set()
+    children = category.get('children')
+    for company in children if isinstance(children, list) else []:
+        if not isinstance(company, dict) or not _text(company.get('name')):
+            continue
+        ticker = validate_ticker(company.get('ticker'))
+        if ticker is None or ticker in seen:
+            continue
+        seen.add(ticker)
+        companies.append({"name": _text(company['name']), "ticker": ticker,
+                          "reason": _text(company.get('reason')), "description": _text(company.get('description'))})
+        if len(companies) == max_companies:
+            break
+    return {"name": _text(category['name']), "children": companies}
+
+
+class TreeCleaner:
+    """分野を clean_category で整えながら集める。ストリーミングでは届いた分野から順に渡す
+
+    有効な企業が残った分野は categories に、残らなかった分野の名前は broken に入れる。
+    同じ名前の分野と、max_categories を超えた分は捨てる。
+    """
+
+    def __init__(self, validate_ticker, max_categories, max_companies):
+        self.validate_ticker = validate_ticker
+        self.max_categories = max_categories
+        self.max_companies = max_companies
+        self.categories = []
+        self.broken = []
+
+    def add(self, categories):
+        """新しく有効と確かめた分野のリストを返す"""
+        accepted = []
+        for category in categories:
+            category = clean_category(category, self.validate_ticker, self.max_companies)
+            if category is None or len(self.categories) + len(self.broken) >= self.max_categories:
+                continue
+            if category['name'] in self.broken or any(c['name'] == category['name'] for c in self.categories):
+                continue
+            if category['children']:
+                self.categories.append(category)
+                accepted.append(category)
+            else:
+                self.broken.append(category['name'])
+        return accepted
+
+
+def clean_tree(tree, validate_ticker, max_categories, max_companies):
+    """ツリーを TreeCleaner で整える。(整えたツリー, 有効な企業が残らなかった分野の名前のリスト) を返す"""
+    cleaner = TreeCleaner(validate_ticker, max_categories, max_companies)
+    children = tree.get('children')
+    cleaner.add(children if isinstance(children, list) else [])
+    return {"name": _text(tree.get('name')), "children": cleaner.categories}, cleaner.broken
+
+
+def tickers(node):
+    """ツリー・分野に含まれるティッカーをすべて返す (まとめて確認するため)"""
+    if not isinstance(node, dict):
+        return []
+    found = [node['ticker']] if isinstance(node.get('ticker'), str) else []
+    children = node.get('children')
+    for child in children if isinstance(children, list) else []:
+        found += tickers(child)
+    return found
@@ -0,0 +1,249 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from sqlalchemy import select, insert, update
+from sqlalchemy.exc import IntegrityError
+import analysis_store
+import analytics
+import gemini_client
+import jobs
+import market_data
+from models import db, StockItem, TickerMetadata
+from theme_graph import normalize_ticker
+
+# 1回の一括登録で受け付ける銘柄数と、株価・社名をまとめて問い合わせる単位
+MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', 1000))
+BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 50))
+RATINGS = ('買い', '中立', '売り')
+EXPORT_COLUMNS = ('ticker', 'company_name', 'company_name_en', 'sector', 'rating', 'rating_date', 'entry_price',
+                  'current_price', 'per', 'pbr', 'dividend_yield', 'memo', 'analysis_text')
+# 読み込むファイルの列名 (日本語/英語のどちらでも可)
+IMPORT_COLUMNS = {
+    'ticker': ('ticker', 'code', 'コード', 'ティッカー'),
+    'rating': ('rating', '評価'),
+    'memo': ('memo', 'メモ'),
+    'entry_price': ('entry_price', '取得価格'),
+    'rating_date': ('rating_date', '評価日'),
+    'analysis_text': ('analysis_text', '分析内容'),
+}
+
+
+def _pick(record, names):
+    for name in names:
+        value = record.get(name)
+        if value is not None and str(value).strip() != '':
+            return value
+    return None
+
+
+def parse(data, fmt):
+    """CSV / JSON のファイル内容を IMPORT_COLUMNS の項目の辞書のリストにする"""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    if fmt == 'csv':
+        records = list(csv.DictReader(io.StringIO(data)))
+    elif fmt == 'json':
+        try:
+            records = json.loads(data)
+        except ValueError as e:
+            raise ValueError(f"JSONを読み込めませんでした: {e}")
+        if isinstance(records, dict):
+            records = records.get('stocks', [])
+        if not isinstance(records, list):
+            raise ValueError("JSONは銘柄の配列か {\"stocks\": [...]} の形式にしてください。")
+        # ティッカーだけの配列も受け付ける
+        records = [{'ticker': r} if isinstance(r, str) else r for r in records if isinstance(r, (str, dict))]
+    else:
+        raise ValueError("ファイル形式は csv か json を指定してください。")
+    if len(records) > MAX_ROWS:
+        raise ValueError(f"一度に登録できるのは{MAX_ROWS}件までです。")
+    return [{field: _pick(record, names) for field, names in IMPORT_COLUMNS.items()} for record in records]
+
+
+def export_rows(user_id):
+    """user_id の全銘柄を EXPORT_COLUMNS の辞書のリストで返す
+
+    analysis_text は最初のレポートだけなので、更新の差分 (AnalysisSection) をつなげたレポートを書き出す。
+    """
+    rows = db.session.execute(
+        select(StockItem.id, *(getattr(StockItem, column) for column in EXPORT_COLUMNS))
+        .where(StockItem.user_id == user_id)
+        .order_by(StockItem.id)
+    ).all()
+    texts = analysis_store.full_texts(rows)
+    exported = []
+    for row in rows:
+        record = {column: row._mapping[column] for column in EXPORT_COLUMNS}
+        record['analysis_text'] = texts[row.id] or None
+        exported.append({column: value.isoformat() if isinstance(value, datetime) else value
+                         for column, value in record.items()})
+    return exported
+
+
+def to_csv(rows):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    # Excel で開いても文字化けしないよう BOM を付ける
+    return '\ufeff' + output.getvalue()
+
+
+def to_json(rows):
+    return json.dumps({'stocks': rows}, ensure_ascii=False, indent=2)
+
+
+class WatchlistImporter:
+    """ファイルから読み込んだ銘柄をまとめてマイリストに登録する
+
+    既存の銘柄との重複は1回のクエリで除き、新しい銘柄の株価は BATCH_SIZE 件ずつ並行して取得する。
+    社名はバッチごとに1回の問い合わせでまとめて調べる (1銘柄ずつ問い合わせると Gemini の回数制限で待たされる)。
+    登録は一括INSERTで行い、分析テキストの無い銘柄の初期分析は分析ジョブとして後から生成する。
+    lookup_names はティッカーのリストから {ティッカー: 日本語社名} を返すコルーチン関数 (分からない銘柄は含めない)。
+    """
+
+    def __init__(self, lookup_names, sector_names=None, save_names=True, batch_size=BATCH_SIZE):
+        self.lookup_names = lookup_names
+        self.sector_names = sector_names or {}
+        self.save_names = save_names
+        self.batch_size = batch_size
+
+    def run(self, user_id, records):
+        """登録を進めながら進捗をイベント (辞書) として返すジェネレーター
+
+        {"type": "start"} → {"type": "progress"} × バッチ数 → {"type": "done"} の順に返す。
+        """
+        rows, failures, duplicates = {}, {}, 0
+        for record in records:
+            ticker = normalize_ticker(record.get('ticker'))
+            if not ticker:
+                continue
+            if ticker in rows:
+                duplicates += 1
+                continue
+            rating = str(record.get('rating') or '中立').strip()
+            if rating not in RATINGS:
+                failures[ticker] = f"評価は {'・'.join(RATINGS)} のいずれかにしてください"
+                continue
+            try:
+                entry_price = float(record['entry_price']) if record.get('entry_price') is not None else None
+            except (TypeError, ValueError):
+                failures[ticker] = '取得価格が数値ではありません'
+                continue
+            try:
+                # 書き出したファイルを読み込み直した場合は評価日を引き継ぐ
+                rating_date = datetime.fromisoformat(str(record['rating_date'])) if record.get('rating_date') else None
+            except ValueError:
+                failures[ticker] = '評価日の形式が正しくありません'
+                continue
+            rows[ticker] = {'ticker': ticker, 'rating': rating, 'memo': record.get('memo') or '',
+                            'entry_price': entry_price, 'rating_date': rating_date,
+                            'analysis_text': record.get('analysis_text')}
+
+        existing = set(db.session.scalars(
+            select(StockItem.ticker).where(StockItem.user_id == user_id, StockItem.ticker.in_(list(rows)))
+        )) if rows else set()
+        new = [ticker for ticker in rows if ticker not in existing]
+        duplicates += len(existing)
+        yield {'type': 'start', 'total': len(new), 'duplicates': duplicates, 'invalid': len(failures)}
+
+        metadata = {m.ticker: m for m in db.session.scalars(select(TickerMetadata).where(TickerMetadata.ticker.in_(new)))}
+        stock_rows, metadata_rows = [], {}
+        for start in range(0, len(new), self.batch_size):
+            batch = new[start:start + self.batch_size]
+            profiles, errors = market_data.fetch_financials(batch, extract=market_data.extract_profile)
+            failures.update(errors)
+            names = self._lookup_names([t for t in profiles if not (metadata.get(t) and metadata[t].company_name)])
+            for ticker, profile in profiles.items():
+                stock_rows.append(self._stock_row(user_id, rows[ticker], profile, metadata.get(ticker),
+                                                  names.get(ticker), metadata_rows))
+            yield {'type': 'progress', 'done': min(start + self.batch_size, len(new)), 'total': len(new),
+                   'added': len(stock_rows), 'failed': len(failures)}
+
+        added = self._insert(user_id, stock_rows, metadata, metadata_rows)
+        failures.update({row['ticker']: '既に追加されています' for row in stock_rows if row['ticker'] not in added})
+        job = None
+        pending_ids = db.session.scalars(
+            select(StockItem.id).where(StockItem.user_id == user_id, StockItem.ticker.in_(list(added)),
+                                       StockItem.analysis_text.is_(None))
+        ).all() if added else []
+        if pending_ids:
+            job = jobs.create_analysis_job(user_id, pending_ids)
+        yield {'type': 'done', 'added': len(added), 'duplicates': duplicates, 'failed': failures,
+               'job_id': job.id if job else None}
+
+    def _lookup_names(self, tickers):
+        if not tickers:
+            return {}
+        try:
+            names = gemini_client.run(self.lookup_names(tickers))
+        except Exception:
+            # 社名が分からなくても登録は続ける (社名の代わりにティッカーを表示する)
+            return {}
+        return {ticker: name for ticker, name in names.items()
+                if ticker in tickers and isinstance(name, str) and name and name != ticker}
+
+    def _stock_row(self, user_id, row, profile, metadata, japanese_name, metadata_rows):
+        ticker = row['ticker']
+        sector = self.sector_names.get(profile['sector'], profile['sector']) if profile['sector'] else None
+        company_name = (metadata and metadata.company_name) or japanese_name
+        # TickerMetadata に無い項目だけを補う (resolve_ticker_metadata と同じ方針)
+        missing = {}
+        if not (metadata and metadata.company_name_en) and profile['long_name']:
+            missing['company_name_en'] = profile['long_name']
+        if not (metadata and metadata.sector) and sector:
+            missing['sector'] = sector
+        if not (metadata and metadata.company_name) and japanese_name and self.save_names:
+            missing['company_name'] = japanese_name
+        if missing:
+            metadata_rows[ticker] = {'ticker': ticker, **missing, 'updated_at': datetime.utcnow()}
+        return {
+            'ticker': ticker,
+            'company_name': company_name or ticker,
+            'company_name_en': (metadata and metadata.company_name_en) or profile['long_name'] or ticker,
+            'sector': (metadata and metadata.sector) or sector or 'N/A',
+            'memo': row['memo'],
+            'rating': row['rating'],
+            'user_id': user_id,
+            'entry_price': row['entry_price'] or profile['current_price'],
+            'current_price': profile['current_price'],
+            'rating_date': row['rating_date'] or (datetime.utcnow() if row['rating'] == '買い' else None),
+            'per': profile['per'],
+            'pbr': profile['pbr'],
+            'dividend_yield': profile['dividend_yield'],
+            'analysis_text': row['analysis_text'] or None,
+            'has_update': False,
+        }
+
+    def _insert(self, user_id, stock_rows, metadata, metadata_rows):
+        """銘柄と TickerMetadata を一括で書き込み、登録したティッカーの集合を返す"""
+        new_metadata = [row for ticker, row in metadata_rows.items() if ticker not in metadata]
+        updated_metadata = [row for ticker, row in metadata_rows.items() if ticker in metadata]
+        for attempt in range(2):
+            try:
+                if new_metadata:
+                    db.session.execute(insert(TickerMetadata), new_metadata)
+                if updated_metadata:
+                    db.session.execute(update(TickerMetadata), updated_metadata)
+                if stock_rows:
+                    db.session.execute(insert(StockItem), stock_rows)
+                db.session.commit()
+                break
+            except IntegrityError:
+                # 取得している間に同じ銘柄が画面や別の登録から追加された場合は、それを除いてやり直す
+                db.session.rollback()
+                if attempt:
+                    raise
+                tickers = [row['ticker'] for row in stock_rows]
+                taken = set(db.session.scalars(
+                    select(StockItem.ticker).where(StockItem.user_id == user_id, StockItem.ticker.in_(tickers))))
+                known = set(db.session.scalars(
+                    select(TickerMetadata.ticker).where(TickerMetadata.ticker.in_(list(metadata_rows)))))
+                stock_rows = [row for row in stock_rows if row['ticker'] not in taken]
+                new_metadata = [row for row in metadata_rows.values() if row['ticker'] not in known]
+                updated_metadata = [row for row in metadata_rows.values() if row['ticker'] in known]
+        if stock_rows:
+            analytics.invalidate(user_id)
+        return {row['ticker'] for row in stock_rows}